@@ -20,7 +20,7 @@ import logging as log
 import os
 import time
 
-from targetd.utils import invoke, TargetdError
+from targetd.utils import invoke, prefixed, sleep, TargetdError
 
 # Notes:
 #
@@ -46,12 +46,16 @@ fs_cmd = 'btrfs'
 pools = []
 
 
-def fs_initialize(config_dict, init_pools):
-
-    global pools
-    pools = [fs['mount'] for fs in init_pools]
+def fs_configure(config_dict, init_pools):
+    """
+    Prepare the pools of init_pools we don't use yet and return a function
+    switching over to init_pools.
+    """
+    new_pools = [fs['mount'] for fs in init_pools]
 
-    for pool in pools:
+    for pool in new_pools:
+        if pool in pools:
+            continue
         # Make sure we have the appropriate subvolumes available
         try:
             create_sub_volume(os.path.join(pool, fs_path))
@@ -60,6 +64,12 @@ def fs_initialize(config_dict, init_pools):
             log.error('Unable to create required subvolumes {0} (Btrfs)'.format(e))
             raise
 
+    def commit():
+        global pools
+        pools = new_pools
+
+    return commit
+
 
 def create_sub_volume(p):
     if not os.path.exists(p):
@@ -169,11 +179,12 @@ def _invoke_retries(command, throw_exception):
     # ERROR: Failed to lookup path for root 0 - No such file or directory
 
     for i in range(0, 5):
-        result, out, err = invoke(command, False)
+        result, out, err = invoke(command, False, retry=i)
         if result == 0:
             return result, out, err
         elif result == 19:
-            time.sleep(1)
+            # gives up at the deadline of the call, like invoke()
+            sleep(1)
             continue
         else:
             raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
@@ -184,10 +195,12 @@ def _invoke_retries(command, throw_exception):
                        "multiple retries %s (Btrfs)" % (str(command)))
 
 
-def fs_hash():
+def fs_hash(pool_name=None, name_prefix=None):
     fs_list = {}
 
     for pool in pools:
+        if pool_name is not None and pool != pool_name:
+            continue
         full_path = os.path.join(pool, fs_path)
 
         result, out, err = _invoke_retries(
@@ -201,7 +214,8 @@ def fs_hash():
 
                 prefix = fs_path + os.path.sep
 
-                if sub_vol[:len(prefix)] == prefix:
+                if sub_vol[:len(prefix)] == prefix and \
+                        prefixed(sub_vol[len(prefix):], name_prefix):
                     key = os.path.join(pool, sub_vol)
                     fs_list[key] = dict(
                         name=sub_vol[len(prefix):],
@@ -215,12 +229,13 @@ def fs_hash():
     return fs_list
 
 
-def ss(req, pool, name):
+def ss(req, pool, name, name_prefix=None):
     '''
         Returns the snapshots belonging to this filesystem
     :param req:
     :param pool: pool of the filesystem
     :param name: name of the subvol of this filesystem
+    :param name_prefix: only return snapshots whose name starts with it
     :return: list of snapshots
     '''
     snapshots = []
@@ -234,6 +249,8 @@ def ss(req, pool, name):
         data = split_stdout(out)
         if len(data):
             for e in data:
+                if not prefixed(e[-1], name_prefix):
+                    continue
                 ts = "%s %s" % (e[10], e[11])
                 time_epoch = int(
                     time.mktime(time.strptime(ts, '%Y-%m-%d %H:%M:%S')))
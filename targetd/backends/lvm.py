@@ -23,6 +23,7 @@ gi.require_version("BlockDev", "2.0")
 from gi.repository import GLib
 from gi.repository import BlockDev as bd
 from targetd.main import TargetdError
+from targetd.utils import bounded, prefixed
 
 REQUESTED_PLUGIN_NAMES = {"lvm"}
 
@@ -111,16 +112,33 @@ def get_dev_path(pool_name, vol_name):
     return "/dev/%s/%s" % (pool2dev_name(pool_name), vol_name)
 
 
-def initialize(config_dict, init_pools):
-    global pools
-    check_pools_access(init_pools)
-    pools = init_pools
-    for pool_name in pools:
-        vg_name = get_vg_lv(pool_name)[0]
-        vg_name_2_pool_name_dict[vg_name] = pool_name
+def configure(config_dict, init_pools):
+    """
+    Check the pools of init_pools we don't use yet and return a function
+    switching over to init_pools.
+    """
+    check_pools_access([p for p in init_pools if p not in pools], init_pools)
+
+    def commit():
+        global pools
+        global vg_name_2_pool_name_dict
+        names = dict(vg_name_2_pool_name_dict)
+        for pool_name in init_pools:
+            names[get_vg_lv(pool_name)[0]] = pool_name
+        vg_name_2_pool_name_dict = names
+        pools = list(init_pools)
+
+    return commit
 
 
-def check_pools_access(check_pools):
+def check_pools_access(check_pools, all_pools=None):
+    """
+    Make sure check_pools exist, and that they can be used along with
+    all_pools (defaults to check_pools).
+    """
+    if all_pools is None:
+        all_pools = check_pools
+
     for pool in check_pools:
         thinp = None
         error = ""
@@ -146,12 +164,14 @@ def check_pools_access(check_pools):
                                    "VG pool {} not found, "
                                    "nested error: {}".format(vg_name, error))
 
-        # Allowed multi-pool configs:
-        # two thinpools from a single vg: ok
-        # two vgs: ok
-        # vg and a thinpool from that vg: BAD
-        #
-        if thin_pool and vg_name in check_pools:
+    # Allowed multi-pool configs:
+    # two thinpools from a single vg: ok
+    # two vgs: ok
+    # vg and a thinpool from that vg: BAD
+    #
+    for pool in all_pools:
+        vg_name, thin_pool = get_vg_lv(pool)
+        if thin_pool and vg_name in all_pools:
             raise TargetdError(
                 TargetdError.INVALID,
                 "VG pool and thin pool from same VG not supported")
@@ -159,10 +179,16 @@ def check_pools_access(check_pools):
     return
 
 
-def volumes(req, pool):
+# libblockdev calls made for a RPC go through utils.bounded(), which gives
+# up on them at the deadline of the call
+
+
+def volumes(req, pool, name_prefix=None):
     output = []
     vg_name, lv_pool = get_vg_lv(pool)
-    for lv in bd.lvm.lvs(vg_name):
+    for lv in bounded(bd.lvm.lvs, vg_name):
+        if not prefixed(lv.lv_name, name_prefix):
+            continue
         attrib = lv.attr
         if not lv_pool:
             if attrib[0] == '-':
@@ -177,44 +203,37 @@ def volumes(req, pool):
 
 
 def create(req, pool, name, size):
-    # Check to ensure that we don't have a volume with this name already,
-    # lvm will fail if we try to create a LV with a duplicate name
-    if any(v['name'] == name for v in volumes(req, pool)):
-        raise TargetdError(TargetdError.NAME_CONFLICT,
-                           "Volume with that name exists")
-
+    # block.create() checked there is no volume with this name already
     vg_name, lv_pool = get_vg_lv(pool)
     if lv_pool:
         # Fall back to non-thinp if needed
         try:
-            bd.lvm.thlvcreate(vg_name, lv_pool, name, int(size))
+            bounded(bd.lvm.thlvcreate, vg_name, lv_pool, name, int(size))
         except bd.LVMError:
-            bd.lvm.lvcreate(vg_name, name, int(size), 'linear')
+            bounded(bd.lvm.lvcreate, vg_name, name, int(size), 'linear')
     else:
-        bd.lvm.lvcreate(vg_name, name, int(size), 'linear')
+        bounded(bd.lvm.lvcreate, vg_name, name, int(size), 'linear')
 
 
 def destroy(req, pool, name):
     vg_name, lv_pool = get_vg_lv(pool)
-    bd.lvm.lvremove(vg_name, name)
+    bounded(bd.lvm.lvremove, vg_name, name)
 
 
 def copy(req, pool, vol_orig, vol_new, timeout=10):
     """
     Create a new volume that is a copy of an existing one.
-    Since 0.6, requires thinp support.
+    Since 0.6, requires thinp support.  block.copy() checked there is no
+    volume named vol_new already.
     """
-    if any(v['name'] == vol_new for v in volumes(req, pool)):
-        raise TargetdError(TargetdError.NAME_CONFLICT,
-                           "Volume with that name exists")
-
     vg_name, thin_pool = get_vg_lv(pool)
 
     if not thin_pool:
         raise RuntimeError("copy requires thin-provisioned volumes")
 
     try:
-        bd.lvm.thsnapshotcreate(vg_name, vol_orig, vol_new, thin_pool)
+        bounded(bd.lvm.thsnapshotcreate, vg_name, vol_orig, vol_new,
+                thin_pool)
     except bd.LVMError as err:
         raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
                            "Failed to copy volume, "
@@ -222,7 +241,7 @@ def copy(req, pool, vol_orig, vol_new, timeout=10):
 
 
 def vol_info(pool, name):
-    return bd.lvm.lvinfo(pool2dev_name(pool), name)
+    return bounded(bd.lvm.lvinfo, pool2dev_name(pool), name)
 
 
 def block_pools(req):
@@ -254,7 +273,7 @@ def block_pools(req):
     for pool in pools:
         vg_name, tp_name = get_vg_lv(pool)
         if not tp_name:
-            vg = bd.lvm.vginfo(vg_name)
+            vg = bounded(bd.lvm.vginfo, vg_name)
             results.append(
                 dict(
                     name=pool,
@@ -263,7 +282,7 @@ def block_pools(req):
                     type='block',
                     uuid=vg.uuid))
         else:
-            thinp = bd.lvm.lvinfo(vg_name, tp_name)
+            thinp = bounded(bd.lvm.lvinfo, vg_name, tp_name)
             results.append(
                 dict(
                     name=pool,
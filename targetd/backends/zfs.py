@@ -17,10 +17,10 @@
 import distutils.spawn
 import logging
 import re
-import subprocess
-from time import time, sleep
+from time import time
 
 from targetd.main import TargetdError
+from targetd.utils import execute, prefixed, sleep
 
 pools = []
 pools_fs = dict()
@@ -110,20 +110,38 @@ def get_dev_path(pool_name, vol_name):
     return "/dev/%s/%s" % (pool2dev_name(pool_name), vol_name)
 
 
-def initialize(config_dict, init_pools):
-    global pools
-    global zfs_enable_copy
-    zfs_enable_copy = zfs_enable_copy or config_dict['zfs_enable_copy']
-    check_pools_access(init_pools)
-    pools = init_pools
+def configure(config_dict, init_pools):
+    """
+    Check the block pools of init_pools we don't use yet and return a
+    function switching over to init_pools.
+    """
+    check_pools_access([p for p in init_pools if p not in pools], init_pools)
+
+    def commit():
+        global pools
+        global zfs_enable_copy
+        zfs_enable_copy = config_dict['zfs_enable_copy']
+        pools = list(init_pools)
+
+    return commit
+
+
+def fs_configure(config_dict, init_pools):
+    """
+    Same as configure() for the fs pools.
+    """
+    new_pools_fs = {fs['mount']: fs['device'] for fs in init_pools}
+    devices = list(new_pools_fs.values())
+    check_pools_access([d for d in devices if d not in pools_fs.values()],
+                       devices)
 
+    def commit():
+        global pools_fs
+        global zfs_enable_copy
+        zfs_enable_copy = config_dict['zfs_enable_copy']
+        pools_fs = new_pools_fs
 
-def fs_initialize(config_dict, init_pools):
-    global pools_fs
-    global zfs_enable_copy
-    zfs_enable_copy = zfs_enable_copy or config_dict['zfs_enable_copy']
-    pools_fs = {fs['mount']: fs['device'] for fs in init_pools}
-    check_pools_access(list(pools_fs.values()))
+    return commit
 
 
 def _check_dataset_name(name):
@@ -151,21 +169,22 @@ def _zfs_exec_command(args=None):
     if args is None:
         args = []
 
-    for _ in range(3):
-        proc = subprocess.Popen([zfs_cmd] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (out, err) = proc.communicate()
-        if proc.returncode != 0:
+    # Commands and the waits between retries give up at the deadline of
+    # the call, see utils.call_context()
+    for attempt in range(3):
+        returncode, out, err = execute([zfs_cmd] + args, attempt)
+        if returncode != 0:
             logging.debug("zfs command returned non-zero status: %s, %s. Stderr: %s. Stdout: %s"
-                          % (proc.returncode, args, out, err))
+                          % (returncode, args, out, err))
             # See: https://github.com/openzfs/zfs/issues/1810
             if b"dataset is busy" in err:
                 sleep(1)
                 logging.debug("Retrying on 'dataset is busy' error ...")
                 continue
             else:
-                return proc.returncode, out, err
+                return returncode, out, err
         else:
-            return proc.returncode, out, err
+            return returncode, out, err
 
 
 
@@ -192,8 +211,15 @@ def _zfs_get(datasets, properties, recursive=False, fstype="all"):
     return result
 
 
-def check_pools_access(check_pools):
-    if any([s.startswith(i + "/") for s in check_pools for i in check_pools]):
+def check_pools_access(check_pools, all_pools=None):
+    """
+    Make sure check_pools exist, and that they can be used along with
+    all_pools (defaults to check_pools).
+    """
+    if all_pools is None:
+        all_pools = check_pools
+
+    if any([s.startswith(i + "/") for s in all_pools for i in all_pools]):
         raise TargetdError(
             TargetdError.INVALID,
             "ZFS pools cannot contain both parent and child datasets")
@@ -241,28 +267,33 @@ def block_pools(req):
     return results
 
 
-def volumes(req, pool):
+def volumes(req, pool, name_prefix=None):
     if not zfs_cmd:
         return []
     allprops = _zfs_get([pool], ["volsize", "guid"], True, "volume")
     results = []
     for fullname, props in allprops.items():
+        name = fullname.replace(pool + "/", "", 1)
+        if not prefixed(name, name_prefix):
+            continue
         results.append(
             dict(
-                name=fullname.replace(pool + "/", "", 1),
+                name=name,
                 size=int(props["volsize"]),
                 uuid=props["guid"]
             ))
     return results
 
 
-def fs_hash():
+def fs_hash(pool_name=None, name_prefix=None):
     if not zfs_cmd:
         return {}
 
     fs_list = {}
 
     for pool, zfs_pool in pools_fs.items():
+        if pool_name is not None and pool != pool_name:
+            continue
         allprops = _zfs_get([zfs_pool], ["name","mountpoint","guid","used","available"], True, "filesystem")
 
         for fullname, props in allprops.items():
@@ -270,6 +301,8 @@ def fs_hash():
                 continue
 
             sub_vol = fullname.replace(zfs_pool + "/", "", 1)
+            if not prefixed(sub_vol, name_prefix):
+                continue
 
             key = props["name"]
             fs_list[key] = dict(
@@ -381,7 +414,7 @@ def _copy(req, pool, vol_orig, vol_new, info_fn, snap=None):
                            "Could not create clone of %s@%s on pool %s" % (vol_orig, snap, pool))
 
 
-def ss(req, pool, name):
+def ss(req, pool, name, name_prefix=None):
     snapshots = []
 
     zfs_pool = pools_fs[pool]
@@ -396,8 +429,11 @@ def ss(req, pool, name):
             logging.warning("found additional subvolumes with snapshots while trying to list snapshots. Please do not"
                             " create subvolumes underneath targetd managed subvolumes")
             continue
+        ss_name = props['name'].replace((zfs_pool + "/" + name + "@"), "", 1)
+        if not prefixed(ss_name, name_prefix):
+            continue
         time_epoch = int(props['creation'])
-        st = dict(name=props['name'].replace((zfs_pool + "/" + name + "@"), "", 1), uuid=props['guid'], timestamp=time_epoch)
+        st = dict(name=ss_name, uuid=props['guid'], timestamp=time_epoch)
         snapshots.append(st)
 
     return snapshots
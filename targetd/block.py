@@ -13,15 +13,22 @@
 #
 # Copyright 2012-2013, Andy Grover <agrover@redhat.com>
 #
-# Routines to export block devices over iscsi.
+# Routines to export block devices over iscsi.  Only imported (along with
+# rtslib) once a block pool is configured or one of the methods is called,
+# see main.configure_block().  main.BLOCK_METHODS lists those of methods().
+
+import logging as log
+import time
 
 from rtslib_fb import (Target, TPG, NodeACL, FabricModule, BlockStorageObject,
                        RTSRoot, NetworkPortal, LUN, MappedLUN, RTSLibError,
                        RTSLibNotInCFS, NodeACLGroup)
 
-from targetd.backends import lvm, zfs
+from targetd.jobs import long_running
 from targetd.main import TargetdError
-from targetd.utils import ignored, name_check
+from targetd.utils import (ignored, name_check, defer, locks, pool_lock,
+                           import_backend, paginate, prefixed,
+                           read_only)
 
 # Handle changes in rtslib_fb for the constant expressing maximum LUN number
 # https://github.com/open-iscsi/rtslib-fb/commit/20a50d9967464add8d33f723f6849a197dbe0c52
@@ -32,22 +39,88 @@ except AttributeError:
     MAX_LUN = 256
 
 
+def _save_config():
+    RTSRoot().save_to_file()
+
+
 def set_portal_addresses(tpg):
     for a in addresses:
         NetworkPortal(tpg, a)
 
 
+# Lock key of the LIO iSCSI target, see utils.locks()
+LIO = 'lio'
+
 pools = {
     "zfs": [],
     "lvm": []
 }
-pool_modules = {
-    "zfs": zfs,
-    "lvm": lvm
-}
+# Backends with pools configured, see configure()
+pool_modules = {}
 target_name = ""
 addresses = []
 
+# Pool name to its VolumeIndex, and seconds one is used before the pool is
+# listed again, see _index()
+indexes = {}
+index_ttl = 60
+
+
+class VolumeIndex(object):
+    """
+    The volumes of a pool by name, as listed by its backend.  The changes
+    made by targetd keep it current, it is only listed again once it is
+    index_ttl seconds old to pick up changes made behind our back.  Only
+    used holding the pool's lock.
+    """
+
+    def __init__(self, volumes):
+        self.volumes = dict((v['name'], v) for v in volumes)
+        self.listed = time.monotonic()
+
+    def add(self, name, info):
+        # info is what the backend's vol_info() returns
+        self.volumes[name] = dict(name=name, size=info.size, uuid=info.uuid)
+
+    def remove(self, name):
+        self.volumes.pop(name, None)
+
+
+def _index(req, pool):
+    """
+    Return the VolumeIndex of pool, listing it if needed.
+    """
+    index = indexes.get(pool)
+    if index is None or time.monotonic() - index.listed > index_ttl:
+        index = indexes[pool] = VolumeIndex(
+            pool_module(pool).volumes(req, pool))
+    return index
+
+
+def _forget(pool):
+    """
+    Drop the index of pool after a change which failed half way, it is
+    listed again when next needed.
+    """
+    indexes.pop(pool, None)
+
+
+def _indexed(req, pool, name, mod=None):
+    """
+    Bring the index of pool up to date with volume name, just made (by
+    module mod) or destroyed.  That is done whatever happens here, so if
+    the index can't be updated it is dropped instead of failing the call.
+    """
+    try:
+        if mod is None:
+            _index(req, pool).remove(name)
+        else:
+            _index(req, pool).add(name, mod.vol_info(pool, name))
+    except Exception as e:
+        log.warning("Dropping the volume index of %s, updating it with %s "
+                    "failed: %s" % (pool, name, e))
+        _forget(pool)
+
 
 def pool_module(pool_name):
     for modname, mod in pool_modules.items():
@@ -73,28 +146,7 @@ def so_name_module(so_name):
                        "Pool not found by storage object (%s)" % so_name)
 
 
-#
-# config_dict must include block_pools and target_name or we blow up
-#
-def initialize(config_dict):
-    global pools
-    pools["lvm"] = list(config_dict['block_pools'])
-    pools["zfs"] = list(config_dict['zfs_block_pools'])
-
-    global target_name
-    target_name = config_dict['target_name']
-
-    global addresses
-    addresses = config_dict['portal_addresses']
-
-    if any(i in pools['zfs'] for i in pools['lvm']):
-        raise TargetdError(TargetdError.INVALID,
-                           "Conflicting names in zfs_block_pools and block_pools in config.")
-
-    # initialize and check both pools
-    for modname, mod in pool_modules.items():
-        mod.initialize(config_dict, pools[modname])
-
+def methods():
     return dict(
         vol_list=volumes,
         vol_create=create,
@@ -116,17 +168,66 @@ def initialize(config_dict):
     )
 
 
-def volumes(req, pool):
-    return pool_module(pool).volumes(req, pool)
+#
+# config_dict must include block_pools and target_name or we blow up
+#
+def configure(config_dict):
+    """
+    Check the pools of config_dict, only probing the ones not in use yet,
+    and return a function switching over to config_dict.  Nothing changes
+    until it is called, so a bad pool leaves the current ones alone.
+    """
+    new_pools = {
+        "zfs": list(config_dict['zfs_block_pools']),
+        "lvm": list(config_dict['block_pools']),
+    }
+
+    if any(i in new_pools['zfs'] for i in new_pools['lvm']):
+        raise TargetdError(TargetdError.INVALID,
+                           "Conflicting names in zfs_block_pools and block_pools in config.")
+
+    # A backend is loaded once it has pools, and kept
+    modules = {modname: import_backend(modname)
+               for modname, names in new_pools.items()
+               if names or modname in pool_modules}
+
+    # check both kinds of pools
+    commits = [mod.configure(config_dict, new_pools[modname])
+               for modname, mod in modules.items()]
+
+    def commit():
+        global pools
+        global pool_modules
+        global target_name
+        global addresses
+        global index_ttl
+        for c in commits:
+            c()
+        pools = new_pools
+        pool_modules = modules
+        target_name = config_dict['target_name']
+        addresses = config_dict['portal_addresses']
+        index_ttl = config_dict['volume_index_ttl']
+        indexes.clear()
+
+    return commit
+
+
+@read_only
+@locks(pool_lock())
+def volumes(req, pool, name_prefix=None, limit=None, cursor=None):
+    vols = pool_module(pool).volumes(req, pool, name_prefix)
+    if name_prefix is None:
+        # Listed anyway, refresh the index with it
+        indexes[pool] = VolumeIndex(vols)
+    return paginate(vols, lambda v: (v['name'],), limit, cursor)
 
 
 def check_vol_exists(req, pool, name):
-    mod = pool_module(pool)
-    if any(v['name'] == name for v in mod.volumes(req, pool)):
-        return True
-    return False
+    return name in _index(req, pool).volumes
 
 
+@locks(pool_lock())
 def create(req, pool, name, size):
     mod = pool_module(pool)
     # Check to ensure that we don't have a volume with this name already,
@@ -134,13 +235,20 @@ def create(req, pool, name, size):
     if check_vol_exists(req, pool, name):
         raise TargetdError(TargetdError.NAME_CONFLICT,
                            "Volume with that name exists")
-    mod.create(req, pool, name, size)
+    try:
+        mod.create(req, pool, name, size)
+    except Exception:
+        _forget(pool)
+        raise
+    _indexed(req, pool, name, mod)
 
 
 def get_so_name(pool, volname):
     return pool_module(pool).get_so_name(pool, volname)
 
 
+@long_running
+@locks(pool_lock(), LIO)
 def destroy(req, pool, name):
     mod = pool_module(pool)
     if not check_vol_exists(req, pool, name):
@@ -159,43 +267,85 @@ def destroy(req, pool, name):
                                "Volume '%s' cannot be "
                                "removed while exported" % name)
 
-    mod.destroy(req, pool, name)
+    try:
+        mod.destroy(req, pool, name)
+    except Exception:
+        _forget(pool)
+        raise
+    _indexed(req, pool, name)
 
 
+@long_running
+@locks(pool_lock())
 def copy(req, pool, vol_orig, vol_new, timeout=10):
     mod = pool_module(pool)
     if not check_vol_exists(req, pool, vol_orig):
         raise TargetdError(TargetdError.NOT_FOUND_VOLUME,
                            "Volume %s not found in pool %s" % (vol_orig, pool))
-    mod.copy(req, pool, vol_orig, vol_new, timeout)
+    if check_vol_exists(req, pool, vol_new):
+        raise TargetdError(TargetdError.NAME_CONFLICT,
+                           "Volume with that name exists")
+    try:
+        mod.copy(req, pool, vol_orig, vol_new, timeout)
+    except Exception:
+        _forget(pool)
+        raise
+    _indexed(req, pool, vol_new, mod)
 
 
-def export_list(req):
+@read_only
+@locks(LIO)
+def export_list(req, pool=None, initiator_wwn=None, name_prefix=None,
+                limit=None, cursor=None):
     try:
         fm = FabricModule('iscsi')
         t = Target(fm, target_name, mode='lookup')
         tpg = TPG(t, 1, mode='lookup')
     except RTSLibNotInCFS:
-        return []
+        return paginate([], None, limit, cursor)
 
-    exports = []
+    exports = _mapped_luns(tpg, pool, initiator_wwn, name_prefix)
+    if limit is None and cursor is None:
+        # Streamed to the client as the volumes are looked up
+        return (_vol_info(e) for e in exports)
+    return paginate(list(exports),
+                    lambda e: (e['initiator_wwn'], e['lun']),
+                    limit, cursor, _vol_info)
+
+
+def _mapped_luns(tpg, pool, initiator_wwn, name_prefix):
+    """
+    Generate the exports of tpg, filtered on what LIO tells us.  Their
+    volumes are looked up in their pool by _vol_info(), once we know which
+    are returned.
+    """
     for na in tpg.node_acls:
+        if initiator_wwn is not None and na.node_wwn != initiator_wwn:
+            continue
         for mlun in na.mapped_luns:
             mod = udev_path_module(mlun.tpg_lun.storage_object.udev_path)
             mlun_pool, mlun_name = \
                 mod.split_udev_path(mlun.tpg_lun.storage_object.udev_path)
-            vinfo = mod.vol_info(mod.dev2pool_name(mlun_pool), mlun_name)
-            exports.append(
-                dict(
-                    initiator_wwn=na.node_wwn,
-                    lun=mlun.mapped_lun,
-                    vol_name=mlun_name,
-                    pool=mod.dev2pool_name(mlun_pool),
-                    vol_uuid=vinfo.uuid,
-                    vol_size=vinfo.size))
-    return exports
-
-
+            pool_name = mod.dev2pool_name(mlun_pool)
+            if (pool is not None and pool_name != pool) or \
+                    not prefixed(mlun_name, name_prefix):
+                continue
+            yield dict(
+                initiator_wwn=na.node_wwn,
+                lun=mlun.mapped_lun,
+                vol_name=mlun_name,
+                pool=pool_name,
+                mod=mod)
+
+
+def _vol_info(export):
+    mod = export.pop('mod')
+    vinfo = mod.vol_info(export['pool'], export['vol_name'])
+    export.update(vol_uuid=vinfo.uuid, vol_size=vinfo.size)
+    return export
+
+
+@locks(pool_lock(), LIO)
 def export_create(req, pool, vol, initiator_wwn, lun):
     fm = FabricModule('iscsi')
     t = Target(fm, target_name)
@@ -216,9 +366,10 @@ def export_create(req, pool, vol, initiator_wwn, lun):
     else:
         MappedLUN(na, lun, tpg_lun)
 
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
+@locks(LIO)
 def export_destroy(req, pool, vol, initiator_wwn):
     mod = pool_module(pool)
     fm = FabricModule('iscsi')
@@ -256,9 +407,10 @@ def export_destroy(req, pool, vol, initiator_wwn):
             if not any(t.tpgs):
                 t.delete()
 
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
+@locks(LIO)
 def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user,
                        out_pass):
     fm = FabricModule('iscsi')
@@ -279,7 +431,7 @@ def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user,
     na.chap_mutual_userid = out_user
     na.chap_mutual_password = out_pass
 
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
 def block_pools(req):
@@ -297,7 +449,10 @@ def _get_iscsi_tpg():
     return TPG(target, 1)
 
 
-def initiator_list(req, standalone_only=False):
+@read_only
+@locks(LIO)
+def initiator_list(req, standalone_only=False, name_prefix=None, limit=None,
+                   cursor=None):
     """Return a list of initiator
 
     Iterate all iSCSI rtslib-fb.NodeACL via rtslib-fb.TPG.node_acls().
@@ -306,6 +461,10 @@ def initiator_list(req, standalone_only=False):
         standalone_only (bool):
             When standalone_only is True, only return initiator which is not
             in any NodeACLGroup (NodeACL.tag is None).
+        name_prefix (str):
+            Only return initiators whose init_id starts with it.
+        limit (int), cursor (str):
+            Return one page, see utils.paginate().
     Returns:
         [
             {
@@ -324,15 +483,18 @@ def initiator_list(req, standalone_only=False):
         if _standalone_only and node_acl.tag is not None:
             return False
         else:
-            return True
+            return prefixed(node_acl.node_wwn, name_prefix)
 
-    return list({
-                    'init_id': node_acl.node_wwn,
-                    'init_type': 'iscsi'
-                } for node_acl in _get_iscsi_tpg().node_acls
-                if _condition(node_acl, standalone_only))
+    return paginate(list({
+                             'init_id': node_acl.node_wwn,
+                             'init_type': 'iscsi'
+                         } for node_acl in _get_iscsi_tpg().node_acls
+                         if _condition(node_acl, standalone_only)),
+                    lambda i: (i['init_id'],), limit, cursor)
 
 
+@read_only
+@locks(LIO)
 def access_group_list(req):
     """Return a list of access group
 
@@ -359,6 +521,7 @@ def access_group_list(req):
                 } for node_acl_group in _get_iscsi_tpg().node_acl_groups)
 
 
+@locks(LIO)
 def access_group_create(req, ag_name, init_id, init_type):
     if init_type != 'iscsi':
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
@@ -382,14 +545,16 @@ def access_group_create(req, ag_name, init_id, init_type):
 
     node_acl_group = NodeACLGroup(tpg, ag_name)
     node_acl_group.add_acl(init_id)
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
+@locks(LIO)
 def access_group_destroy(req, ag_name):
     NodeACLGroup(_get_iscsi_tpg(), ag_name).delete()
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
+@locks(LIO)
 def access_group_init_add(req, ag_name, init_id, init_type):
     if init_type != 'iscsi':
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
@@ -414,9 +579,10 @@ def access_group_init_add(req, ag_name, init_id, init_type):
                                "Requested init_id is in use")
 
     NodeACLGroup(tpg, ag_name).add_acl(init_id)
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
+@locks(LIO)
 def access_group_init_del(req, ag_name, init_id, init_type):
     if init_type != 'iscsi':
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
@@ -429,10 +595,13 @@ def access_group_init_del(req, ag_name, init_id, init_type):
         return
 
     NodeACLGroup(tpg, ag_name).remove_acl(init_id)
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
-def access_group_map_list(req):
+@read_only
+@locks(LIO)
+def access_group_map_list(req, ag_name=None, pool_name=None, name_prefix=None,
+                          limit=None, cursor=None):
     """
     Return a list of dictionaries in this format:
         {
@@ -441,16 +610,24 @@ def access_group_map_list(req):
             'pool_name': pool_name,
             'vol_name': vol_name,
         }
+    optionally only the ones of access group ag_name, pool pool_name or
+    volumes whose name starts with name_prefix, one page at a time if limit
+    or cursor are given, see utils.paginate().
     """
     results = []
     tpg = _get_iscsi_tpg()
 
     for node_acl_group in tpg.node_acl_groups:
+        if ag_name is not None and node_acl_group.name != ag_name:
+            continue
         for mapped_lun_group in node_acl_group.mapped_lun_groups:
             tpg_lun = mapped_lun_group.tpg_lun
             so_name = tpg_lun.storage_object.name
             mod = so_name_module(so_name)
-            pool_name, vol_name = mod.so_name2pool_volume(so_name)
+            map_pool, vol_name = mod.so_name2pool_volume(so_name)
+            if (pool_name is not None and map_pool != pool_name) or \
+                    not prefixed(vol_name, name_prefix):
+                continue
 
             # When user delete old volume and the created new one with
             # idential name. The mapping status will be kept.
@@ -458,11 +635,12 @@ def access_group_map_list(req):
             results.append({
                 'ag_name': node_acl_group.name,
                 'h_lun_id': mapped_lun_group.mapped_lun,
-                'pool_name': pool_name,
+                'pool_name': map_pool,
                 'vol_name': vol_name,
             })
 
-    return results
+    return paginate(results, lambda m: (m['ag_name'], m['h_lun_id']),
+                    limit, cursor)
 
 
 def _tpg_lun_of(tpg, pool_name, vol_name):
@@ -471,8 +649,13 @@ def _tpg_lun_of(tpg, pool_name, vol_name):
     If not exist, create one.
     """
     mod = pool_module(pool_name)
-    # get wwn of volume so LIO can export as vpd83 info
-    vol_serial = mod.vol_info(pool_name, vol_name).uuid
+    # get wwn of volume so LIO can export as vpd83 info, from the index if
+    # current (our callers hold the pool's lock)
+    index = indexes.get(pool_name)
+    vol = None
+    if index is not None and time.monotonic() - index.listed <= index_ttl:
+        vol = index.volumes.get(vol_name)
+    vol_serial = vol['uuid'] if vol else mod.vol_info(pool_name, vol_name).uuid
 
     # only add new SO if it doesn't exist
     # so.name concats pool & vol names separated by ':'
@@ -497,6 +680,7 @@ def _tpg_lun_of(tpg, pool_name, vol_name):
         return LUN(tpg, storage_object=so)
 
 
+@locks(pool_lock('pool_name'), LIO)
 def access_group_map_create(req, pool_name, vol_name, ag_name, h_lun_id=None):
     tpg = _get_iscsi_tpg()
     tpg.enable = True
@@ -537,9 +721,10 @@ def access_group_map_create(req, pool_name, vol_name, ag_name, h_lun_id=None):
             h_lun_id = free_h_lun_ids.pop()
 
     node_acl_group.mapped_lun_group(h_lun_id, tpg_lun)
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
 
 
+@locks(pool_lock('pool_name'), LIO)
 def access_group_map_destroy(req, pool_name, vol_name, ag_name):
     tpg = _get_iscsi_tpg()
     node_acl_group = NodeACLGroup(tpg, ag_name)
@@ -555,4 +740,4 @@ def access_group_map_destroy(req, pool_name, vol_name, ag_name):
         tpg_lun.delete()
         lun_so.delete()
 
-    RTSRoot().save_to_file()
+    defer(req, _save_config)
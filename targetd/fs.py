@@ -17,11 +17,14 @@
 # fs support using btrfs.
 
 import os
+import time
+from contextlib import contextmanager
 
-from targetd.backends import btrfs, zfs
+from targetd.jobs import long_running
 from targetd.mount import Mount
 from targetd.nfs import Nfs, Export
-from targetd.utils import TargetdError
+from targetd.utils import (TargetdError, import_backend, locks, paginate,
+                           prefixed, read_only)
 
 # Notes:
 #
@@ -40,14 +43,50 @@ from targetd.utils import TargetdError
 #
 # There may be better ways of utilizing btrfs.
 
+# Lock keys, see utils.locks().  Most calls find their filesystem by uuid
+# so all fs pools share one key.
+FS = 'fs'
+NFS = 'nfs:%s' % os.path.join(Nfs.EXPORT_FS_CONFIG_DIR, Nfs.EXPORT_FILE)
+
 pools = {
     "zfs": [],
     "btrfs": []
 }
-pool_modules = {
-    "zfs": zfs,
-    "btrfs": btrfs
-}
+# File systems we have a backend for, imported once a pool needs it
+BACKENDS = ("zfs", "btrfs")
+# Backends with pools configured, see configure()
+pool_modules = {}
+
+# The Catalog of the file systems, and seconds it is used before they are
+# listed again, see _lookup()
+catalog = None
+catalog_ttl = 60
+
+
+class Catalog(object):
+    """
+    The file systems of every fs pool by uuid, and by uuid the snapshots of
+    those we had to look into.  targetd's own changes update it.  What it
+    doesn't know yet (a file system just created, ...) is found by listing
+    them again, as is done once it is catalog_ttl seconds old to pick up
+    changes made behind our back.  Only used holding the FS lock.
+    """
+
+    def __init__(self, filesystems):
+        self.filesystems = dict((f['uuid'], f) for f in filesystems)
+        # fs uuid to {snapshot uuid: snapshot}, filled as needed
+        self.snapshots = dict()
+        self.listed = time.monotonic()
+
+    def remove(self, fs_uuid, ss_uuid=None):
+        """
+        Forget a file system, with its snapshots, or one of its snapshots.
+        """
+        if ss_uuid is None:
+            self.filesystems.pop(fs_uuid, None)
+            self.snapshots.pop(fs_uuid, None)
+        else:
+            self.snapshots.get(fs_uuid, {}).pop(ss_uuid, None)
 
 
 def pool_module(pool_name):
@@ -64,12 +103,30 @@ def pool_module(pool_name):
 
 
 def initialize(config_dict):
+    configure(config_dict)()
 
-    global pools
-    global allow_chown
+    return dict(
+        fs_list=fs,
+        fs_destroy=fs_destroy,
+        fs_create=fs_create,
+        fs_clone=fs_clone,
+        ss_list=ss,
+        fs_snapshot=fs_snapshot,
+        fs_snapshot_delete=fs_snapshot_delete,
+        nfs_export_auth_list=nfs_export_auth_list,
+        nfs_export_list=nfs_export_list,
+        nfs_export_add=nfs_export_add,
+        nfs_export_remove=nfs_export_remove,
+        nfs_export_add_many=nfs_export_add_many,
+        nfs_export_remove_many=nfs_export_remove_many,
+    )
 
-    allow_chown = config_dict['allow_chown']
 
+def configure(config_dict):
+    """
+    Check the fs pools of config_dict, only preparing the ones not in use
+    yet, and return a function switching over to config_dict.
+    """
     all_fs_pools = list(config_dict['fs_pools'])
 
     for mount in all_fs_pools:
@@ -77,35 +134,50 @@ def initialize(config_dict):
             raise TargetdError(TargetdError.NOT_FOUND_FS,
                                'The fs_pool {0} does not exist'.format(mount))
 
+    new_pools = {modname: [] for modname in BACKENDS}
     for info in Mount.mounted_filesystems():
         if info[Mount.MOUNT_POINT] in all_fs_pools:
             filesystem = info[Mount.FS_TYPE]
-            if filesystem in pool_modules:
+            if filesystem in BACKENDS:
                 # forward both mountpoint and device to the backend as ZFS prefers its own devices (pool/volume) and
                 # btrfs prefers mount points (/mnt/btrfs). Otherwise ZFS or btrfs needs to ask mounted_filesystems again
-                pools[filesystem].append({"mount": info[Mount.MOUNT_POINT], "device": info[Mount.DEVICE]})
+                new_pools[filesystem].append({"mount": info[Mount.MOUNT_POINT], "device": info[Mount.DEVICE]})
             else:
                 raise TargetdError(TargetdError.NO_SUPPORT,
                                    'Unsupported filesystem {0} for pool {1}'.format(info[2], info[1]))
 
-    for modname, mod in pool_modules.items():
-        mod.fs_initialize(config_dict, pools[modname])
+    # A backend is loaded once it has pools, and kept
+    modules = {modname: import_backend(modname)
+               for modname, mounts in new_pools.items()
+               if mounts or modname in pool_modules}
 
-    return dict(
-        fs_list=fs,
-        fs_destroy=fs_destroy,
-        fs_create=fs_create,
-        fs_clone=fs_clone,
-        ss_list=ss,
-        fs_snapshot=fs_snapshot,
-        fs_snapshot_delete=fs_snapshot_delete,
-        nfs_export_auth_list=nfs_export_auth_list,
-        nfs_export_list=nfs_export_list,
-        nfs_export_add=nfs_export_add,
-        nfs_export_remove=nfs_export_remove,
-    )
+    commits = [mod.fs_configure(config_dict, new_pools[modname])
+               for modname, mod in modules.items()]
+
+    def commit():
+        global pools
+        global pool_modules
+        global allow_chown
+        global catalog
+        global catalog_ttl
+        for c in commits:
+            c()
+        if _mounts(new_pools) != _mounts(pools):
+            # Only then does reload_config() hold the FS lock
+            catalog = None
+        pools = new_pools
+        pool_modules = modules
+        allow_chown = config_dict['allow_chown']
+        catalog_ttl = config_dict['fs_catalog_ttl']
+
+    return commit
+
+
+def _mounts(fs_pools):
+    return set(p['mount'] for mounts in fs_pools.values() for p in mounts)
 
 
+@locks(FS)
 def fs_create(req, pool_name, name, size_bytes):
     """
     Create a filesystem inside a given pool with a given name
@@ -117,6 +189,7 @@ def fs_create(req, pool_name, name, size_bytes):
     pool_module(pool_name).fs_create(req, pool_name, name, size_bytes)
 
 
+@locks(FS)
 def fs_snapshot(req, fs_uuid, dest_ss_name):
     """
     Create a snapshot from the filesystem described by the given uuid
@@ -129,18 +202,25 @@ def fs_snapshot(req, fs_uuid, dest_ss_name):
     pool_module(fs_ht['pool']).fs_snapshot(req, fs_ht['pool'], fs_ht['name'], dest_ss_name)
 
 
+@locks(FS)
 def fs_snapshot_delete(req, fs_uuid, ss_uuid):
     fs_ht = _get_fs_by_uuid(req, fs_uuid)
     snapshot = _get_ss_by_uuid(req, fs_uuid, ss_uuid, fs_ht)
-    pool_module(fs_ht['pool']).fs_snapshot_delete(req, fs_ht['pool'], fs_ht['name'], snapshot['name'])
+    with _changing():
+        pool_module(fs_ht['pool']).fs_snapshot_delete(req, fs_ht['pool'], fs_ht['name'], snapshot['name'])
+    catalog.remove(fs_uuid, ss_uuid)
 
 
+@long_running
+@locks(FS)
 def fs_destroy(req, uuid):
     # Check to see if this file system has any read-only snapshots, if yes then
     # delete.  The API requires a FS to list its RO copies, we may want to
     # reconsider this decision.
     fs_ht = _get_fs_by_uuid(req, uuid)
-    pool_module(fs_ht['pool']).fs_destroy(req, fs_ht['pool'], fs_ht['name'])
+    with _changing():
+        pool_module(fs_ht['pool']).fs_destroy(req, fs_ht['pool'], fs_ht['name'])
+    catalog.remove(uuid)
 
 
 def fs_pools(req):
@@ -152,43 +232,106 @@ def fs_pools(req):
     return results
 
 
-def _fs_hash():
-    fs_list = {}
-
+def _fs_iter(pool=None, name_prefix=None):
+    # One backend at a time, so the first ones are sent while the later
+    # ones are listed
     for mod in pool_modules.values():
-        fs_list.update(mod.fs_hash())
-
-    return fs_list
-
+        yield from mod.fs_hash(pool, name_prefix).values()
 
-def fs(req):
-    return list(_fs_hash().values())
 
-
-def ss(req, fs_uuid, fs_cache=None):
+def _cataloged(filesystems):
+    """
+    Pass on a listing of every file system, which becomes the catalog once
+    it is complete.
+    """
+    global catalog
+    listed = []
+    for f in filesystems:
+        listed.append(f)
+        yield f
+    catalog = Catalog(listed)
+
+
+@read_only
+@locks(FS)
+def fs(req, pool=None, name_prefix=None, limit=None, cursor=None):
+    filesystems = _fs_iter(pool, name_prefix)
+    if pool is None and name_prefix is None:
+        filesystems = _cataloged(filesystems)
+    if limit is None and cursor is None:
+        return filesystems
+    return paginate(list(filesystems),
+                    lambda f: (f['pool'], f['name']), limit, cursor)
+
+
+@read_only
+@locks(FS)
+def ss(req, fs_uuid, fs_cache=None, name_prefix=None, limit=None,
+       cursor=None):
     if fs_cache is None:
         fs_cache = _get_fs_by_uuid(req, fs_uuid)
 
-    return pool_module(fs_cache['pool']).ss(req, fs_cache['pool'], fs_cache['name'])
+    snapshots = pool_module(fs_cache['pool']).ss(
+        req, fs_cache['pool'], fs_cache['name'], name_prefix)
+    if name_prefix is None and catalog is not None:
+        catalog.snapshots[fs_uuid] = dict((s['uuid'], s) for s in snapshots)
+    return paginate(snapshots, lambda s: (s['name'],), limit, cursor)
+
+
+def _lookup(find):
+    """
+    Return find(catalog), listing the file systems again first if the
+    catalog is too old, or after if find() returns None.
+    """
+    global catalog
+    if catalog is None or time.monotonic() - catalog.listed > catalog_ttl:
+        catalog = Catalog(_fs_iter())
+        return find(catalog)
+    found = find(catalog)
+    if found is None:
+        catalog = Catalog(_fs_iter())
+        found = find(catalog)
+    return found
+
+
+@contextmanager
+def _changing():
+    """
+    Drop the catalog if the change made in the body fails, it may have been
+    half done.
+    """
+    global catalog
+    try:
+        yield
+    except Exception:
+        catalog = None
+        raise
 
 
 def _get_fs_by_uuid(req, fs_uuid):
-    for f in fs(req):
-        if f['uuid'] == fs_uuid:
-            return f
-    raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
+    f = _lookup(lambda c: c.filesystems.get(fs_uuid))
+    if f is None:
+        raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
+    return f
 
 
 def _get_ss_by_uuid(req, fs_uuid, ss_uuid, fs_ht=None):
     if fs_ht is None:
         fs_ht = _get_fs_by_uuid(req, fs_uuid)
 
-    for s in ss(req, fs_uuid, fs_ht):
-        if s['uuid'] == ss_uuid:
-            return s
-    raise TargetdError(TargetdError.NOT_FOUND_SS, "snapshot not found")
+    snapshots = catalog.snapshots.get(fs_uuid, {})
+    if ss_uuid not in snapshots:
+        # Not looked into yet, or taken since
+        snapshots = catalog.snapshots[fs_uuid] = dict(
+            (s['uuid'], s) for s in pool_module(fs_ht['pool']).ss(
+                req, fs_ht['pool'], fs_ht['name']))
+    if ss_uuid not in snapshots:
+        raise TargetdError(TargetdError.NOT_FOUND_SS, "snapshot not found")
+    return snapshots[ss_uuid]
 
 
+@long_running
+@locks(FS)
 def fs_clone(req, fs_uuid, dest_fs_name, snapshot_id):
     fs_ht = _get_fs_by_uuid(req, fs_uuid)
     if snapshot_id:
@@ -197,33 +340,38 @@ def fs_clone(req, fs_uuid, dest_fs_name, snapshot_id):
     else:
         source = None
 
-    pool_module(fs_ht['pool']).fs_clone(req, fs_ht['pool'], fs_ht['name'], dest_fs_name, source)
+    # The clone is cataloged when first looked up
+    with _changing():
+        pool_module(fs_ht['pool']).fs_clone(req, fs_ht['pool'], fs_ht['name'], dest_fs_name, source)
 
 
+@read_only
+@locks()
 def nfs_export_auth_list(req):
     return Nfs.security_options()
 
 
-def nfs_export_list(req):
-    rc = []
-    exports = Nfs.exports()
-    for e in exports:
-        rc.append(dict(host=e.host, path=e.path, options=e.options_list()))
-    return rc
-
+@read_only
+@locks(NFS)
+def nfs_export_list(req, host=None, path_prefix=None, limit=None, cursor=None):
+    exports = [e for e in Nfs.exports()
+               if (host is None or e.host == host) and
+               prefixed(e.path, path_prefix)]
+    return paginate(exports, lambda e: (e.path, e.host), limit, cursor,
+                    lambda e: dict(host=e.host, path=e.path,
+                                   options=e.options_list()))
 
-def nfs_export_add(req, host, path, options=None, chown=None, export_path=None):
 
+def _export_options(options):
+    """
+    Return the bit wise and key=value options of a list of export options.
+    """
     if not isinstance(options, list):
         if options is not None and len(options) > 0:
             options = [options]
         else:
             options = []
 
-    if export_path is not None:
-        raise TargetdError(TargetdError.NFS_NO_SUPPORT,
-                           "separate export path not supported at "
-                           "this time")
     bit_opt = 0
     key_opt = {}
 
@@ -233,20 +381,38 @@ def nfs_export_add(req, host, path, options=None, chown=None, export_path=None):
             key_opt[k] = v
         else:
             bit_opt |= Export.bool_option[o]
+    return bit_opt, key_opt
+
+
+def _chown_ids(chown):
+    """
+    Return the uid and gid (-1 if not given) of a chown specification.
+    """
+    if not allow_chown:
+        raise TargetdError(TargetdError.NO_SUPPORT, "Chown is disabled. Consult manual before enabling it.")
+    items = chown.split(':')
+    try:
+        uid = int(items[0])
+        gid = -1
+        if len(items) > 1:
+            gid = int(items[1])
+        return uid, gid
+    except ValueError as e:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "Wrong chown arguments: {}".format(e))
+
+
+@locks(NFS)
+def nfs_export_add(req, host, path, options=None, chown=None, export_path=None):
+
+    if export_path is not None:
+        raise TargetdError(TargetdError.NFS_NO_SUPPORT,
+                           "separate export path not supported at "
+                           "this time")
+    bit_opt, key_opt = _export_options(options)
 
     if chown is not None:
-        if not allow_chown:
-            raise TargetdError(TargetdError.NO_SUPPORT, "Chown is disabled. Consult manual before enabling it.")
-        items = chown.split(':')
-        try:
-            uid = int(items[0])
-            gid = -1
-            if len(items) > 1:
-                gid = int(items[1])
-            os.chown(path, uid, gid)
-        except ValueError as e:
-            raise TargetdError(TargetdError.INVALID_ARGUMENT,
-                               "Wrong chown arguments: {}".format(e))
+        os.chown(path, *_chown_ids(chown))
     try:
         Nfs.export_add(host, path, bit_opt, key_opt)
     except ValueError as e:
@@ -254,6 +420,83 @@ def nfs_export_add(req, host, path, options=None, chown=None, export_path=None):
     return dict(host=host, path=path)
 
 
+def _export_entries(entries, fields):
+    """
+    Check the entries of a *_many call are objects with a host and a path
+    and only the other fields given, returning them.
+    """
+    if not isinstance(entries, list):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "exports must be an array")
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or \
+                not isinstance(entry.get('host'), str) or \
+                not isinstance(entry.get('path'), str) or \
+                not set(entry).issubset(('host', 'path') + fields):
+            raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                               "exports[%d] must be an object with host and "
+                               "path and optionally %s" %
+                               (i, ", ".join(fields) or "nothing else"))
+    return entries
+
+
+def _not_main_exports(keys):
+    main_exports = Nfs.main_exports()
+    for path, host in keys:
+        if (path, host) in main_exports:
+            raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                               "%s:%s is exported in %s" %
+                               (host, path, Nfs.MAIN_EXPORT_FILE))
+
+
+@locks(NFS)
+def nfs_export_add_many(req, exports):
+    """
+    nfs_export_add for many exports at once.  All of them are checked
+    before any is added, then targetd.exports is written once and applied
+    with a single exportfs -r.
+    """
+    adding = []
+    chowns = []
+    for i, entry in enumerate(_export_entries(exports, ('options', 'chown'))):
+        try:
+            bit_opt, key_opt = _export_options(entry.get('options'))
+            export = Export(entry['host'], entry['path'], bit_opt, key_opt)
+        except (KeyError, ValueError) as e:
+            raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                               "exports[%d]: invalid option %s" % (i, e))
+        adding.append(export)
+        if entry.get('chown') is not None:
+            chowns.append((entry['path'], _chown_ids(entry['chown'])))
+    _not_main_exports([e.key() for e in adding])
+
+    for path, ids in chowns:
+        os.chown(path, *ids)
+    existed = Nfs.export_update(add=adding)
+    return [dict(host=e.host, path=e.path,
+                 status='updated' if e.key() in existed else 'added')
+            for e in adding]
+
+
+@locks(NFS)
+def nfs_export_remove_many(req, exports):
+    """
+    nfs_export_remove for many exports at once, with one write of
+    targetd.exports and a single exportfs -r.  Exports which aren't there
+    are reported as not_found instead of failing the call.
+    """
+    keys = [Export(e['host'], e['path']).key()
+            for e in _export_entries(exports, ())]
+    _not_main_exports(keys)
+
+    existed = Nfs.export_update(remove=keys)
+    return [dict(host=host, path=path,
+                 status='removed' if (path, host) in existed
+                 else 'not_found')
+            for path, host in keys]
+
+
+@locks(NFS)
 def nfs_export_remove(req, host, path):
     found = False
 
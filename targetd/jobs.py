@@ -0,0 +1,208 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Long running calls (vol_copy, fs_clone, ...) made with async_job=true run
+# here, on a pool of their own, and the client gets a job id to follow them
+# with job_status, job_wait and job_cancel.
+
+import logging as log
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+
+from targetd.utils import TargetdError, call_context, unlocked
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+manager = None
+
+
+class Job(object):
+
+    def __init__(self, method):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        # Set once the job has finished, one way or the other
+        self.done = Event()
+        # Set by job_cancel, stops the commands of a running job
+        self.cancel = Event()
+
+    def status(self):
+        rc = dict(job_id=self.id, method=self.method, status=self.state,
+                  created=self.created, started=self.started,
+                  finished=self.finished)
+        if self.state == DONE:
+            rc['result'] = self.result
+        elif self.error is not None:
+            rc['error'] = self.error
+        return rc
+
+
+class JobManager(object):
+    """
+    Runs jobs on workers threads and keeps up to max_jobs of them, finished
+    ones for ttl seconds, or until room is needed for new ones.
+    """
+
+    def __init__(self, workers, max_jobs, ttl):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="targetd-job")
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.lock = Lock()
+        # job id to Job, in the order they were submitted
+        self.jobs = dict()
+
+    def _expire(self, make_room=False):
+        # Called with lock held
+        now = time.time()
+        finished = [j for j in self.jobs.values() if j.done.is_set()]
+        for j in finished:
+            if now - j.finished > self.ttl or \
+                    (make_room and len(self.jobs) >= self.max_jobs):
+                del self.jobs[j.id]
+
+    def submit(self, method, fn):
+        """
+        Run fn() as a job, returning its id.
+        """
+        job = Job(method)
+        with self.lock:
+            self._expire(make_room=True)
+            if len(self.jobs) >= self.max_jobs:
+                raise TargetdError(TargetdError.JOB_LIMIT,
+                                   "Too many unfinished jobs (%d)" %
+                                   self.max_jobs)
+            self.jobs[job.id] = job
+            job.future = self.executor.submit(self._run, job, fn)
+        return job.id
+
+    def _run(self, job, fn):
+        with self.lock:
+            if job.state == CANCELLED:
+                return
+            job.state = RUNNING
+            job.started = time.time()
+        try:
+            with call_context(cancel=job.cancel):
+                result = fn()
+            state, error = DONE, None
+        except TargetdError as td:
+            state = CANCELLED if td.error == TargetdError.CANCELLED \
+                else FAILED
+            result, error = None, dict(code=td.error, message=str(td))
+        except Exception as e:
+            log.error("job %s (%s) failed: %s" % (job.id, job.method, e))
+            log.debug(traceback.format_exc())
+            result, state = None, FAILED
+            error = dict(code=-1, message="%s: %s" % (type(e).__name__, e))
+        self._finish(job, state, result, error)
+
+    def _finish(self, job, state, result=None, error=None):
+        with self.lock:
+            job.state = state
+            job.result = result
+            job.error = error
+            job.finished = time.time()
+        job.done.set()
+
+    def get(self, job_id):
+        with self.lock:
+            self._expire()
+            try:
+                return self.jobs[job_id]
+            except (KeyError, TypeError):
+                raise TargetdError(TargetdError.NOT_FOUND_JOB,
+                                   "Job %s not found" % job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel the job, returns False if it has finished already.  A running
+        job stops at its next command, see utils.call_context(), unless it
+        finishes first.
+        """
+        job = self.get(job_id)
+        with self.lock:
+            if job.state == RUNNING:
+                job.cancel.set()
+                return True
+            if job.state != QUEUED:
+                return False
+            job.state = CANCELLED
+        job.future.cancel()
+        self._finish(job, CANCELLED)
+        return True
+
+    def stats(self):
+        with self.lock:
+            rc = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED, CANCELLED), 0)
+            for j in self.jobs.values():
+                rc[j.state] += 1
+            return rc
+
+
+def initialize(config_dict):
+    global manager
+    manager = JobManager(config_dict['job_workers'], config_dict['max_jobs'],
+                         config_dict['job_ttl'])
+
+    return dict(
+        job_status=job_status,
+        job_wait=job_wait,
+        job_cancel=job_cancel,
+    )
+
+
+def long_running(fn):
+    """
+    Mark a RPC method as one which may be called with async_job=true.
+    """
+    fn.job = True
+    return fn
+
+
+def submit(method, fn):
+    return manager.submit(method, fn)
+
+
+@unlocked
+def job_status(req, job_id):
+    return manager.get(job_id).status()
+
+
+@unlocked
+def job_wait(req, job_id, timeout=30):
+    job = manager.get(job_id)
+    if not isinstance(timeout, (int, float)) or timeout < 0:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "timeout must be a number of seconds")
+    job.done.wait(timeout)
+    return job.status()
+
+
+@unlocked
+def job_cancel(req, job_id):
+    return manager.cancel(job_id)
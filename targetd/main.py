@@ -17,9 +17,22 @@
 # sharable resources on the local machine, such as the LIO
 # kernel target.
 
+import asyncio
+import email.utils
+import functools
+import http.client
+import io
 import json
 import os
+import queue
+import re
+import select
 import signal
+import socketserver
+import struct
+import threading
+import time
+import types
 
 import setproctitle
 
@@ -32,12 +45,18 @@ import itertools
 import socket
 import base64
 import ssl
-from socketserver import ThreadingMixIn
-import time
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from collections.abc import Iterator
+from contextlib import contextmanager, ExitStack
 import traceback
 import logging as log
-from targetd.utils import TargetdError, Pit, Tar
+from targetd import jobs, metrics
+from targetd.utils import (TargetdError, Pit, Tar, Batch, LockManager,
+                           SingleFlight, Snapshots, call_context,
+                           command_seconds, ignored, library_call_seconds,
+                           lock_keys, locks, read_only, resumed, startup,
+                           traces, unlocked)
 import stat
 
 default_config_path = "/etc/target/targetd.yaml"
@@ -56,41 +75,929 @@ default_config = dict(
     ssl_cert="/etc/target/targetd_cert.pem",
     ssl_key="/etc/target/targetd_key.pem",
     portal_addresses=["0.0.0.0"],
-    allow_chown=False
+    allow_chown=False,
+    # seconds an idle HTTP/1.1 connection is kept open
+    keepalive_timeout=30,
+    # seconds a new TLS connection may take to do its handshake
+    tls_handshake_timeout=10,
+    # requests served on one connection before it is closed
+    keepalive_requests=100,
+    # largest request body accepted, raise it for large batches
+    max_request_size=1024 * 128,
+    # "threading": a pool of threads serving connections, "asyncio": an
+    # event loop with a pool of worker threads for the calls
+    server_engine="threading",
+    # threads running requests, and connections (threading) or calls
+    # (asyncio) allowed to wait for one before new ones get a 503
+    workers=16,
+    accept_queue_size=64,
+    # threads running async_job calls, jobs kept and seconds finished jobs
+    # are kept for
+    job_workers=4,
+    max_jobs=1000,
+    job_ttl=3600,
+    # seconds a call may take, by method name or "default"; calls passing
+    # call_timeout use that instead
+    call_timeouts={},
+    # path of a unix domain socket to also serve the API on, for clients on
+    # this host allowed by their uid or (primary) gid instead of a password
+    unix_socket=None,
+    unix_socket_mode=0o660,
+    unix_socket_uids=[0],
+    unix_socket_gids=[],
+    # serve GET /metrics, to anyone unless metrics_password is set
+    metrics=False,
+    metrics_user="metrics",
+    metrics_password=None,
+    # add a Server-Timing header to responses, with the time spent in the
+    # commands and library calls made
+    server_timing=False,
+    # seconds a call may hold its locks before the stack of its thread is
+    # logged, null not to check
+    lock_stuck_seconds=120,
+    # let identical calls of read only methods running at the same time
+    # share one result
+    coalesce_reads=True,
+    # seconds the result of a list call may be served again, as long as
+    # nothing it reads was changed through targetd, 0 to always look again
+    read_snapshot_ttl=5,
+    # seconds the volumes of a block pool are known without listing them
+    # again, for the changes made outside targetd
+    volume_index_ttl=60,
+    # seconds the file systems are known by uuid without listing them again
+    fs_catalog_ttl=60,
 )
 
 config = {}
 
-# Will be added to by fs/block.initialize()
+# Will be added to by fs.initialize() and configure_block()
 mapping = dict()
 
-# Used to serialize the work we actually do
-mutex = Lock()
+# targetd.block once a block pool or a call of its methods needs it, see
+# configure_block() and _load_block()
+block = None
+
+# The methods of targetd.block (see block.methods()), known before it is
+# imported: hosts without block pools still have LIO targets to list
+BLOCK_METHODS = frozenset((
+    'vol_list', 'vol_create', 'vol_destroy', 'vol_copy', 'export_list',
+    'export_create', 'export_destroy', 'initiator_set_auth',
+    'initiator_list', 'access_group_list', 'access_group_create',
+    'access_group_destroy', 'access_group_init_add', 'access_group_init_del',
+    'access_group_map_list', 'access_group_map_create',
+    'access_group_map_destroy'))
+# Why importing it failed, see _unloaded_block()
+block_error = None
+
+# Called by reload_config() with the new configuration, each checks it and
+# returns a function switching over to it, see block.configure()
+configure_hooks = []
+
+# Settings only read at startup, reload_config() keeps their old values
+RESTART_SETTINGS = ('ssl', 'server_engine', 'workers', 'accept_queue_size',
+                    'job_workers', 'max_jobs', 'job_ttl', 'unix_socket',
+                    'unix_socket_mode')
+
+# One reload at a time
+reload_lock = threading.Lock()
 
 # Tarpit
 tar = Tar()
 
+# Content-Type of GET /metrics, the Prometheus text format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds a failed authentication is held before it gets its reply
+TARPIT_DELAY = 2
+
+# Seconds a client is asked to wait when turned away because we are busy
+RETRY_AFTER = 1
+
+# Seconds between checks whether an idle connection should give up its worker
+IDLE_POLL = 0.1
+
+# Bytes of a streamed result collected before they are sent as one chunk
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# X-Request-Id headers taken as the id of the request, see _request_id()
+REQUEST_ID = re.compile(r'[A-Za-z0-9_.-]{1,64}')
+
+# Params taken by rpc_call() itself rather than the method
+RESERVED_PARAMS = frozenset(('async_job', 'call_timeout'))
+
+requests_in_flight = metrics.Gauge(
+    "targetd_requests_in_flight", "Calls being executed")
+queue_wait_seconds = metrics.Histogram(
+    "targetd_queue_wait_seconds", "Time waiting for a worker thread")
+requests_rejected = metrics.Counter(
+    "targetd_requests_rejected_total",
+    "Requests turned away with 503 because the queue was full")
+call_seconds = metrics.Histogram(
+    "targetd_call_seconds", "Time taken by calls, waiting for locks included")
+call_errors = metrics.Counter(
+    "targetd_call_errors_total", "Calls which failed, by error code",
+    labels=('method', 'code'))
+lock_wait_seconds = metrics.Histogram(
+    "targetd_lock_wait_seconds", "Time calls waited for their locks")
+lock_hold_seconds = metrics.Histogram(
+    "targetd_lock_hold_seconds", "Time calls held their locks")
+
+coalesced_calls = metrics.Counter(
+    "targetd_coalesced_calls_total",
+    "Calls answered with the result of an identical call already running")
+
+# Used to serialize the work we actually do, per pool/target/exports file
+lock_manager = LockManager(lock_wait_seconds, lock_hold_seconds)
+
+snapshot_reads = metrics.Counter(
+    "targetd_snapshot_reads_total",
+    "Calls answered from the snapshot of an identical call")
+
+# Read only calls running, by method and params, see _read()
+flights = SingleFlight()
+
+# Their results, served until a write invalidates them
+snapshots = Snapshots(lock_manager)
+
+
+def call_keys(calls):
+    """
+    Return the lock keys needed by the JSON-RPC request objects in calls,
+    None if they need to lock everything.
+    """
+    keys = set()
+    for call in calls:
+        try:
+            fn = mapping[call['method']]
+            params = call.get('params', None)
+        except (KeyError, TypeError, AttributeError):
+            # Not a valid call, it will fail without doing any work
+            continue
+        if isinstance(params, dict) and params.get('async_job') and \
+                getattr(fn, 'job', False):
+            # The job takes the locks when it runs, see _start_job()
+            continue
+        if not _lockable(call):
+            # rpc_call() rejects it without doing any work
+            continue
+        fn_keys = lock_keys(fn, params)
+        if fn_keys is None:
+            return None
+        keys |= fn_keys
+    return keys
+
+
+def _lockable(call):
+    """
+    False if the lock keys of a call can't be had from its params, see
+    utils.lock_keys().  rpc_call() then rejects it before it runs, so it
+    is made without taking any lock.
+    """
+    try:
+        lock_keys(mapping[call['method']], call.get('params', None))
+    except TargetdError:
+        return False
+    except (KeyError, TypeError, AttributeError):
+        pass
+    return True
+
+
+@contextmanager
+def _tracking(req, method):
+    """
+    Account for a call of method, the first one req makes also records how
+    long it waited for a worker.
+    """
+    if not (isinstance(method, str) and method in mapping):
+        yield
+        return
+
+    wait = getattr(req, 'queue_wait', None)
+    if wait is not None:
+        queue_wait_seconds.observe(method, wait)
+        req.queue_wait = None
+
+    requests_in_flight.inc(method)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        call_seconds.observe(method, time.monotonic() - start)
+        requests_in_flight.dec(method)
+
+
+def call_methods(calls):
+    """
+    Return the known method names used by the parsed JSON-RPC request or
+    batch calls.
+    """
+    if not isinstance(calls, list):
+        calls = [calls]
+    rc = []
+    for call in calls:
+        method = call.get('method') if isinstance(call, dict) else None
+        if isinstance(method, str) and method in mapping:
+            rc.append(method)
+    return rc
+
+
+def rpc_call(req, call):
+    """
+    Run one JSON-RPC request object, returning its response object.
+    """
+    error = (-1, "jsonrpc error")
+    id_num = 0
+    method = None
+
+    try:
+        try:
+            version = call['jsonrpc']
+            if version != "2.0":
+                raise ValueError
+            method = call['method']
+            id_num = int(call['id'])
+            params = call.get('params', None)
+            run_async = False
+            timeout = None
+            if isinstance(params, dict) and \
+                    RESERVED_PARAMS.intersection(params):
+                params = dict(params)
+                run_async = params.pop('async_job', False)
+                timeout = params.pop('call_timeout', None)
+        except (KeyError, ValueError, TypeError):
+            error = (-32600, "not a valid jsonrpc-2.0 request")
+            raise
+
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(_tracking(req, method))
+                timeout = _call_timeout(method, timeout)
+                # Its locks are known, see _lockable()
+                lock_keys(mapping[method], params)
+                if run_async:
+                    result = _start_job(req, method, params, timeout)
+                else:
+                    with call_context(timeout, method=method) as ctx:
+                        if params:
+                            result = mapping[method](req, **params)
+                        else:
+                            result = mapping[method](req)
+                        if isinstance(result, types.GeneratorType):
+                            result = _started(req, result, ctx, stack)
+        except KeyError:
+            error = (-32601, "method %s not found" % method)
+            log.debug(traceback.format_exc())
+            raise
+        except TypeError:
+            error = (TargetdError.INVALID_ARGUMENT,
+                     "invalid method arguments(s)")
+            log.debug(traceback.format_exc())
+            raise
+        except TargetdError as td:
+            error = (td.error, str(td))
+            raise
+        except Exception as e:
+            error = (-1, "%s: %s" % (type(e).__name__, e))
+            log.debug(traceback.format_exc())
+            raise
+
+        return dict(result=result, id=id_num, jsonrpc="2.0")
+    except:
+        log.debug(traceback.format_exc())
+        log.debug('Error=%s, msg=%s' % (error[0], error[1]))
+        # Only known methods, clients choose the names of the others
+        known = isinstance(method, str) and method in mapping
+        call_errors.inc((method if known else "", str(error[0])))
+        return dict(
+            error=dict(code=error[0], message=error[1]),
+            id=id_num,
+            jsonrpc="2.0")
+
+
+def _call_timeout(method, timeout):
+    """
+    Seconds the call of method may take: timeout if the client passed one,
+    else the one configured for the method, None for no limit.
+    """
+    if timeout is None:
+        timeouts = config['call_timeouts'] or {}
+        timeout = timeouts.get(method, timeouts.get('default'))
+    if timeout is not None and \
+            (not isinstance(timeout, (int, float)) or timeout <= 0):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "call_timeout must be a positive number of "
+                           "seconds")
+    return timeout
+
+
+def _start_job(req, method, params, timeout=None):
+    """
+    Run the call on the job pool instead, with its own request object and
+    locks, returning its job id.  Its timeout counts from when it starts.
+    """
+    fn = mapping[method]
+    if not getattr(fn, 'job', False):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "%s can't be called with async_job" % method)
+    keys = lock_keys(fn, params)
+    job_req = RpcRequest(req.client_address, req.headers)
+    request_id = getattr(req, 'request_id', None)
+
+    def run():
+        with call_context(timeout, request_id=request_id,
+                          method=method) as ctx, \
+                lock_manager.locked(keys, ctx.orphans, method):
+            result = fn(job_req, **params)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+
+    return dict(job_id=jobs.submit(method, run))
+
+
+def _started(req, result, ctx, stack):
+    """
+    Run the generator a method returned up to its first item, so the usual
+    errors (bad pool, missing target, ...) are reported as such.  The rest
+    is encoded as it is sent by StreamedResponse, unless the call is part of
+    a batch.  The call (ctx) and its accounting (stack) go on until then.
+    """
+    if req.batch is not None:
+        return list(result)
+    try:
+        first = next(result)
+    except StopIteration:
+        return []
+    return _Stream(first, result, ctx, stack.pop_all())
+
+
+class _Stream(Iterator):
+    """
+    The items of a streamed result.  Those after the first are produced in
+    the call_context() of the call, ctx, on whichever thread sends them,
+    and not past its deadline.  Closing it ends the call.
+    """
+
+    def __init__(self, first, rest, ctx, call):
+        self.pending = [first]
+        self.rest = rest
+        self.ctx = ctx
+        self.call = call
+
+    def __next__(self):
+        with resumed(self.ctx):
+            self.ctx.remaining()
+            if self.pending:
+                return self.pending.pop()
+            return next(self.rest)
+
+    def remaining(self):
+        return self.ctx.remaining()
+
+    def close(self):
+        try:
+            with resumed(self.ctx):
+                self.rest.close()
+        finally:
+            self.call.close()
+
+
+class StreamedResponse(object):
+    """
+    A JSON-RPC response whose result array is encoded while it is iterated
+    over, in chunks of about STREAM_CHUNK_SIZE.  The call and its locks
+    last until it has been iterated over or closed.  Senders give up once
+    the deadline of the call passes, see remaining().
+    """
+
+    def __init__(self, response, locks):
+        self.items = response.pop('result')
+        self.response = response
+        self.locks = locks
+
+    def __iter__(self):
+        try:
+            buf = ['{"result": [']
+            size = 0
+            sep = ''
+            for item in self.items:
+                data = sep + json.dumps(item)
+                buf.append(data)
+                size += len(data)
+                sep = ', '
+                if size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(buf)
+                    buf = []
+                    size = 0
+            # the rest of the response object
+            buf.append('], ' + json.dumps(self.response)[1:])
+            yield ''.join(buf)
+        finally:
+            self.close()
+
+    def remaining(self, limit):
+        """
+        Seconds the next chunk may take to send: limit, or less if the call
+        has a deadline.  Raises once the deadline has passed.
+        """
+        left = self.items.remaining()
+        return limit if left is None else min(left, limit)
+
+    def close(self):
+        try:
+            self.items.close()
+        finally:
+            self.locks.close()
+
+
+def _commit_batch(req, response):
+    """
+    Run the work the batch deferred, if that fails the calls which
+    succeeded are reported with its error instead.
+    """
+    try:
+        req.batch.commit()
+    except Exception as e:
+        if isinstance(e, TargetdError):
+            error = dict(code=e.error, message=str(e))
+        else:
+            error = dict(code=-1, message="%s: %s" % (type(e).__name__, e))
+        log.error("batch commit failed: %s" % error['message'])
+        log.debug(traceback.format_exc())
+        for r in response:
+            if 'result' in r:
+                del r['result']
+                r['error'] = error
+
+
+def rpc_execute(req, body):
+    """
+    Run the JSON-RPC request or batch in body (bytes) on behalf of req,
+    returning the JSON text of the response, or a StreamedResponse for a
+    call whose method returned a generator.  req is passed on to the
+    methods and needs a batch attribute, see utils.defer().
+    """
+    req.request_id = None
+    try:
+        calls = json.loads(body.decode('utf-8'))
+    except ValueError:
+        # see http://www.jsonrpc.org/specification for errcodes
+        log.debug(traceback.format_exc())
+        return json.dumps(
+            dict(error=dict(code=-32700, message="parse error"),
+                 id=0, jsonrpc="2.0"))
+
+    if block is None and block_error is None and _block_calls(calls):
+        _load_block()
+
+    # Each call sets its own deadline, calls it gave up on keep the locks
+    # until they return, see utils.bounded()
+    with call_context(request_id=_request_id(req)) as ctx:
+        # for server_timing()
+        req.request_id = ctx.request_id
+        req.traces = ctx.traces
+        if isinstance(calls, list) and calls:
+            # Serialize the actual work to be done.  The whole batch runs
+            # holding the locks of all its calls and saves the LIO config
+            # once.
+            reads = [getattr(mapping.get(m), 'read_only', False)
+                     for m in call_methods(calls)]
+            with lock_manager.locked(call_keys(calls), ctx.orphans,
+                                     "batch", write=not all(reads)):
+                req.batch = Batch()
+                try:
+                    response = [rpc_call(req, c) for c in calls]
+                    _commit_batch(req, response)
+                finally:
+                    req.batch = None
+        else:
+            name = (call_methods(calls) or [""])[0]
+            read = getattr(mapping.get(name), 'read_only', False)
+            if read:
+                response = _read(req, calls, name, ctx)
+                if response is not None:
+                    return response
+            # Serialize the actual work to be done.
+            with ExitStack() as stack:
+                if not getattr(mapping.get(name), 'unlocked', False) and \
+                        _lockable(calls):
+                    stack.enter_context(lock_manager.locked(
+                        call_keys([calls]), ctx.orphans, name,
+                        write=not read))
+                response = rpc_call(req, calls)
+                if isinstance(response.get('result'), Iterator):
+                    # keep the locks until the result has been sent
+                    return StreamedResponse(response, stack.pop_all())
+    return json.dumps(response)
+
+
+def _read(req, call, name, ctx):
+    """
+    Run a call of a read only method.  It is answered from the snapshot of
+    an identical call (same method and params) if no write to what it reads
+    was done since, without waiting for any lock.  Otherwise, if an
+    identical call is running already, with its result, waiting for it no
+    longer than its own call_timeout allows.  If its locks are
+    held, by a write in progress say, it is answered with its snapshot
+    however old instead of waiting for them, unless a write was done since
+    it was taken.  Results are encoded once for all the calls they answer.
+    Returns None if the call must run on its own, as the one it waited for
+    streamed its result.
+    """
+    try:
+        if call['jsonrpc'] != "2.0":
+            return None
+        id_num = int(call['id'])
+        params = call.get('params')
+        key = (name, json.dumps(params, sort_keys=True))
+        timeout = _call_timeout(name, params.get('call_timeout')
+                                if isinstance(params, dict) else None)
+    except (KeyError, TypeError, ValueError, TargetdError):
+        # Left to rpc_call() to complain about
+        return None
+    if not _lockable(call):
+        return None
+
+    keys = call_keys([call])
+    ttl = config['read_snapshot_ttl']
+    if ttl:
+        rc = snapshots.get(key, keys, ttl)
+        if rc is not None:
+            with _tracking(req, name):
+                snapshot_reads.inc(name)
+            return _response(rc, id_num)
+
+    snapshot = []
+
+    def run():
+        with ExitStack() as stack:
+            last = snapshots.get(key, keys) if ttl else None
+            if stack.enter_context(lock_manager.locked(
+                    keys, ctx.orphans, name, write=False,
+                    wait=last is None)):
+                # read again while this call waited for the locks
+                last = snapshots.get(key, keys, ttl) if ttl else None
+            if last is not None:
+                with _tracking(req, name):
+                    snapshot.append(last)
+                return last
+            generation = lock_manager.generation(keys)
+            response = rpc_call(req, call)
+            if isinstance(response.get('result'), Iterator):
+                return StreamedResponse(response, stack.pop_all())
+        if 'result' not in response:
+            return 'error', json.dumps(response['error'])
+        rc = ('result', json.dumps(response['result']))
+        if ttl:
+            snapshots.put(key, generation, rc, keys, ttl,
+                          functools.partial(_reread, call))
+        return rc
+
+    if config['coalesce_reads']:
+        # Waiting for the identical call counts as making this one
+        try:
+            rc, shared = flights.do(key, run, timeout, _tracking(req, name))
+        except TargetdError as td:
+            if td.error != TargetdError.TIMEOUT:
+                raise
+            call_errors.inc((name, str(td.error)))
+            return _response(('error', json.dumps(
+                dict(code=td.error, message=str(td)))), id_num)
+    else:
+        rc, shared = run(), False
+    if isinstance(rc, StreamedResponse):
+        return None if shared else rc
+    if shared:
+        coalesced_calls.inc(name)
+    elif snapshot:
+        snapshot_reads.inc(name)
+    return _response(rc, id_num)
+
+
+def _reread(call):
+    """
+    Make the read only call again for its snapshot, after a write made it
+    stale, see Snapshots.committed().  Not a call of the method as far as
+    the metrics go.  Returns its result as _read() keeps it, None if it
+    failed.
+    """
+    method = call['method']
+    params = dict(call.get('params') or {})
+    timeout = _call_timeout(method, params.pop('call_timeout', None))
+    try:
+        with call_context(timeout, method=method):
+            result = mapping[method](RpcRequest(None, {}), **params)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+    except Exception:
+        log.debug(traceback.format_exc())
+        return None
+    return 'result', json.dumps(result)
+
+
+def _response(rc, id_num):
+    """
+    Return the JSON text of the response with id id_num to a call which
+    returned rc, ('result' or 'error', its JSON text).  The same text
+    json.dumps() gives for the whole response.
+    """
+    return '{"%s": %s, "id": %d, "jsonrpc": "2.0"}' % (rc[0], rc[1], id_num)
+
+
+def _request_id(req):
+    """
+    The id the client gave the request in an X-Request-Id header, if it is
+    a sane one, else None for a new one.
+    """
+    request_id = req.headers.get('X-Request-Id')
+    if request_id and REQUEST_ID.fullmatch(request_id):
+        return request_id
+    return None
+
+
+def server_timing(req):
+    """
+    Return the Server-Timing header for the response to req, if enabled:
+    the milliseconds spent running each command (by name) and in library
+    calls, and the request id to look them up with debug_trace.
+    """
+    request_id = getattr(req, 'request_id', None)
+    if not config['server_timing'] or request_id is None:
+        return {}
+    spent = dict()
+    for t in list(req.traces):
+        name = os.path.basename(t['argv'][0]) \
+            if t['kind'] == "command" else "library"
+        spent[name] = spent.get(name, 0.0) + t['seconds']
+    entries = ['%s;dur=%.3f' % (re.sub(r'[^\w.-]', '_', name), s * 1000)
+               for name, s in sorted(spent.items())]
+    entries.append('request;desc="%s"' % request_id)
+    return {"Server-Timing": ", ".join(entries)}
+
+
+@unlocked
+def debug_trace(req, request_id=None, method=None, limit=100):
+    """
+    Return the last limit commands and library calls traced, oldest first,
+    only those of request_id and/or method if given.
+    """
+    if not isinstance(limit, int) or limit < 0:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "limit must be a positive integer")
+    rc = [t for t in list(traces)
+          if (request_id is None or t['request_id'] == request_id) and
+          (method is None or t['method'] == method)]
+    return rc[len(rc) - limit:] if limit else []
+
+
+@unlocked
+def lock_status(req):
+    """
+    Return the calls holding locks and those waiting for them, see
+    LockManager.status().
+    """
+    return lock_manager.status()
+
+
+def basic_auth(header):
+    """
+    Return (user, password) from an Authorization header, raises if it is
+    missing or isn't HTTP Basic auth.
+    """
+    # get basic auth string, strip "Basic "
+    auth_bytes = header[6:].encode('utf-8')
+    auth_str = base64.b64decode(auth_bytes).decode('utf-8')
+    in_user, in_pass = auth_str.split(":")
+    return in_user, in_pass
+
+
+def authorized(in_user, in_pass):
+    return in_user == config['user'] and in_pass == config['password']
+
+
+def metrics_authorized(in_user, in_pass):
+    return in_user == config['metrics_user'] and \
+        in_pass == config['metrics_password']
+
+
+def _tarpit_stat(stat):
+    return lambda: {(): tar.stats()[stat]}
+
+
+def _job_counts():
+    if jobs.manager is None:
+        return {}
+    return jobs.manager.stats()
+
+
+# Served by GET /metrics, see metrics_text()
+exposed_metrics = [
+    requests_in_flight, queue_wait_seconds, requests_rejected, call_seconds,
+    call_errors, lock_wait_seconds, lock_hold_seconds, command_seconds,
+    library_call_seconds, coalesced_calls, snapshot_reads,
+    metrics.Callback("targetd_tarpit_pitted_total",
+                     "Failed authentications delayed",
+                     _tarpit_stat('pitted'), kind='counter'),
+    metrics.Callback("targetd_tarpit_rejected_total",
+                     "Requests refused while their client was in the tarpit",
+                     _tarpit_stat('rejected'), kind='counter'),
+    metrics.Callback("targetd_tarpit_held", "Clients in the tarpit",
+                     _tarpit_stat('held')),
+    metrics.Callback("targetd_tarpit_pending", "Delayed replies not sent yet",
+                     _tarpit_stat('pending')),
+    metrics.Callback("targetd_jobs", "Jobs kept, by status", _job_counts,
+                     labels=('status',)),
+]
+
+
+def metrics_text():
+    return metrics.expose(exposed_metrics)
+
+
+def http_response(code, body, content_type, keep_alive=True, headers=None):
+    """
+    Return the bytes of a complete HTTP/1.1 response.  With a body of None
+    only the head of a chunked response is returned, see http_chunk().
+    """
+    lines = ["HTTP/1.1 %d %s" % (code, HTTPStatus(code).phrase),
+             "Date: %s" % email.utils.formatdate(usegmt=True),
+             "Content-Type: %s" % content_type]
+    if body is None:
+        lines.append("Transfer-Encoding: chunked")
+        body = b''
+    else:
+        lines.append("Content-Length: %d" % len(body))
+    for k, v in (headers or {}).items():
+        lines.append("%s: %s" % (k, v))
+    if not keep_alive:
+        lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+
+def http_chunk(data):
+    """
+    Frame data (bytes) as one chunk of a chunked response, empty data ends
+    the response.
+    """
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+def error_response(code, headers=None):
+    """
+    Return the bytes of an error response like the one
+    BaseHTTPRequestHandler.send_error() sends, closing the connection.
+    """
+    status = HTTPStatus(code)
+    body = BaseHTTPRequestHandler.error_message_format % dict(
+        code=code, message=status.phrase, explain=status.description)
+    return http_response(code, body.encode('utf-8', 'replace'),
+                         BaseHTTPRequestHandler.error_content_type, False,
+                         headers)
+
+
+def busy_response():
+    """
+    Return the bytes of the 503 response sent when the queue is full.
+    """
+    return error_response(503, {"Retry-After": str(RETRY_AFTER)})
+
+
+def _send_and_close(sock, data):
+    try:
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        # Closing with an unread request body in the receive buffer resets
+        # the connection, and the client may lose our reply.  Drain what has
+        # arrived, without waiting for more.
+        sock.setblocking(False)
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
 
 class TargetHandler(BaseHTTPRequestHandler):
+    # Allow clients to reuse their connection (and TLS session) for many
+    # calls, every response we send carries a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, don't let Nagle hold the
+    # body back waiting for the client's delayed ACK on a reused connection.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # StreamRequestHandler applies this to the socket, an idle connection
+        # times out in handle_one_request() and is closed.
+        self.timeout = config['keepalive_timeout']
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_served = 0
+        # Set while the calls of a JSON-RPC batch run, see utils.defer()
+        self.batch = None
+        # Seconds the connection waited for this worker, see _tracking()
+        self.queue_wait = self.server.queue_wait()
+        # Set by rpc_execute(), see server_timing()
+        self.request_id = None
+        self.traces = []
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._next_request():
+            self.handle_one_request()
+
+    def _buffered(self):
+        """
+        True if (part of) the next request has already been received.
+        """
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except (OSError, ValueError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def _next_request(self):
+        """
+        Wait for the next request on a kept alive connection.  Returns False
+        if the connection should be closed: it stayed idle for
+        keepalive_timeout or, while idle, other connections are waiting for
+        this worker.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self._buffered() or \
+                    select.select([self.connection], [], [], IDLE_POLL)[0]:
+                return True
+            if self.server.busy() or time.monotonic() >= deadline:
+                return False
+
     def log_request(self, code='-', size='-'):
         # override base class - don't log good requests
         pass
 
-    def do_POST(self):
+    def send_rpc(self, rpcdata):
+        if isinstance(rpcdata, StreamedResponse):
+            if self.request_version == 'HTTP/1.1':
+                self.send_streamed(rpcdata)
+                return
+            # no chunked encoding before HTTP/1.1
+            rpcdata = ''.join(rpcdata)
+
+        body = rpcdata.encode('utf-8')
 
-        rpcdata = ""
-        error = None
-        id_num = 0
+        self.requests_served += 1
+
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in server_timing(self).items():
+            self.send_header(k, v)
+        if self.requests_served >= config['keepalive_requests']:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_streamed(self, rpcdata):
+        """
+        Send the response chunk by chunk as it is encoded.
+        """
+        self.requests_served += 1
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            for k, v in server_timing(self).items():
+                self.send_header(k, v)
+            if self.requests_served >= config['keepalive_requests']:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            for data in rpcdata:
+                # A slow client doesn't keep the call going past its deadline
+                self.connection.settimeout(rpcdata.remaining(self.timeout))
+                self.wfile.write(http_chunk(data.encode('utf-8')))
+            self.wfile.write(http_chunk(b''))
+        except Exception:
+            # Too late for an error response, the client sees the response
+            # end without its last chunk
+            log.error(traceback.format_exc())
+            self.close_connection = True
+        finally:
+            rpcdata.close()
+            self.connection.settimeout(self.timeout)
 
-        # get basic auth string, strip "Basic "
+    def authenticate(self, check=authorized):
+        """
+        Check the client's credentials with check(user, password), returns
+        False once it has been answered with an error.
+        """
         try:
-            auth_bytes = self.headers.get("Authorization")[6:].encode('utf-8')
-            auth_str = base64.b64decode(auth_bytes).decode('utf-8')
-            in_user, in_pass = auth_str.split(":")
+            in_user, in_pass = basic_auth(self.headers.get("Authorization"))
         except Exception:
             log.error(traceback.format_exc())
             self.send_error(400)
-            return
+            return False
 
         if tar.is_stuck(self.client_address[0]):
             log.warning("Concurrent authentication attempts from %s" %
@@ -98,13 +1005,48 @@ class TargetHandler(BaseHTTPRequestHandler):
             # This client already has a failed authentication attempt,
             # immediately return error without trying new credentials.
             self.send_error(503)
+            return False
+
+        if not check(in_user, in_pass):
+            # Tarpit the bad authentication for a bit.  The tarpit sends the
+            # reply later, this thread is free to serve others.
+            self.close_connection = True
+            self.server.hold_request(self.request)
+            tar.delay(self.client_address[0], TARPIT_DELAY,
+                      functools.partial(_send_and_close, self.request,
+                                        error_response(401)))
+            return False
+
+        return True
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            # Only the API, which takes POST
+            self.send_error(501)
             return
+        if not config['metrics']:
+            self.send_error(404)
+            return
+
+        if config['metrics_password'] and \
+                not self.authenticate(metrics_authorized):
+            return
+
+        body = metrics_text().encode('utf-8')
+
+        self.requests_served += 1
 
-        if in_user != config['user'] or in_pass != config['password']:
-            # Tarpit the bad authentication for a bit
-            with tar.pitted(self.client_address[0]):
-                time.sleep(2)
-                self.send_error(401)
+        self.send_response(200)
+        self.send_header("Content-type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        if self.requests_served >= config['keepalive_requests']:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+
+        if not self.authenticate():
             return
 
         if not self.path == "/targetrpc":
@@ -113,102 +1055,340 @@ class TargetHandler(BaseHTTPRequestHandler):
             return
 
         try:
-            error = (-1, "jsonrpc error")
+            content_len = int(self.headers.get('content-length'))
+        except (TypeError, ValueError):
+            # We can't find the end of the request without it
+            self.send_error(411)
+            return
+
+        # Make sure we aren't being asked to read too much data.
+        # Since this happens after authentication this really should
+        # never happen for normal operation.
+        if content_len > config['max_request_size']:
+            log.error("client %s, content-length = %d rejecting!" %
+                      (self.client_address[0], content_len))
+            self.send_error(413)
+            return
+
+        self.send_rpc(rpc_execute(self, self.rfile.read(content_len)))
+
+
+class PoolMixIn(object):
+    """
+    Serve connections on a fixed pool of config['workers'] threads.  Accepted
+    connections wait for a worker in a queue of config['accept_queue_size'],
+    once that is full new connections are turned away with a 503.
+    """
+
+    def start_workers(self):
+        self.connections = queue.Queue(maxsize=config['accept_queue_size'])
+        self.worker = threading.local()
+        for i in range(config['workers']):
+            t = threading.Thread(target=self._work, name="targetd-%d" % i)
+            # Idle keep-alive connections must not hold up shutdown
+            t.daemon = True
+            t.start()
+
+        # Turning clients away can mean a TLS handshake, done on its own
+        # thread to keep the accept loop going.
+        self.rejects = queue.Queue(maxsize=config['accept_queue_size'])
+        t = threading.Thread(target=self._work_rejects, name="targetd-busy")
+        t.daemon = True
+        t.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait(
+                (request, client_address, time.monotonic()))
+        except queue.Full:
+            requests_rejected.inc("")
             try:
-                content_len = int(self.headers.get('content-length'))
-
-                # Make sure we aren't being asked to read too much data.
-                # Since this happens after authentication this really should
-                # never happen for normal operation.
-                if content_len > (1024 * 128):
-                    log.error("client %s, content-length = %d rejecting!" %
-                              (self.client_address[0], content_len))
-                    self.send_error(413)
-                    return
-
-                req = json.loads(self.rfile.read(content_len).decode('utf-8'))
-            except ValueError:
-                # see http://www.jsonrpc.org/specification for errcodes
-                error = (-32700, "parse error")
-                raise
+                self.rejects.put_nowait(request)
+            except queue.Full:
+                self.close_request(request)
 
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
+    def busy(self):
+        """
+        True if connections are waiting for a worker.
+        """
+        return not self.connections.empty()
+
+    def queue_wait(self):
+        """
+        Seconds the connection being handled by this worker thread waited
+        for it.
+        """
+        queued = getattr(self.worker, 'queued', None)
+        if queued is None:
+            return None
+        return time.monotonic() - queued
 
+    def _work(self):
+        while True:
+            request, client_address, queued = self.connections.get()
+            self.worker.queued = queued
             try:
-                version = req['jsonrpc']
-                if version != "2.0":
-                    raise ValueError
-                method = req['method']
-                id_num = int(req['id'])
-                params = req.get('params', None)
-            except (KeyError, ValueError):
-                error = (-32600, "not a valid jsonrpc-2.0 request")
-                raise
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.worker.queued = None
+                self.shutdown_request(request)
 
-            # Serialize the actual work to be done.
-            mutex.acquire()
+    def _work_rejects(self):
+        while True:
+            request = self.rejects.get()
             try:
-                if params:
-                    result = mapping[method](self, **params)
-                else:
-                    result = mapping[method](self)
-            except KeyError:
-                error = (-32601, "method %s not found" % method)
-                log.debug(traceback.format_exc())
-                raise
-            except TypeError:
-                error = (TargetdError.INVALID_ARGUMENT,
-                         "invalid method arguments(s)")
-                log.debug(traceback.format_exc())
-                raise
-            except TargetdError as td:
-                error = (td.error, str(td))
-                raise
+                request.settimeout(RETRY_AFTER)
+                _send_and_close(self.client_socket(request), busy_response())
             except Exception as e:
-                error = (-1, "%s: %s" % (type(e).__name__, e))
-                log.debug(traceback.format_exc())
-                raise
-            finally:
-                mutex.release()
+                log.debug("rejecting connection: %s" % e)
+                self.close_request(request)
 
-            rpcdata = json.dumps(dict(result=result, id=id_num, jsonrpc="2.0"))
-        except:
-            log.debug(traceback.format_exc())
-            log.debug('Error=%s, msg=%s' % (error[0], error[1]))
-            rpcdata = json.dumps(
-                dict(
-                    error=dict(code=error[0], message=error[1]),
-                    id=id_num,
-                    jsonrpc="2.0"))
-        finally:
-            self.wfile.write(rpcdata.encode('utf-8'))
+    def client_socket(self, request):
+        """
+        The socket to talk HTTP with on an accepted connection.
+        """
+        return request
 
 
-class HTTPService(ThreadingMixIn, HTTPServer, object):
+class HTTPService(PoolMixIn, HTTPServer, object):
     """
-    Handle rpc requests concurrently, but process them sequentially by using a
-    mutex.  We do this so we hopefully don't block valid API users when some
-    one tries to brute force the password.
+    Handle rpc requests concurrently, but process the ones working on the same
+    resource sequentially by using lock_manager.  We do this so we hopefully
+    don't block valid API users when some one tries to brute force the
+    password.
 
     Note: Many things we are calling into are not thread safe and/or cannot be
-    done concurrently.  We will process things one at a time.
+    done concurrently.  We will process things one at a time for each pool,
+    the LIO target and the NFS exports, see utils.locks().
+    """
+    # listen() backlog, the accept loop hands connections off right away
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        super(HTTPService, self).__init__(*args, **kwargs)
+        self.held = set()
+        self.held_lock = threading.Lock()
+        self.start_workers()
+
+    def hold_request(self, request):
+        """
+        Keep request open once its handler returns, something else (the
+        tarpit) will close it.
+        """
+        with self.held_lock:
+            self.held.add(request)
+
+    def shutdown_request(self, request):
+        with self.held_lock:
+            if request in self.held:
+                self.held.discard(request)
+                return
+        super(HTTPService, self).shutdown_request(request)
+
+
+def peer_credentials(sock):
+    """
+    Return (pid, uid, gid) of the process connected to an AF_UNIX socket.
+    """
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)
+
+
+class UnixTargetHandler(TargetHandler):
+    """
+    Serve a client connected to config['unix_socket'].  Instead of a
+    password it is authenticated by the uid and gid of its process, which
+    the kernel vouches for.
+    """
+    # Not a TCP connection
+    disable_nagle_algorithm = False
+
+    def setup(self):
+        self.peer = peer_credentials(self.request)
+        TargetHandler.setup(self)
+
+    def address_string(self):
+        return "pid %d uid %d" % self.peer[:2]
+
+    def authenticate(self, check=None):
+        pid, uid, gid = self.peer
+        if uid in config['unix_socket_uids'] or \
+                gid in config['unix_socket_gids']:
+            return True
+        log.error("unix socket client pid %d uid %d gid %d not allowed" %
+                  self.peer)
+        # Read the body first, a client still sending it when we close the
+        # connection gets EPIPE instead of our answer
+        with ignored(TypeError, ValueError):
+            content_len = int(self.headers.get('content-length'))
+            if content_len <= config['max_request_size']:
+                self.rfile.read(content_len)
+        self.send_error(403)
+        return False
+
+
+class UnixHTTPService(HTTPService):
+    """
+    Serve the API on a unix domain socket, to clients on this host.  No TLS
+    and no tarpit, see UnixTargetHandler for authentication.
+    """
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        path = self.server_address
+        # Left behind by a previous run, don't remove anything else
+        with ignored(FileNotFoundError):
+            if stat.S_ISSOCK(os.lstat(path).st_mode):
+                os.unlink(path)
+        socketserver.TCPServer.server_bind(self)
+        os.chmod(path, config['unix_socket_mode'])
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        # There is no client address on a unix socket, name ours instead
+        return request, (self.server_address, 0)
+
+    def server_close(self):
+        super(UnixHTTPService, self).server_close()
+        with ignored(FileNotFoundError):
+            os.unlink(self.server_address)
+
+
+class SSLContextCache(object):
+    """
+    The SSLContext for config's ssl_cert and ssl_key, shared by all
+    connections so clients can resume their TLS session (session tickets)
+    instead of doing a full handshake.  When the files change on disk they
+    are verified again and a new context replaces the old one; if that fails
+    we keep using the old one.
     """
+    # Seconds between looking at the files
+    CHECK_INTERVAL = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+        self.signature = SSLContextCache._signature()
+        self.context = self._create()
+        self.reloads = 0
+
+    def _create(self):
+        ctx = TLSHTTPService._create_ssl_context()
+        # Called during every handshake, which lets connections accepted with
+        # a context we have replaced since (asyncio) switch to the new one.
+        # sni_callback is Python 3.7, the older call does the same.
+        if hasattr(ctx, 'sni_callback'):
+            ctx.sni_callback = self._switch
+        else:
+            ctx.set_servername_callback(self._switch)
+        return ctx
+
+    def _switch(self, sslobj, server_name, ctx):
+        current = self.get()
+        if current is not ctx:
+            sslobj.context = current
+        return None
+
+    @staticmethod
+    def _signature():
+        rc = []
+        for f in (config["ssl_cert"], config["ssl_key"]):
+            try:
+                ss = os.stat(f)
+                rc.append((ss.st_ino, ss.st_mtime_ns, ss.st_size))
+            except OSError:
+                rc.append(None)
+        return tuple(rc)
+
+    def get(self):
+        """
+        Return the current context, reloading it first if the files have
+        changed.
+        """
+        now = time.monotonic()
+        if now - self.checked < SSLContextCache.CHECK_INTERVAL or \
+                not self.lock.acquire(blocking=False):
+            return self.context
+        try:
+            self.checked = now
+            signature = SSLContextCache._signature()
+            if signature != self.signature:
+                # Only retried once they change again, e.g. when the key
+                # is written after the certificate
+                self.signature = signature
+                self._reload()
+        finally:
+            self.lock.release()
+        return self.context
+
+    def _reload(self):
+        if not TLSHTTPService.verify_certificates():
+            log.error("Keeping the current TLS certificate")
+            return
+        try:
+            self.context = self._create()
+        except (OSError, ssl.SSLError) as e:
+            log.error("Keeping the current TLS certificate, loading "
+                      "the new one failed: %s" % e)
+            return
+        self.reloads += 1
+        log.info("Reloaded TLS certificate %s" % config["ssl_cert"])
 
 
 class TLSHTTPService(HTTPService):
     """Also use TLS to encrypt the connection"""
 
-    def finish_request(self, sock, addr):
-        sockssl = ssl.wrap_socket(
-            sock,
+    def __init__(self, *args, **kwargs):
+        self.ssl_contexts = SSLContextCache()
+        super(TLSHTTPService, self).__init__(*args, **kwargs)
+
+    @staticmethod
+    def _create_ssl_context():
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certfile=config["ssl_cert"],
+                            keyfile=config["ssl_key"])
+        ctx.set_ciphers("HIGH:-aNULL:-eNULL:-PSK")
+        ctx.options &= ~ssl.OP_NO_TICKET
+        return ctx
+
+    def hold_request(self, request):
+        # The TLS socket handlers see is detached from the socket
+        # shutdown_request() gets, so closing that leaves it open already.
+        pass
+
+    def client_socket(self, request):
+        # Bound the handshake, unless the caller did already
+        if request.gettimeout() is None:
+            request.settimeout(config['tls_handshake_timeout'])
+        return self.ssl_contexts.get().wrap_socket(
+            request,
             server_side=True,
-            keyfile=config["ssl_key"],
-            certfile=config["ssl_cert"],
-            ciphers="HIGH:-aNULL:-eNULL:-PSK",
             suppress_ragged_eofs=True)
-        return self.RequestHandlerClass(sockssl, addr, self)
+
+    def _client_hello(self, sock):
+        """
+        Wait for the client to start the TLS handshake, which it does right
+        away.  Returns False if it stayed silent for tls_handshake_timeout
+        or, while it is, other connections are waiting for this worker.
+        """
+        deadline = time.monotonic() + config['tls_handshake_timeout']
+        while not select.select([sock], [], [], IDLE_POLL)[0]:
+            if self.busy() or time.monotonic() >= deadline:
+                return False
+        return True
+
+    def finish_request(self, sock, addr):
+        # The handshake runs on the worker, a client which doesn't do its
+        # part must not keep it
+        if not self._client_hello(sock):
+            log.debug("No TLS handshake from %s" % (addr,))
+            return None
+        return self.RequestHandlerClass(self.client_socket(sock), addr, self)
 
     @staticmethod
     def _verify_ssl_file(f):
@@ -240,68 +1420,519 @@ class TLSHTTPService(HTTPService):
                 and TLSHTTPService._verify_ssl_file(config["ssl_cert"]))
 
 
+class RpcRequest(object):
+    """
+    Passed to the methods as req in place of a TargetHandler when called
+    from AsyncHTTPService.
+    """
+
+    def __init__(self, client_address, headers, queue_wait=None):
+        self.client_address = client_address
+        self.headers = headers
+        # Set while the calls of a JSON-RPC batch run, see utils.defer()
+        self.batch = None
+        # Seconds the call waited for a worker, see _tracking()
+        self.queue_wait = queue_wait
+        # Set by rpc_execute(), see server_timing()
+        self.request_id = None
+        self.traces = []
+
+
+class AsyncHTTPService(object):
+    """
+    Serve the API from an asyncio event loop.  Connections, HTTP parsing,
+    authentication and the tarpit are handled on the loop so an idle
+    connection costs a coroutine instead of a thread, the calls themselves
+    run on a pool of config['workers'] threads.
+    """
+
+    def __init__(self, server_address, ssl_context=None):
+        self.server_address = server_address
+        self.ssl_context = ssl_context
+        self.executor = ThreadPoolExecutor(max_workers=config['workers'],
+                                           thread_name_prefix="targetd")
+        # Calls running or waiting for a worker, more than the workers plus
+        # the queue get a 503
+        self.admitted = 0
+        # Set once listening, server_address then holds the bound address
+        self.ready = threading.Event()
+
+    def serve_forever(self, running=lambda: True, poll_interval=0.5):
+        """
+        Serve until running() returns False.
+        """
+        # What asyncio.run() does, which Python 3.6 doesn't have
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve(running, poll_interval))
+            AsyncHTTPService._cancel_tasks(loop)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _cancel_tasks(loop):
+        """
+        Cancel the connections still served by loop and let them finish.
+        """
+        # asyncio.all_tasks() is Python 3.7, Task.all_tasks() gone in 3.9
+        all_tasks = getattr(asyncio, 'all_tasks', None) or \
+            asyncio.Task.all_tasks
+        pending = [t for t in all_tasks(loop) if not t.done()]
+        if not pending:
+            return
+        for t in pending:
+            t.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*pending, return_exceptions=True))
+
+    async def _serve(self, running, poll_interval):
+        with startup.phase('bind'):
+            server = await asyncio.start_server(
+                self.handle_connection, *self.server_address,
+                ssl=self.ssl_context)
+        startup.finish()
+        self.server_address = server.sockets[0].getsockname()[:2]
+        self.ready.set()
+        try:
+            while running():
+                await asyncio.sleep(poll_interval)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        served = 0
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        config['keepalive_timeout'])
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                served += 1
+                keep_alive = await self.handle_request(
+                    reader, writer, client_address, head, served)
+                await writer.drain()
+        except Exception:
+            log.debug(traceback.format_exc())
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer, client_address, head,
+                             served):
+        """
+        Handle one request, head holds its request line and headers.
+        Returns True if the connection can be kept open.
+        """
+        request_line, _, header_bytes = head.partition(b'\r\n')
+        try:
+            command, path, version = \
+                request_line.decode('iso-8859-1').split()
+            headers = http.client.parse_headers(io.BytesIO(header_bytes))
+        except Exception:
+            return self._error(writer, 400)
+
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        if command == 'GET' and path == "/metrics":
+            return await self._get(writer, client_address, headers,
+                                   keep_alive and
+                                   served < config['keepalive_requests'])
+
+        if command != 'POST':
+            return self._error(writer, 501)
+
+        if not await self._authenticate(writer, client_address, headers):
+            return False
+
+        if not path == "/targetrpc":
+            log.error("Invalid URL %s" % path)
+            return self._error(writer, 404)
+
+        try:
+            content_len = int(headers.get('content-length'))
+        except (TypeError, ValueError):
+            # We can't find the end of the request without it
+            return self._error(writer, 411)
+
+        # Make sure we aren't being asked to read too much data.
+        if content_len > config['max_request_size']:
+            log.error("client %s, content-length = %d rejecting!" %
+                      (client_address[0], content_len))
+            return self._error(writer, 413)
+
+        if headers.get('Expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        body = await asyncio.wait_for(reader.readexactly(content_len),
+                                      config['keepalive_timeout'])
+
+        if self.admitted >= config['workers'] + config['accept_queue_size']:
+            try:
+                methods = call_methods(json.loads(body.decode('utf-8')))
+            except ValueError:
+                methods = []
+            for method in methods or [""]:
+                requests_rejected.inc(method)
+            writer.write(busy_response())
+            return False
+
+        if served >= config['keepalive_requests']:
+            keep_alive = False
+
+        self.admitted += 1
+        req = RpcRequest(client_address, headers)
+        try:
+            # The running loop, asyncio.get_running_loop() is Python 3.7
+            loop = asyncio.get_event_loop()
+            rpcdata = await loop.run_in_executor(
+                self.executor, self._execute, time.monotonic(), req, body)
+            if isinstance(rpcdata, StreamedResponse):
+                if version == 'HTTP/1.1':
+                    return await self._send_streamed(writer, rpcdata,
+                                                     keep_alive,
+                                                     server_timing(req))
+                # no chunked encoding before HTTP/1.1
+                rpcdata = await loop.run_in_executor(self.executor,
+                                                     ''.join, rpcdata)
+        finally:
+            self.admitted -= 1
+
+        writer.write(http_response(200, rpcdata.encode('utf-8'),
+                                   "application/json", keep_alive,
+                                   server_timing(req)))
+        return keep_alive
+
+    async def _authenticate(self, writer, client_address, headers,
+                            check=authorized):
+        """
+        Check the client's credentials with check(user, password), returns
+        False once it has been answered with an error.
+        """
+        try:
+            in_user, in_pass = basic_auth(headers.get("Authorization"))
+        except Exception:
+            log.error(traceback.format_exc())
+            return self._error(writer, 400)
+
+        if tar.is_stuck(client_address[0]):
+            log.warning("Concurrent authentication attempts from %s" %
+                        client_address[0])
+            # This client already has a failed authentication attempt,
+            # immediately return error without trying new credentials.
+            return self._error(writer, 503)
+
+        if not check(in_user, in_pass):
+            # Tarpit the bad authentication for a bit, only this coroutine
+            # waits.
+            with tar.pitted(client_address[0]):
+                await asyncio.sleep(TARPIT_DELAY)
+                return self._error(writer, 401)
+
+        return True
+
+    async def _get(self, writer, client_address, headers, keep_alive):
+        """
+        Serve GET /metrics, returns True if the connection can be kept open.
+        """
+        if not config['metrics']:
+            return self._error(writer, 404)
+
+        if config['metrics_password'] and not await self._authenticate(
+                writer, client_address, headers, metrics_authorized):
+            return False
+
+        writer.write(http_response(200, metrics_text().encode('utf-8'),
+                                   METRICS_CONTENT_TYPE, keep_alive))
+        return keep_alive
+
+    async def _send_streamed(self, writer, rpcdata, keep_alive,
+                             headers=None):
+        """
+        Send a StreamedResponse chunk by chunk.  It is encoded on a worker
+        thread, which hands each chunk to the loop and waits until it has
+        been written.
+        """
+        loop = asyncio.get_event_loop()
+
+        async def write(data):
+            writer.write(data)
+            await writer.drain()
+
+        def pump():
+            try:
+                for data in rpcdata:
+                    # A slow client doesn't keep the call going past its
+                    # deadline
+                    timeout = rpcdata.remaining(config['keepalive_timeout'])
+                    sent = asyncio.run_coroutine_threadsafe(
+                        write(http_chunk(data.encode('utf-8'))), loop)
+                    try:
+                        sent.result(timeout)
+                    except Exception:
+                        sent.cancel()
+                        raise
+            finally:
+                rpcdata.close()
+
+        writer.write(http_response(200, None, "application/json", keep_alive,
+                                   headers))
+        try:
+            await loop.run_in_executor(self.executor, pump)
+        except Exception:
+            # Too late for an error response, the client sees the response
+            # end without its last chunk
+            log.error(traceback.format_exc())
+            # don't wait for the client to take what was written
+            writer.transport.abort()
+            return False
+        writer.write(http_chunk(b''))
+        return keep_alive
+
+    @staticmethod
+    def _execute(queued, req, body):
+        req.queue_wait = time.monotonic() - queued
+        return rpc_execute(req, body)
+
+    @staticmethod
+    def _error(writer, code):
+        """
+        Send an error response, the connection is closed after it.
+        """
+        writer.write(error_response(code))
+        return False
+
+
 def load_config(config_path):
     global config
 
+    config = read_config(config_path)
+    log.basicConfig(level=config['log_level'])
+
+
+def read_config(config_path):
+    """
+    Return the configuration in config_path with the defaults filled in.
+    """
+    rc = {}
     if os.path.isfile(config_path):
-        config = yaml.safe_load(open(config_path).read())
+        rc = yaml.safe_load(open(config_path).read())
         # If a user supplies a password as "password:whatever" we don't get
         # a parse failure, we simply get a string with the contents.
         # Maybe there is a better way to handle this issue where we don't
         # have a space between key and value?
-        if config is None or type(config) is str:
-            config = {}
+        if rc is None or type(rc) is str:
+            rc = {}
 
     for key, value in iter(default_config.items()):
-        if key not in config:
-            config[key] = value
+        if key not in rc:
+            rc[key] = value
 
     # compatibility: handle old single-pool config option
-    if 'pool_name' in config:
+    if 'pool_name' in rc:
         log.warning("Please update config file, "
                     "'pool_name' should be 'block_pools'")
-        config['block_pools'] = [config['pool_name']]
-        del config['pool_name']
+        rc['block_pools'] = [rc['pool_name']]
+        del rc['pool_name']
 
     # Make unique pool lists
-    config['block_pools'] = set(config['block_pools'])
-    config['fs_pools'] = set(config['fs_pools'])
-    config['zfs_block_pools'] = set(config['zfs_block_pools'])
+    rc['block_pools'] = set(rc['block_pools'])
+    rc['fs_pools'] = set(rc['fs_pools'])
+    rc['zfs_block_pools'] = set(rc['zfs_block_pools'])
 
-    passwd = config.get('password', None)
+    passwd = rc.get('password', None)
     if not passwd or type(passwd) is not str:
         log.critical("password not set in %s in the form 'password: string_pw'"
                      % config_path)
         raise AttributeError
 
     # convert log level to int
-    config['log_level'] = getattr(log, config['log_level'].upper(), log.INFO)
-    log.basicConfig(level=config['log_level'])
+    rc['log_level'] = getattr(log, rc['log_level'].upper(), log.INFO)
+    return rc
+
+
+def reload_config(config_path=default_config_path):
+    """
+    Apply config_path again without a restart, on SIGHUP.  Only the pools
+    added to it are checked and set up.  Calls on the pools removed from it,
+    and on any fs pool if those changed, finish before the switch, other
+    calls carry on.  If anything is wrong
+    the current configuration stays.  Returns whether it was applied.
+    """
+    global config
+    global block_error
+
+    with reload_lock:
+        # The next block call tries to import it again, see _load_block()
+        block_error = None
+        try:
+            new_config = read_config(config_path)
+            for key in RESTART_SETTINGS:
+                if new_config[key] != config[key]:
+                    log.warning("Changing %s needs a restart" % key)
+                    new_config[key] = config[key]
+            commits = [configure(new_config) for configure in configure_hooks]
+        except Exception as e:
+            log.error("Keeping the current configuration, %s: %s" %
+                      (config_path, e))
+            return False
+
+        keys = set('pool:%s' % p
+                   for key in ('block_pools', 'zfs_block_pools')
+                   for p in config[key] - new_config[key])
+        if config['fs_pools'] != new_config['fs_pools']:
+            # All fs pools share one lock key (see fs.FS), and adding one
+            # drops the fs catalog too
+            keys.add('fs')
+        with lock_manager.locked(keys, name="reload"):
+            for commit in commits:
+                commit()
+            config = new_config
+            # The pools listed may have changed
+            lock_manager.invalidate()
+        log.getLogger().setLevel(config['log_level'])
+        log.info("Reloaded %s" % config_path)
+        return True
+
+
+def configure_block(config_dict, needed=False):
+    """
+    configure hook (see reload_config()) of the block module, which with
+    rtslib is only imported once config_dict has a block pool, or it is
+    needed for a call of its methods.  Those are added to mapping when it
+    is, in place of the ones of _unloaded_block().
+    """
+    if block is None:
+        if not needed and not config_dict['block_pools'] and \
+                not config_dict['zfs_block_pools']:
+            return lambda: None
+        with startup.phase('imports'):
+            import targetd.block as module
+    else:
+        module = block
+    commit = module.configure(config_dict)
+
+    def publish():
+        global block
+        global mapping
+        commit()
+        if block is None:
+            # A new dict, so a call never sees some of the methods only
+            mapping = dict(mapping, **module.methods())
+            block = module
+
+    return publish
+
+
+def _block_calls(calls):
+    """
+    True if the parsed JSON-RPC request or batch calls a block method.
+    """
+    for call in calls if isinstance(calls, list) else [calls]:
+        method = call.get('method') if isinstance(call, dict) else None
+        if isinstance(method, str) and method in BLOCK_METHODS:
+            return True
+    return False
+
+
+def _load_block():
+    """
+    Import targetd.block for a call of one of its methods on a host without
+    block pools, e.g. access_group_list.  If that fails the methods answer
+    with why, see _unloaded_block(), and it is only tried again after
+    reload_config().
+    """
+    global block_error
+    with reload_lock:
+        if block is not None or block_error is not None:
+            return
+        try:
+            configure_block(config, needed=True)()
+        except Exception as e:
+            log.error("Error initializing block module: %s" % e)
+            block_error = "%s: %s" % (type(e).__name__, e)
+
+
+def _unloaded_block(name):
+    """
+    Stand-in for block method name until targetd.block is imported, only
+    called if importing it failed, see rpc_execute().
+    """
+    @unlocked
+    def unloaded(req, **params):
+        raise TargetdError(TargetdError.NO_SUPPORT,
+                           "%s is not available, the block module failed "
+                           "to load: %s" % (name, block_error))
+
+    return unloaded
 
 
 def update_mapping():
     # wait until now so submodules can import 'main' safely
-    import targetd.block as block
-    import targetd.fs as fs
+    with startup.phase('imports'):
+        import targetd.fs as fs
 
-    try:
-        mapping.update(block.initialize(config))
-    except Exception as e:
-        log.error("Error initializing block module: %s" % e)
-        raise
+    with startup.phase('pool checks'):
+        try:
+            configure_block(config)()
+        except Exception as e:
+            log.error("Error initializing block module: %s" % e)
+            raise
+        if block is None:
+            mapping.update((name, _unloaded_block(name))
+                           for name in BLOCK_METHODS)
 
-    try:
-        mapping.update(fs.initialize(config))
-    except Exception as e:
-        log.error("Error initializing fs module: %s" % e)
-        raise
+        try:
+            mapping.update(fs.initialize(config))
+        except Exception as e:
+            log.error("Error initializing fs module: %s" % e)
+            raise
+
+    mapping.update(jobs.initialize(config))
+
+    configure_hooks.extend((configure_block, fs.configure))
 
     # one method requires output from both modules
+    @read_only
+    @locks()
     def pool_list(req):
-        return list(itertools.chain(block.block_pools(req), fs.fs_pools(req)))
+        block_pools = block.block_pools(req) if block else []
+        return list(itertools.chain(block_pools, fs.fs_pools(req)))
 
     mapping['pool_list'] = pool_list
 
+    @unlocked
+    def server_stats(req):
+        in_flight = requests_in_flight.values()
+        waits = queue_wait_seconds.values()
+        rejected = requests_rejected.values()
+        methods = dict()
+        for method in set(in_flight) | set(waits) | set(rejected):
+            wait = waits.get(method, dict(sum=0.0, count=0))
+            methods[method or "unknown"] = dict(
+                in_flight=in_flight.get(method, 0),
+                queued=wait['count'],
+                queue_wait_seconds=wait['sum'],
+                rejected=rejected.get(method, 0))
+        return dict(tarpit=tar.stats(), methods=methods,
+                    jobs=jobs.manager.stats())
+
+    mapping['server_stats'] = server_stats
+    mapping['debug_trace'] = debug_trace
+    mapping['lock_status'] = lock_status
+
 
 RUN = True
 
@@ -311,14 +1942,22 @@ def handler(signum, frame):
     if signum == signal.SIGINT:
         log.info("SIGINT received, shutting down ...")
         RUN = False
+    elif signum == signal.SIGHUP:
+        log.info("SIGHUP received, reloading %s ..." % default_config_path)
+        # Checking new pools takes a while, keep serving meanwhile
+        t = threading.Thread(target=reload_config, name="targetd-reload")
+        t.daemon = True
+        t.start()
 
 
 def main():
 
     signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGHUP, handler)
 
     try:
-        load_config(default_config_path)
+        with startup.phase('config'):
+            load_config(default_config_path)
     except AttributeError:
         return -1
 
@@ -342,7 +1981,46 @@ def main():
         server_class = HTTPService
         note = "(TLS no)"
 
-    server = server_class(('', 18700), TargetHandler)
+    if config['server_engine'] not in ('threading', 'asyncio'):
+        log.critical("unknown server_engine %s, expected threading or "
+                     "asyncio" % config['server_engine'])
+        return -1
+
+    lock_manager.watch(lambda: config['lock_stuck_seconds'])
+
+    unix_server = None
+    if config['unix_socket']:
+        unix_server = UnixHTTPService(config['unix_socket'],
+                                      UnixTargetHandler)
+        t = threading.Thread(target=unix_server.serve_forever,
+                             name="targetd-unix")
+        t.daemon = True
+        t.start()
+        log.info("serving unix socket %s", config['unix_socket'])
+
+    try:
+        serve(server_class, note)
+    finally:
+        if unix_server:
+            unix_server.shutdown()
+            unix_server.server_close()
+
+    return 0
+
+
+def serve(server_class, note):
+    if config['server_engine'] == 'asyncio':
+        ssl_context = None
+        if config['ssl']:
+            ssl_context = SSLContextCache().context
+        server = AsyncHTTPService(('', 18700), ssl_context)
+        log.info("started asyncio server %s", note)
+        server.serve_forever(lambda: RUN)
+        return
+
+    with startup.phase('bind'):
+        server = server_class(('', 18700), TargetHandler)
+    startup.finish()
     log.info("started server %s", note)
 
     server.timeout = 0.5
@@ -350,5 +2028,3 @@ def main():
         server.handle_request()
 
     server.socket.close()
-
-    return 0
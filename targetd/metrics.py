@@ -0,0 +1,226 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Measurements of targetd itself.  Every thread updates its own shard of a
+# metric, so recording takes no lock; reading merges the shards.  Once a
+# thread is gone its shard is folded into one kept for all of them.
+# expose() renders them in the Prometheus text format for GET /metrics.
+
+import bisect
+import threading
+import weakref
+
+
+def _labels(names, key):
+    """
+    Return the {label="value",...} text for a key, a string or a tuple of
+    strings lining up with names.
+    """
+    if not names:
+        return ''
+    values = key if isinstance(key, tuple) else (key,)
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+        for n, v in zip(names, values))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Owner(object):
+    """
+    Kept in a thread's local storage, so it goes away with the thread.
+    """
+    __slots__ = ('__weakref__',)
+
+
+class _Metric(object):
+
+    TYPE = 'untyped'
+
+    def __init__(self, name, doc, labels=('method',)):
+        self.name = name
+        self.doc = doc
+        # what the parts of a key are, see _labels()
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        # id() of the shard of each live thread to it
+        self._shards = dict()
+        # what the threads gone recorded
+        self._retired = dict()
+        # Only taken the first time a thread records to this metric, and
+        # when it is gone (which may happen while holding it, in any thread)
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = dict()
+            self._local.owner = _Owner()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            weakref.finalize(self._local.owner, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            del self._shards[id(shard)]
+            for k, v in shard.items():
+                self._add(self._retired, k, v)
+
+    def _add(self, into, key, value):
+        raise NotImplementedError
+
+    def _merged(self):
+        with self._lock:
+            # dict() copies in one step, so a shard can't change under us
+            return [dict(s) for s in list(self._shards.values())] + \
+                [dict(self._retired)]
+
+    def _head(self):
+        return ["# HELP %s %s" % (self.name, self.doc),
+                "# TYPE %s %s" % (self.name, self.TYPE)]
+
+
+class Counter(_Metric):
+    """
+    A number per key which only goes up (or down for a gauge).
+    """
+
+    TYPE = 'counter'
+
+    def inc(self, key, amount=1):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, key, amount=1):
+        self.inc(key, -amount)
+
+    def _add(self, into, key, value):
+        into[key] = into.get(key, 0) + value
+
+    def values(self):
+        rc = dict()
+        for shard in self._merged():
+            for k, v in shard.items():
+                rc[k] = rc.get(k, 0) + v
+        return rc
+
+    def expose(self):
+        return self._head() + [
+            "%s%s %s" % (self.name, _labels(self.labels, k), _number(v))
+            for k, v in sorted(self.values().items())]
+
+
+class Gauge(Counter):
+    """
+    Same thing, a gauge just also goes down.
+    """
+
+    TYPE = 'gauge'
+
+
+class Callback(Counter):
+    """
+    A gauge (or counter) read from fn() when exposed, which returns a dict
+    {key: value}.  For what targetd already counts elsewhere, under a lock.
+    """
+
+    def __init__(self, name, doc, fn, labels=(), kind='gauge'):
+        super(Callback, self).__init__(name, doc, labels)
+        self.fn = fn
+        self.TYPE = kind
+
+    def values(self):
+        return self.fn()
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (seconds) per key.
+    """
+
+    TYPE = 'histogram'
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+               10, 30, 60, 300)
+
+    def __init__(self, name, doc, labels=('method',), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, key, value):
+        shard = self._shard()
+        h = shard.get(key)
+        if h is None:
+            # bucket counts, then the overflow bucket, sum and count
+            h = shard[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        h[bisect.bisect_left(self.buckets, value)] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    def _add(self, into, key, value):
+        h = into.setdefault(key, [0] * len(value))
+        for i, v in enumerate(value):
+            h[i] += v
+
+    def values(self):
+        """
+        Return {key: dict(buckets=[cumulative counts], sum=, count=)}, the
+        bucket counts line up with self.buckets plus one for +Inf.
+        """
+        merged = dict()
+        for shard in self._merged():
+            for k, h in shard.items():
+                m = merged.setdefault(k, [0] * len(h))
+                for i, v in enumerate(list(h)):
+                    m[i] += v
+
+        rc = dict()
+        for k, m in merged.items():
+            cumulative = []
+            total = 0
+            for c in m[:-2]:
+                total += c
+                cumulative.append(total)
+            rc[k] = dict(buckets=cumulative, sum=m[-2], count=m[-1])
+        return rc
+
+    def expose(self):
+        lines = self._head()
+        for k, h in sorted(self.values().items()):
+            for le, count in zip(self.buckets + (float('inf'),),
+                                 h['buckets']):
+                key = (k if isinstance(k, tuple) else (k,)) + (_number(le),)
+                lines.append("%s_bucket%s %d" % (
+                    self.name, _labels(self.labels + ('le',), key), count))
+            labels = _labels(self.labels, k)
+            lines.append("%s_sum%s %s" % (self.name, labels,
+                                          _number(h['sum'])))
+            lines.append("%s_count%s %d" % (self.name, labels, h['count']))
+        return lines
+
+
+def expose(metrics):
+    """
+    Return the text of metrics in the Prometheus exposition format.
+    """
+    lines = []
+    for m in metrics:
+        lines.extend(m.expose())
+    return "\n".join(lines) + "\n"
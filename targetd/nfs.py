@@ -11,17 +11,104 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import ctypes
+import ctypes.util
 import os
 import os.path
 import re
 import shlex
+import struct
+import tempfile
 import logging as log
 
-from targetd.utils import invoke
+from targetd.utils import ignored, invoke
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Watch files and directories for changes with inotify(7), through libc.
+    A file is watched through its directory, so it is still watched once
+    replaced by a rename.  Raises OSError if that can't be done.
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+        IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, paths):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError("inotify not available: %s" % e)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Set once a watched directory is gone, we can't tell what changes
+        # from then on
+        self.lost = False
+        # watch descriptor to the names watched in its directory, None for
+        # all of them
+        self.watches = dict()
+        try:
+            for path in paths:
+                if os.path.isdir(path):
+                    directory, name = path, None
+                else:
+                    directory, name = os.path.split(path)
+                wd = libc.inotify_add_watch(
+                    self.fd, os.fsencode(directory or '.'), self.MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "can't watch %s" % directory)
+                names = self.watches.get(wd, set())
+                if name is None or names is None:
+                    self.watches[wd] = None
+                else:
+                    self.watches[wd] = names | {name}
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def changed(self):
+        """
+        Return True if any of the paths changed since the last call.
+        """
+        rc = self.lost
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return rc
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + size].rstrip(b'\0')
+                offset += size
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self.lost = True
+                names = self.watches.get(wd, ())
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF) \
+                        or names is None or os.fsdecode(name) in names:
+                    rc = True
 
 
 class Export(object):
 
+    __slots__ = ('host', 'path', 'options', 'key_value_options')
+
     SECURE = 0x00000001
     RW = 0x00000002
     RO = 0x00000004
@@ -83,6 +170,20 @@ class Export(object):
     export_regex = r"([\/a-zA-Z0-9\.\-_]+)[\s]+(.+)\((.+)\)"
     octal_nums_regex = r"""\\([0-7][0-7][0-7])"""
 
+    _export_pattern = re.compile(export_regex)
+    _octal_nums_pattern = re.compile(octal_nums_regex)
+    # The tokens shlex.split() finds in a line without quotes or escapes
+    _token_pattern = re.compile(r"[^ \t\r\n]+")
+    _shell_chars = frozenset('"\'\\')
+
+    # options bits to their names, in the order of bool_option, filled as
+    # they are asked for by options_list()
+    _option_names = dict()
+    # options strings to what _parse_opt() made of them, up to
+    # PARSED_OPTIONS, exportfs lists the same few over and over
+    _parsed_options = dict()
+    PARSED_OPTIONS = 1000
+
     @staticmethod
     def _validate_options(options):
         for e in Export._conflicting:
@@ -116,6 +217,17 @@ class Export(object):
 
     @staticmethod
     def _parse_opt(options_string):
+        parsed = Export._parsed_options.get(options_string)
+        if parsed is None:
+            parsed = Export._parse_opt_string(options_string)
+            if len(Export._parsed_options) >= Export.PARSED_OPTIONS:
+                Export._parsed_options.clear()
+            Export._parsed_options[options_string] = parsed
+        # The pairs end up in an Export, which must have its own
+        return parsed[0], dict(parsed[1])
+
+    @staticmethod
+    def _parse_opt_string(options_string):
         bits = 0
         pairs = {}
 
@@ -206,14 +318,24 @@ class Export(object):
 
         return rc
 
+    @staticmethod
+    def _tokens(line):
+        """
+        Split a line of an exports file as shlex.split(line, '#') does.
+        Without quotes or backslashes that is splitting what comes before
+        any # at whitespace, the rest still goes through shlex.
+        """
+        if Export._shell_chars.isdisjoint(line):
+            return Export._token_pattern.findall(line.partition('#')[0])
+        return shlex.split(Export._chr_encode(line), '#')
+
     @staticmethod
     def parse_exports_file(f):
         rc = []
 
         with open(f, "r") as e_f:
             for line in e_f:
-                exp = Export.parse_export(
-                    shlex.split(Export._chr_encode(line), '#'))
+                exp = Export.parse_export(Export._tokens(line))
                 if exp:
                     rc.extend(exp)
 
@@ -222,18 +344,23 @@ class Export(object):
     @staticmethod
     def parse_exportfs_output(export_text):
         rc = []
-        pattern = re.compile(Export.export_regex)
 
-        for m in re.finditer(pattern, export_text):
+        for m in Export._export_pattern.finditer(export_text):
             rc.append(
                 Export(m.group(2), m.group(1), *Export.parse_opt(m.group(3))))
         return rc
 
+    @staticmethod
+    def _names(options):
+        names = Export._option_names.get(options)
+        if names is None:
+            names = tuple(k for k, v in Export.bool_option.items()
+                          if options & v)
+            Export._option_names[options] = names
+        return names
+
     def options_list(self):
-        rc = []
-        for k, v in self.bool_option.items():
-            if self.options & v:
-                rc.append(k)
+        rc = list(Export._names(self.options))
 
         for k, v in self.key_value_options.items():
             rc.append('%s=%s' % (k, v))
@@ -261,9 +388,10 @@ class Export(object):
     def _chr_encode(s):
         # Replace octal values, the export path can contain \nnn in the
         # export name.
-        p = re.compile(Export.octal_nums_regex)
+        if '\\' not in s:
+            return s
 
-        for m in re.finditer(p, s):
+        for m in Export._octal_nums_pattern.finditer(s):
             s = s.replace('\\' + m.group(1), chr(int(m.group(1), 8)))
 
         return s
@@ -271,6 +399,88 @@ class Export(object):
     def __eq__(self, other):
         return self.path == other.path and self.host == other.host
 
+    def key(self):
+        return self.path, self.host
+
+
+class ExportTable(object):
+    """
+    The exports of the NFS server, as exportfs -v lists them, and those of
+    the main exports file, kept in memory.  They are only read again once
+    inotify reports a change to the exports files or the kernel's table
+    (etab) made by someone else, see ours().  Without inotify they are read
+    every time.  Only used holding the NFS lock.
+
+    The lines of targetd.exports are kept too, see file_lines().
+    """
+
+    def __init__(self):
+        # (path, host) to Export, None until read
+        self.exports = None
+        self.user_exports = None
+        # (path, host) to its line in targetd.exports, None until needed
+        self.lines = None
+        try:
+            self.watch = Inotify((Nfs.MAIN_EXPORT_FILE,
+                                  Nfs.EXPORT_FS_CONFIG_DIR, Nfs.ETAB))
+        except OSError as e:
+            log.warning("Not watching the NFS exports, reading them for "
+                        "every call: %s" % e)
+            self.watch = None
+
+    def _check(self):
+        if self.watch is None or self.watch.changed():
+            self.exports = None
+            self.user_exports = None
+            self.lines = None
+
+    def get(self):
+        """
+        Return the exports, {(path, host): Export} in exportfs order.
+        """
+        self._check()
+        if self.exports is None:
+            ec, out, error = invoke([Nfs.CMD, '-v'])
+            self.exports = dict((e.key(), e) for e in
+                                Export.parse_exportfs_output(out))
+        return self.exports
+
+    def user(self):
+        """
+        Return the (path, host) of the exports in the main exports file, as
+        of the last get().
+        """
+        if self.user_exports is None:
+            self.user_exports = set(
+                e.key() for e in
+                Export.parse_exports_file(Nfs.MAIN_EXPORT_FILE))
+        return self.user_exports
+
+    def file_lines(self):
+        """
+        Return the lines of targetd.exports by (path, host), to be changed
+        along with the exports.  At first, and after changes made by others,
+        they are those of all the exports which aren't in the main exports
+        file, as of the last get().
+        """
+        if self.lines is None:
+            user_exports = self.user()
+            self.lines = dict((k, e.export_file_format())
+                              for k, e in self.exports.items()
+                              if k not in user_exports)
+        return self.lines
+
+    def ours(self, reload=False):
+        """
+        Forget the change events caused by a change we just made, which the
+        table already reflects unless reload is set.  Changes made by others
+        at the same time are missed.
+        """
+        if self.watch is not None:
+            self.watch.changed()
+        if reload:
+            self.exports = None
+
 
 class Nfs(object):
     """
@@ -280,37 +490,58 @@ class Nfs(object):
     EXPORT_FILE = 'targetd.exports'
     EXPORT_FS_CONFIG_DIR = os.getenv("TARGETD_NFS_EXPORT_DIR", '/etc/exports.d')
     MAIN_EXPORT_FILE = os.getenv("TARGETD_NFS_EXPORT", '/etc/exports')
+    ETAB = os.getenv("TARGETD_NFS_ETAB", '/var/lib/nfs/etab')
+
+    # The ExportTable, created when first needed
+    table = None
+
+    @staticmethod
+    def _table():
+        if Nfs.table is None:
+            Nfs.table = ExportTable()
+        return Nfs.table
 
     @staticmethod
     def security_options():
         return "sys", "krb5", "krb5i", "krb5p"
 
     @staticmethod
-    def _save_exports():
-        # Remove existing export
+    def _save_exports(lines):
+        """
+        Replace targetd.exports with lines.  They are written to a temporary
+        file, synced and renamed over it, so it is never missing or partly
+        written, even after a crash.
+        """
         config_file = os.path.join(Nfs.EXPORT_FS_CONFIG_DIR, Nfs.EXPORT_FILE)
+        # Not named *.exports, which exportfs would read
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % Nfs.EXPORT_FILE,
+                                   suffix='.tmp',
+                                   dir=Nfs.EXPORT_FS_CONFIG_DIR)
         try:
-            os.remove(config_file)
-        except OSError:
-            pass
-
-        # Get exports in /etc/exports
-        user_exports = Export.parse_exports_file(Nfs.MAIN_EXPORT_FILE)
-
-        # Recreate all existing exports
-        with open(config_file, 'w') as ef:
-            for e in Nfs.exports():
-                if e not in user_exports:
-                    ef.write(e.export_file_format())
+            with os.fdopen(fd, 'w') as ef:
+                ef.write(''.join(lines))
+                ef.flush()
+                os.fchmod(ef.fileno(), 0o644)
+                os.fsync(ef.fileno())
+            os.rename(tmp, config_file)
+        except BaseException:
+            with ignored(OSError):
+                os.remove(tmp)
+            raise
+
+        # Make the rename itself durable
+        dir_fd = os.open(Nfs.EXPORT_FS_CONFIG_DIR, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     @staticmethod
     def exports():
         """
         Return list of exports
         """
-        ec, out, error = invoke([Nfs.CMD, '-v'])
-        rc = Export.parse_exportfs_output(out)
-        return rc
+        return list(Nfs._table().get().values())
 
     @staticmethod
     def export_add(host, path, bit_wise_options, key_value_options):
@@ -319,6 +550,9 @@ class Nfs(object):
         """
         export = Export(host, path, bit_wise_options, key_value_options)
         options = export.options_string()
+        table = Nfs._table()
+        table.get()
+        lines = table.file_lines()
 
         cmd = [Nfs.CMD]
 
@@ -329,7 +563,11 @@ class Nfs(object):
 
         ec, out, err = invoke(cmd, False)
         if ec == 0:
-            Nfs._save_exports()
+            if export.key() not in table.user():
+                lines[export.key()] = export.export_file_format()
+                Nfs._save_exports(lines.values())
+            # Read again when next needed, for the options exportfs adds
+            table.ours(reload=True)
             return None
         elif ec == 22:
             raise ValueError("Invalid option: %s" % err)
@@ -339,9 +577,59 @@ class Nfs(object):
 
     @staticmethod
     def export_remove(export):
+        table = Nfs._table()
+        exports = table.get()
+        lines = table.file_lines()
         ec, out, err = invoke(
             [Nfs.CMD, '-u',
              '%s:%s' % (export.host, export.path)])
 
         if ec == 0:
-            Nfs._save_exports()
+            exports.pop(export.key(), None)
+            if lines.pop(export.key(), None) is not None:
+                Nfs._save_exports(lines.values())
+            table.ours()
+
+    @staticmethod
+    def main_exports():
+        """
+        Return the (path, host) keys of the exports in the main exports file.
+        """
+        return Nfs._table().user()
+
+    @staticmethod
+    def export_update(add=(), remove=()):
+        """
+        Add the Exports in add and remove the exports with the (path, host)
+        keys in remove, writing targetd.exports once and applying it with
+        one exportfs -r.  None of them may be in the main exports file, see
+        main_exports(), exportfs -r would put those back as they are there.
+        Returns the keys of those which were exported before.
+        """
+        table = Nfs._table()
+        exports = table.get()
+        lines = table.file_lines()
+        before = dict(lines)
+        existed = set(k for k in [e.key() for e in add] + list(remove)
+                      if k in exports)
+
+        for key in remove:
+            lines.pop(key, None)
+        for e in add:
+            lines[e.key()] = e.export_file_format()
+        Nfs._save_exports(lines.values())
+
+        cmd = [Nfs.CMD, '-r']
+        ec, out, err = invoke(cmd, False)
+        if ec != 0:
+            # Back to the exports we had, as far as exportfs lets us
+            lines.clear()
+            lines.update(before)
+            Nfs._save_exports(lines.values())
+            invoke(cmd, False)
+        # Read again when next needed, for what exportfs made of them
+        table.ours(reload=True)
+        if ec != 0:
+            raise RuntimeError('Unexpected exit code "%s" %s, out= %s' %
+                               (str(cmd), str(ec), str(out + ":" + err)))
+        return existed
@@ -15,10 +15,25 @@
 #
 # Utility functions.
 
+import base64
+import heapq
+import importlib
+import itertools
+import json
+import logging as log
+import os
 import re
+import sys
+import time
+import traceback
+import uuid
+from collections import deque
 from contextlib import contextmanager
-from subprocess import Popen, PIPE
-from threading import Lock
+from subprocess import Popen, PIPE, TimeoutExpired
+from threading import (Condition, Event, Lock, Thread, current_thread,
+                       get_ident, local)
+
+from targetd import metrics
 
 
 @contextmanager
@@ -64,28 +79,847 @@ class TargetdError(Exception):
     NOT_FOUND_NFS_EXPORT = -400
     NFS_NO_SUPPORT = -401
 
+    # Specific to jobs
+    NOT_FOUND_JOB = -500
+    JOB_LIMIT = -501
+
+    # Deadlines, see call_context()
+    TIMEOUT = -600
+    CANCELLED = -601
+
     def __init__(self, error_code, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
         self.error = error_code
 
 
-def invoke(cmd, raise_exception=True):
+# Seconds between checks whether a running command has been cancelled
+CANCEL_POLL = 0.5
+
+_calls = local()
+
+command_seconds = metrics.Histogram(
+    "targetd_command_seconds", "Run time of the commands executed",
+    labels=('command',))
+library_call_seconds = metrics.Histogram(
+    "targetd_library_call_seconds",
+    "Run time of the library calls made through bounded()",
+    labels=('function',))
+
+# The last commands run and library calls made, see traced().  Appending
+# to a deque is atomic, no lock needed.
+TRACE_BUFFER = 1000
+traces = deque(maxlen=TRACE_BUFFER)
+
+
+class CallContext(object):
     """
-    Exec a command returning a tuple (exit code, stdout, stderr) and optionally
-    throwing an exception on non-zero exit code.
+    The deadline of the call running on this thread and the events which
+    cancel it.  orphans holds an Event per library call left running in
+    the background when the call gave up on it, see bounded().  traces
+    holds what the request (request_id) ran, call by call (method).
+    """
+
+    def __init__(self, deadline, cancel, orphans, request_id=None,
+                 method=None, traces=None):
+        self.deadline = deadline
+        self.cancel = cancel
+        self.orphans = orphans
+        self.request_id = request_id
+        self.method = method
+        self.traces = traces
+
+    def remaining(self):
+        if any(e.is_set() for e in self.cancel):
+            raise TargetdError(TargetdError.CANCELLED, "Call cancelled")
+        if self.deadline is None:
+            return None
+        left = self.deadline - time.monotonic()
+        if left <= 0:
+            raise TargetdError(TargetdError.TIMEOUT, "Call timed out")
+        return left
+
+
+@contextmanager
+def call_context(timeout=None, cancel=None, request_id=None, method=None):
+    """
+    Run the body with a deadline timeout seconds from now and/or cancelled
+    by the Event cancel, on top of the ones of the enclosing call_context().
+    Commands run by execute(), sleep() and bounded() give up once either is
+    reached, with TargetdError.TIMEOUT or CANCELLED.  They are traced as
+    part of request_id and method, by default the enclosing ones.
+    """
+    outer = getattr(_calls, 'context', None)
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    if outer is not None:
+        if outer.deadline is not None:
+            deadline = outer.deadline if deadline is None \
+                else min(deadline, outer.deadline)
+        events = list(outer.cancel)
+        orphans = outer.orphans
+        request_id = request_id or outer.request_id
+        method = method or outer.method
+        call_traces = outer.traces
+    else:
+        events = []
+        orphans = []
+        call_traces = []
+    if cancel is not None:
+        events.append(cancel)
+
+    _calls.context = CallContext(deadline, events, orphans,
+                                 request_id or uuid.uuid4().hex, method,
+                                 call_traces)
+    try:
+        yield _calls.context
+    finally:
+        _calls.context = outer
+
+
+@contextmanager
+def resumed(ctx):
+    """
+    Run the body in the CallContext ctx a call_context() yielded, again,
+    possibly on another thread.
+    """
+    outer = getattr(_calls, 'context', None)
+    _calls.context = ctx
+    try:
+        yield ctx
+    finally:
+        _calls.context = outer
+
+
+def remaining():
+    """
+    Seconds left until the deadline of the current call, None if it has
+    none.  Raises once it has passed or the call has been cancelled.
+    """
+    ctx = getattr(_calls, 'context', None)
+    return None if ctx is None else ctx.remaining()
+
+
+def sleep(seconds):
+    """
+    time.sleep() which raises as soon as the current call is cancelled or
+    its deadline passes.
+    """
+    end = time.monotonic() + seconds
+    while True:
+        left = remaining()
+        step = end - time.monotonic()
+        if step <= 0:
+            return
+        step = min(step, CANCEL_POLL)
+        if left is not None:
+            step = min(step, left)
+        time.sleep(step)
+
+
+def traced(ctx, kind, argv, started, seconds, **kwargs):
+    """
+    Record a command (kind "command") or library call ("library") made on
+    behalf of the call ctx (a CallContext or None), see traces.
+    """
+    rc = dict(kind=kind, argv=list(argv), started=started, seconds=seconds,
+              request_id=None, method=None, **kwargs)
+    if ctx is not None:
+        rc['request_id'] = ctx.request_id
+        rc['method'] = ctx.method
+        ctx.traces.append(rc)
+    traces.append(rc)
+
+
+def execute(cmd, retry=0):
     """
+    Run a command returning a tuple (exit code, stdout, stderr) as bytes.
+    The command is killed if it outlasts the deadline of the current call
+    or the call is cancelled, see call_context().  retry counts the previous
+    attempts of the same command, for its trace.
+    """
+    start = time.monotonic()
+    started = time.time()
+    out = err = b''
     c = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    out = c.communicate()
+    try:
+        while True:
+            try:
+                left = remaining()
+            except TargetdError as e:
+                c.kill()
+                out, err = c.communicate()
+                log.error("Killed %s: %s" % (cmd, e))
+                raise TargetdError(e.error, "%s: %s" % (e, " ".join(cmd)))
+            wait = CANCEL_POLL if left is None else min(left, CANCEL_POLL)
+            try:
+                out, err = c.communicate(timeout=wait)
+                return c.returncode, out, err
+            except TimeoutExpired:
+                continue
+    finally:
+        seconds = time.monotonic() - start
+        command_seconds.observe(os.path.basename(cmd[0]), seconds)
+        traced(getattr(_calls, 'context', None), "command", cmd, started,
+               seconds, exit_code=c.returncode, retry=retry,
+               stdout_bytes=len(out), stderr_bytes=len(err))
+
+
+def bounded(fn, *args, **kwargs):
+    """
+    Call fn, which can't be interrupted (a library call), giving up on it
+    when the current call's deadline passes or it is cancelled.  It then
+    keeps running in the background and the locks of the call stay held
+    until it returns, see LockManager.locked().
+    """
+    name = getattr(fn, '__name__', str(fn))
+    ctx = getattr(_calls, 'context', None)
+
+    def timed():
+        start = time.monotonic()
+        started = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            seconds = time.monotonic() - start
+            library_call_seconds.observe(name, seconds)
+            traced(ctx, "library", [name] + [str(a) for a in args], started,
+                   seconds)
+
+    if ctx is None or (ctx.deadline is None and not ctx.cancel):
+        return timed()
+
+    done = Event()
+    rc = {}
+
+    def run():
+        try:
+            rc['result'] = timed()
+        except BaseException as e:
+            rc['error'] = e
+        finally:
+            done.set()
+
+    Thread(target=run, name="bounded", daemon=True).start()
+    while not done.is_set():
+        try:
+            left = ctx.remaining()
+        except TargetdError:
+            log.error("Gave up waiting for %s" % name)
+            ctx.orphans.append(done)
+            raise
+        done.wait(CANCEL_POLL if left is None else min(left, CANCEL_POLL))
+    if 'error' in rc:
+        raise rc['error']
+    return rc['result']
+
+
+def invoke(cmd, raise_exception=True, retry=0):
+    """
+    Exec a command returning a tuple (exit code, stdout, stderr) and optionally
+    throwing an exception on non-zero exit code.  See execute() for how long
+    it may run and retry.
+    """
+    returncode, out, err = execute(cmd, retry)
 
     if raise_exception:
-        if c.returncode != 0:
+        if returncode != 0:
             cmd_str = str(cmd)
             raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
                                'Unexpected exit code "%s" %s, out= %s' %
-                               (cmd_str, str(c.returncode),
-                                str(out[0] + out[1])))
+                               (cmd_str, str(returncode), str(out + err)))
+
+    return returncode, out.decode('utf-8'), err.decode('utf-8')
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(
+        json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(key, list):
+            return tuple(key)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                       "Invalid cursor %s" % cursor)
+
+
+def paginate(items, key, limit=None, cursor=None, fn=None):
+    """
+    Page through items ordered by key (a function returning a tuple which
+    is unique per item).  Without limit and cursor all the items are
+    returned as a list in their original order, as before paging existed.
+    Otherwise returns dict(items=[up to limit items after cursor],
+    next_cursor=...), next_cursor being None on the last page.  fn, if
+    given, turns each item returned into its result, so expensive details
+    are only looked up for the items on the page.
+    """
+    fn = fn or (lambda x: x)
+    if limit is None and cursor is None:
+        return [fn(i) for i in items]
+
+    if limit is not None and (type(limit) is not int or limit < 1):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "limit must be a positive integer")
+
+    if cursor is not None:
+        after = _decode_cursor(cursor)
+        try:
+            items = [i for i in items if key(i) > after]
+        except TypeError:
+            raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                               "Invalid cursor %s" % cursor)
+
+    if limit is None:
+        page = sorted(items, key=key)
+        next_cursor = None
+    else:
+        # One more than asked for tells us whether there is a next page
+        page = heapq.nsmallest(limit + 1, items, key=key)
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = _encode_cursor(key(page[-1]))
+
+    return dict(items=[fn(i) for i in page], next_cursor=next_cursor)
+
+
+def prefixed(name, prefix):
+    """
+    True if no prefix is given or name starts with it.
+    """
+    return prefix is None or name.startswith(prefix)
+
+
+class RWLock(object):
+    """
+    A lock which can be held shared by many threads or exclusively by one.
+    Waiting exclusive holders keep new shared holders out, so they can't be
+    starved.
+    """
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.shared = 0
+        self.exclusive = False
+        self.exclusive_waiting = 0
+
+    def acquire_shared(self, blocking=True):
+        with self.cond:
+            while self.exclusive or self.exclusive_waiting:
+                if not blocking:
+                    return False
+                self.cond.wait()
+            self.shared += 1
+            return True
+
+    def release_shared(self):
+        with self.cond:
+            self.shared -= 1
+            if not self.shared:
+                self.cond.notify_all()
+
+    def acquire_exclusive(self, blocking=True):
+        with self.cond:
+            if not blocking and (self.exclusive or self.shared):
+                return False
+            self.exclusive_waiting += 1
+            while self.exclusive or self.shared:
+                self.cond.wait()
+            self.exclusive_waiting -= 1
+            self.exclusive = True
+            return True
+
+    def release_exclusive(self):
+        with self.cond:
+            self.exclusive = False
+            self.cond.notify_all()
+
+
+# Seconds between the checks of LockManager.watch()
+WATCHDOG_POLL = 5
+
+# Results kept by Snapshots
+SNAPSHOTS = 1000
+
+# Stale snapshots read again after writes, at most, see Snapshots.committed()
+SNAPSHOT_REREADS = 8
+
+
+class LockManager(object):
+    """
+    Serializes work per resource (a pool, the LIO target, an exports file)
+    instead of globally.  Calls holding different keys run concurrently,
+    calls sharing a key run one at a time.  Passing None instead of keys
+    locks every resource.
+
+    Keys are always taken in sorted order, so callers asking for several
+    keys can't deadlock each other.
+
+    Who holds and who waits for which keys is kept for status() and
+    stuck(), see watch().  Writers bump the generation of their keys as
+    they release them, see generation(), and call on_write.
+    """
+
+    def __init__(self, wait_seconds=None, hold_seconds=None):
+        self.lock = Lock()
+        self.locks = dict()
+        # Held shared along with any keys, exclusively for None
+        self.all = RWLock()
+        # Histograms of the time locked() callers wait and hold, by name
+        self.wait_seconds = wait_seconds
+        self.hold_seconds = hold_seconds
+        # id to a dict describing the caller, in the order they came, under
+        # self.lock
+        self.ids = itertools.count()
+        self.waiters = dict()
+        self.holders = dict()
+        # Bumped by the writes done with a key, with None and with any keys,
+        # under self.lock
+        self.generations = dict()
+        self.all_generation = 0
+        self.write_generation = 0
+        # Called with the keys (a frozenset, or None) of each write as it is
+        # done, its locks still held
+        self.on_write = []
 
-    return c.returncode, out[0].decode('utf-8'), out[1].decode('utf-8')
+    def _key_lock(self, key):
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = Lock()
+            return self.locks[key]
+
+    def invalidate(self, keys=None):
+        """
+        Count a write to keys (None for every resource), see generation().
+        """
+        with self.lock:
+            self.write_generation += 1
+            if keys is None:
+                self.all_generation += 1
+            else:
+                for key in keys:
+                    self.generations[key] = self.generations.get(key, 0) + 1
+
+    def generation(self, keys):
+        """
+        Return a tuple which changes whenever a write to keys is done, or
+        to any resource if keys is None or empty.
+        """
+        with self.lock:
+            if not keys:
+                return (self.write_generation,)
+            return (self.all_generation,) + \
+                tuple(self.generations.get(k, 0) for k in sorted(keys))
+
+    @contextmanager
+    def locked(self, keys, orphans=None, name=None, write=True, wait=True):
+        """
+        Hold the locks of keys (None for all of them) for the body.  If
+        orphans (Events, see bounded()) are still unset afterwards the locks
+        are released by a background thread once they are set.  The time
+        spent waiting for and holding them is recorded under name.  Unless
+        write is False or keys is empty, the generation of keys is bumped
+        before they are released.  Yields True, or False without holding anything if wait
+        is False and one of the locks is held already.
+        """
+        if keys is not None:
+            # callers pass lists too, the on_write hooks get sets
+            keys = frozenset(keys)
+        start = time.monotonic()
+        held = []
+        me = dict(method=name, keys=None if keys is None else sorted(keys),
+                  thread=current_thread().name, ident=get_ident(),
+                  since=start, waiting_for='all', reported=False)
+        token = next(self.ids)
+        with self.lock:
+            self.waiters[token] = me
+        try:
+            if keys is None:
+                got = self.all.acquire_exclusive(wait)
+                release_all = self.all.release_exclusive
+            else:
+                got = self.all.acquire_shared(wait)
+                release_all = self.all.release_shared
+        except BaseException:
+            with self.lock:
+                del self.waiters[token]
+            raise
+        if not got:
+            with self.lock:
+                del self.waiters[token]
+            yield False
+            return
+        acquired = None
+        try:
+            for key in sorted(set(keys or ())):
+                lock = self._key_lock(key)
+                me['waiting_for'] = key
+                if not lock.acquire(wait):
+                    break
+                held.append(lock)
+            else:
+                acquired = time.monotonic()
+                with self.lock:
+                    del self.waiters[token]
+                    me['since'] = acquired
+                    me['waiting_for'] = None
+                    self.holders[token] = me
+                if self.wait_seconds is not None:
+                    self.wait_seconds.observe(name, acquired - start)
+            yield acquired is not None
+        finally:
+            def release():
+                # Calls locking no resource can't have changed any
+                if write and acquired is not None and \
+                        (keys is None or keys):
+                    self.invalidate(keys)
+                    for fn in self.on_write:
+                        try:
+                            fn(keys)
+                        except Exception:
+                            log.error(traceback.format_exc())
+                for lock in reversed(held):
+                    lock.release()
+                release_all()
+                with self.lock:
+                    self.waiters.pop(token, None)
+                    self.holders.pop(token, None)
+                if self.hold_seconds is not None and acquired is not None:
+                    self.hold_seconds.observe(name,
+                                              time.monotonic() - acquired)
+
+            pending = [e for e in orphans or () if not e.is_set()]
+            if pending:
+                log.warning("Locks %s stay held until abandoned calls "
+                            "return" % sorted(keys or ['all']))
+                Thread(target=_release_after, args=(pending, release),
+                       name="release", daemon=True).start()
+            else:
+                release()
+
+    def status(self):
+        """
+        Return dict(holders=[...], waiters=[...]), the callers of locked()
+        holding their locks and those waiting for them in the order they
+        came, with how long they have been (seconds) and the key each waiter
+        is waiting for ("all" for the lock of every resource).
+        """
+        now = time.monotonic()
+        with self.lock:
+            entries = dict(holders=list(self.holders.values()),
+                           waiters=list(self.waiters.values()))
+        rc = dict()
+        for kind, callers in entries.items():
+            rc[kind] = [dict(method=c['method'], keys=c['keys'],
+                             thread=c['thread'],
+                             seconds=now - c['since'])
+                        for c in callers]
+        for w, c in zip(rc['waiters'], entries['waiters']):
+            w['waiting_for'] = c['waiting_for']
+        return rc
+
+    def stuck(self, threshold):
+        """
+        Log the Python stack of each caller which has held its locks for
+        longer than threshold seconds, once per caller.  Returns their
+        methods.
+        """
+        now = time.monotonic()
+        with self.lock:
+            stuck = [c for c in self.holders.values()
+                     if not c['reported'] and now - c['since'] > threshold]
+            for c in stuck:
+                c['reported'] = True
+        frames = sys._current_frames()
+        for c in stuck:
+            frame = frames.get(c['ident'])
+            stack = ''.join(traceback.format_stack(frame)) if frame \
+                else "  (thread has exited)\n"
+            log.warning("%s (thread %s) has held locks %s for %.1f s:\n%s" %
+                        (c['method'], c['thread'], c['keys'] or ['all'],
+                         now - c['since'], stack))
+        return [c['method'] for c in stuck]
+
+    def watch(self, threshold, interval=WATCHDOG_POLL):
+        """
+        Check for stuck() callers every interval seconds on a thread of its
+        own.  threshold() returns the seconds after which a caller counts as
+        stuck, or None not to check.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                seconds = threshold()
+                if seconds is not None:
+                    self.stuck(seconds)
+
+        Thread(target=run, name="lock-watchdog", daemon=True).start()
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs a function at most once at a time per key: callers asking for a
+    key already being run wait for that run and share its result (or
+    exception) instead of running it again.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = dict()
+
+    def do(self, key, fn, timeout=None, waiting=None):
+        """
+        Return (fn(), shared), shared being True if the result came from a
+        run started by another caller.  Such a caller waits in the context
+        manager waiting, if given, and for up to timeout seconds before
+        giving up with TargetdError.TIMEOUT.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if not leader:
+            with waiting if waiting is not None else ignored():
+                if not flight.done.wait(timeout):
+                    raise TargetdError(TargetdError.TIMEOUT,
+                                       "Call timed out")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class Snapshots(object):
+    """
+    The results of read only calls, by method and params, as immutable
+    values.  Each is served until a write to the lock keys it was read
+    under is done (see LockManager.generation()) or it is ttl seconds old,
+    whichever comes first.  Up to size of them are kept.  Up to rereads of
+    those a write makes stale are read again in the background, see
+    committed().
+    """
+
+    def __init__(self, manager, size=SNAPSHOTS, rereads=SNAPSHOT_REREADS):
+        self.manager = manager
+        self.size = size
+        self.rereads = rereads
+        self.lock = Lock()
+        # key to (generation, time taken, value, lock keys, ttl, reread),
+        # oldest first
+        self.entries = dict()
+        # keys of the entries to read again, oldest first, and whether a
+        # thread is at it, under self.lock
+        self.pending = dict()
+        self.rereading = False
+        manager.on_write.append(self.committed)
+
+    def get(self, key, keys, ttl=None):
+        """
+        Return the value kept for key if no write to keys was done since and
+        it is at most ttl seconds old (any age for None), else None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        generation, taken, value = entry[:3]
+        if ttl is not None and time.monotonic() - taken > ttl or \
+                generation != self.manager.generation(keys):
+            return None
+        return value
+
+    def put(self, key, generation, value, keys=None, ttl=None, reread=None):
+        """
+        Keep value for key, generation being the one of its keys when it
+        was read, under their locks.  If it is read again by reread() the
+        writes to keys done while it is at most ttl seconds old make the
+        new value current, see committed().
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, time.monotonic(), value, keys,
+                                 ttl, reread)
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+
+    def committed(self, keys):
+        """
+        Have the latest values a write to keys (None for every resource)
+        made stale read again by a background thread, so the calls which
+        follow are answered with what the write did without waiting for the
+        next write.  The writer doesn't wait for them.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for k, e in self.entries.items():
+                if e[5] is not None and now - e[1] <= e[4] and \
+                        (keys is None or not e[3] or e[3] & keys):
+                    self.pending.pop(k, None)
+                    self.pending[k] = None
+            while len(self.pending) > self.rereads:
+                del self.pending[next(iter(self.pending))]
+            start = self.pending and not self.rereading
+            if start:
+                self.rereading = True
+        if start:
+            Thread(target=self._reread_pending, name="reread",
+                   daemon=True).start()
+
+    def _reread_pending(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.rereading = False
+                    return
+                key = next(iter(self.pending))
+                del self.pending[key]
+                entry = self.entries.get(key)
+            if entry is None:
+                continue
+            generation, _, _, keys, ttl, reread = entry
+            try:
+                with self.manager.locked(keys, name="reread", write=False):
+                    current = self.manager.generation(keys)
+                    # else a call read it again already
+                    value = reread() if current != generation else None
+            except Exception:
+                log.error(traceback.format_exc())
+                continue
+            if value is not None:
+                self.put(key, current, value, keys, ttl, reread)
+
+
+def _release_after(events, release):
+    for e in events:
+        e.wait()
+    release()
+
+
+def locks(*keys):
+    """
+    Declare the resources a RPC method works on, see LockManager.  Each key
+    is a string or a function taking the call's params (a dict) and
+    returning a key or a list of keys.  Methods which don't declare their
+    keys lock every resource.
+    """
+
+    def decorate(fn):
+        fn.lock_keys = keys
+        return fn
+
+    return decorate
+
+
+def read_only(fn):
+    """
+    Mark a RPC method which only looks things up.  Identical calls of it
+    running at the same time can share one result, see SingleFlight, and
+    it may be answered from a snapshot, see Snapshots.
+    """
+    fn.read_only = True
+    return fn
+
+
+def unlocked(fn):
+    """
+    Declare a RPC method which takes no locks at all, not even waiting for
+    those of every resource, to look into targetd while other calls are
+    stuck holding them.  It must not touch any resource.
+    """
+    fn.lock_keys = ()
+    fn.unlocked = True
+    return fn
+
+
+def pool_lock(param='pool'):
+    """
+    Lock key of the pool named by the call's param.
+    """
+    return lambda params: 'pool:%s' % params[param]
+
+
+def lock_keys(fn, params):
+    """
+    Return the set of lock keys for calling fn with params, or None if
+    every resource needs to be locked, as fn declares no keys.  Raises
+    INVALID_ARGUMENT if the keys it declares can't be had from params.
+    """
+    specs = getattr(fn, 'lock_keys', None)
+    if specs is None:
+        return None
+
+    keys = set()
+    try:
+        for spec in specs:
+            if callable(spec):
+                key = spec(params or {})
+                if isinstance(key, (list, tuple, set)):
+                    keys.update(key)
+                else:
+                    keys.add(key)
+            else:
+                keys.add(spec)
+    except (KeyError, TypeError):
+        # Not locking everything, which would hold up calls on every other
+        # resource until those running on the one it may be about are done
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "invalid method arguments(s)")
+    return keys
+
+
+class Batch(object):
+    """
+    Work deferred until all the calls of a JSON-RPC batch have run, each
+    function is run once no matter how many calls deferred it.
+    """
+
+    def __init__(self):
+        self.pending = dict()
+
+    def defer(self, fn):
+        self.pending[fn] = True
+
+    def commit(self):
+        pending = list(self.pending)
+        self.pending.clear()
+        for fn in pending:
+            fn()
+
+
+def defer(req, fn):
+    """
+    Run fn now, or once at the end of the batch req is part of.
+    """
+    batch = getattr(req, 'batch', None)
+    if batch is None:
+        fn()
+    else:
+        batch.defer(fn)
 
 
 class Pit(object):
@@ -97,32 +931,159 @@ class Pit(object):
     def __enter__(self):
         self.tar.lock.acquire()
         try:
-            self.tar.client[self.client_id] = True
+            self.tar._hold(self.client_id)
         finally:
             self.tar.lock.release()
 
     def __exit__(self, e_type, e_value, e_traceback):
         self.tar.lock.acquire()
         try:
-            del self.tar.client[self.client_id]
+            self.tar._unhold(self.client_id)
         finally:
             self.tar.lock.release()
 
 
 class Tar(object):
+    """
+    Tracks clients serving a delay for a failed authentication.  Delays are
+    served either by the caller, see pitted(), or by the tarpit's own timer
+    thread, see delay(), which frees the caller right away.
+    """
 
     def __init__(self):
         self.lock = Lock()
         self.client = dict()
+        # heap of (due time, sequence, client id, function)
+        self.pending = []
+        self.sequence = itertools.count()
+        self.wakeup = Condition(self.lock)
+        self.thread = None
+        # counters, see stats()
+        self.pitted_count = 0
+        self.rejected_count = 0
 
     def is_stuck(self, client_id):
         self.lock.acquire()
         try:
             if client_id in self.client:
+                self.rejected_count += 1
                 return True
         finally:
             self.lock.release()
         return False
 
     def pitted(self, client_id):
-        return Pit(self, client_id)
\ No newline at end of file
+        return Pit(self, client_id)
+
+    def _hold(self, client_id):
+        # Called with lock held, the same client can get in more than once
+        # when its requests race past is_stuck()
+        self.client[client_id] = self.client.get(client_id, 0) + 1
+        self.pitted_count += 1
+
+    def _unhold(self, client_id):
+        # Called with lock held
+        self.client[client_id] -= 1
+        if not self.client[client_id]:
+            del self.client[client_id]
+
+    def delay(self, client_id, seconds, fn):
+        """
+        Hold client_id in the tarpit for seconds, then call fn from the
+        tarpit's thread and release it.  Returns immediately.
+        """
+        with self.lock:
+            self._hold(client_id)
+            heapq.heappush(self.pending, (time.monotonic() + seconds,
+                                          next(self.sequence), client_id, fn))
+            if self.thread is None:
+                self.thread = Thread(target=self._release, name="tarpit")
+                self.thread.daemon = True
+                self.thread.start()
+            self.wakeup.notify()
+
+    def _release(self):
+        while True:
+            with self.lock:
+                while not self.pending or \
+                        self.pending[0][0] > time.monotonic():
+                    timeout = None
+                    if self.pending:
+                        timeout = self.pending[0][0] - time.monotonic()
+                    self.wakeup.wait(timeout)
+                due, seq, client_id, fn = heapq.heappop(self.pending)
+
+            try:
+                fn()
+            except Exception as e:
+                log.debug("tarpit release of %s: %s" % (client_id, e))
+            finally:
+                with self.lock:
+                    self._unhold(client_id)
+
+    def stats(self):
+        with self.lock:
+            return dict(pitted=self.pitted_count, rejected=self.rejected_count,
+                        held=len(self.client), pending=len(self.pending))
+
+
+class StartupProfile(object):
+    """
+    Wall time spent in each phase of starting up.  Phases nest, the time of
+    an inner phase isn't counted in the outer one.
+    """
+
+    PHASES = ('config', 'imports', 'pool checks', 'bind')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last = self.started
+        self.times = dict.fromkeys(StartupProfile.PHASES, 0.0)
+        self.stack = []
+        self.finished = None
+
+    def _account(self):
+        now = time.monotonic()
+        if self.stack:
+            self.times[self.stack[-1]] += now - self.last
+        self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        if self.finished is not None:
+            # Started already, e.g. a backend imported by reload_config()
+            yield
+            return
+        self._account()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self._account()
+            self.stack.pop()
+
+    def finish(self):
+        """
+        Log the phase times once the server is listening and return them,
+        with 'total' since targetd's modules were loaded.
+        """
+        if self.finished is None:
+            self.finished = dict(self.times,
+                                 total=time.monotonic() - self.started)
+            log.info("Started in %.3fs (%s)" % (
+                self.finished['total'],
+                ", ".join("%s %.3fs" % (p, self.times[p])
+                          for p in StartupProfile.PHASES)))
+        return self.finished
+
+
+startup = StartupProfile()
+
+
+def import_backend(name):
+    """
+    Import targetd.backends.<name>, done once a pool needs it so hosts
+    without such pools don't pay for loading it (libblockdev for lvm).
+    """
+    with startup.phase('imports'):
+        return importlib.import_module('targetd.backends.%s' % name)
@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+#
+# Benchmarks for targetd, run against the daemon configured the same way as
+# for targetd_test.py (see testlib.py for the TARGETD_UT_* environment).
+# The streaming, unix_socket and thundering_herd benchmarks run their own
+# server in-process instead, the nfs ones a fake exportfs and exports_parser
+# needs neither.
+#
+# test/targetd_bench.py [benchmark ...]
+
+import base64
+import http.client
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from requests.auth import HTTPBasicAuth
+
+from test import testlib
+
+
+def _url():
+    return "%s://%s:%s%s" % (testlib.proto, testlib.host, testlib.port,
+                             testlib.rpc_path)
+
+
+def _payload(method, params=None):
+    return json.dumps(dict(id=1, method=method, params=params,
+                           jsonrpc="2.0")).encode('utf-8')
+
+
+def _rate(label, calls, seconds):
+    print("%-40s %8d calls %8.3f s %10.1f calls/s" %
+          (label, calls, seconds, calls / seconds))
+
+
+def bench_keepalive(calls=500, method="pool_list"):
+    """
+    Calls per second with a new connection (and TLS handshake) per call
+    versus one persistent connection.
+    """
+    auth = HTTPBasicAuth(testlib.user, testlib.password)
+    data = _payload(method)
+
+    start = time.time()
+    for _ in range(calls):
+        r = requests.post(_url(), data=data, auth=auth,
+                          verify=testlib.cert_file,
+                          headers={'Connection': 'close'})
+        assert r.status_code == 200
+    _rate("%s fresh connections" % method, calls, time.time() - start)
+
+    with requests.Session() as s:
+        start = time.time()
+        for _ in range(calls):
+            r = s.post(_url(), data=data, auth=auth, verify=testlib.cert_file)
+            assert r.status_code == 200
+        _rate("%s pooled connection" % method, calls, time.time() - start)
+
+
+def bench_tls_handshake(connections=300):
+    """
+    Milliseconds per TLS connection doing a full handshake versus resuming
+    the previous session.
+    """
+    ctx = ssl.create_default_context(cafile=testlib.cert_file)
+    ctx.check_hostname = False
+
+    for resume in (False, True):
+        session = None
+        reused = 0
+        start = time.time()
+        for _ in range(connections):
+            sock = socket.create_connection((testlib.host, testlib.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with ctx.wrap_socket(sock, server_hostname=testlib.host,
+                                 session=session) as s:
+                reused += s.session_reused
+                if resume:
+                    session = s.session
+        elapsed = time.time() - start
+        print("%-40s %8d conns %8.3f ms/conn %5d resumed" %
+              ("TLS %s handshake" % ("resumed" if resume else "full"),
+               connections, elapsed * 1000 / connections, reused))
+
+
+def _fs_entries(n):
+    for i in range(n):
+        yield dict(name="fs_%06d" % i, uuid="%032x" % i,
+                   total_space=1 << 40, free_space=1 << 39, pool="/mnt/pool",
+                   full_path="/mnt/pool/targetd_fs/fs_%06d" % i)
+
+
+def _listing(streamed, n, results):
+    # Runs in its own process, so ru_maxrss is this mode's peak alone
+    main = importlib.import_module('targetd.main')
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+        f.write("password: %s\n" % testlib.password)
+        f.flush()
+        main.load_config(f.name)
+    if streamed:
+        main.mapping['fs_list'] = lambda req: _fs_entries(n)
+    else:
+        main.mapping['fs_list'] = lambda req: list(_fs_entries(n))
+    server = main.HTTPService(('127.0.0.1', 0), main.TargetHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    auth = '%s:%s' % (testlib.user, testlib.password)
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    conn.request('POST', testlib.rpc_path, _payload('fs_list'), {
+        'Authorization': 'Basic %s' % base64.b64encode(auth.encode()).decode()})
+    r = conn.getresponse()
+    r.read(1)
+    first = time.time() - start
+    size = 1
+    while True:
+        data = r.read(65536)
+        if not data:
+            break
+        size += len(data)
+    total = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    results.put((first, total, peak, size))
+
+
+def bench_streaming(n=50000):
+    """
+    Time to first byte, total time and peak RSS growth of an in-process
+    server for an n element fs_list, encoded in one piece versus streamed.
+    """
+    ctx = multiprocessing.get_context('fork')
+    for streamed in (False, True):
+        results = ctx.Queue()
+        p = ctx.Process(target=_listing, args=(streamed, n, results))
+        p.start()
+        first, total, peak, size = results.get()
+        p.join()
+        print("%-40s %8.1f ms first byte %8.1f ms total %8.1f MiB peak "
+              "RSS growth (%d bytes)" %
+              ("fs_list %d %s" % (n, "streamed" if streamed else "buffered"),
+               first * 1000, total * 1000, peak / 1024.0, size))
+
+
+class _UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path):
+        super(_UnixConnection, self).__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def _latencies(connect, calls, reuse):
+    auth = '%s:%s' % (testlib.user, testlib.password)
+    headers = {'Authorization':
+               'Basic %s' % base64.b64encode(auth.encode()).decode()}
+    data = _payload('echo')
+    times = []
+    conn = None
+    for _ in range(calls):
+        start = time.perf_counter()
+        if conn is None:
+            conn = connect()
+        conn.request('POST', testlib.rpc_path, data, headers)
+        r = conn.getresponse()
+        r.read()
+        assert r.status == 200
+        if not reuse:
+            conn.close()
+            conn = None
+        times.append(time.perf_counter() - start)
+    if conn is not None:
+        conn.close()
+    times.sort()
+    return times
+
+
+def bench_unix_socket(calls=2000):
+    """
+    Latency (median and 99th percentile) of a trivial call to an in-process
+    server over loopback TLS versus the unix domain socket, with a new
+    connection per call and with one kept alive connection.
+    """
+    main = importlib.import_module('targetd.main')
+    d = tempfile.mkdtemp()
+    cert, key = os.path.join(d, 'cert.pem'), os.path.join(d, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                           '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                           '-keyout', key, '-out', cert],
+                          stderr=subprocess.DEVNULL)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+        f.write("password: %s\nssl_cert: %s\nssl_key: %s\n"
+                "unix_socket: %s\nunix_socket_uids: [%d]\n" %
+                (testlib.password, cert, key, os.path.join(d, 'sock'),
+                 os.getuid()))
+        f.flush()
+        main.load_config(f.name)
+
+    @main.locks()
+    def echo(req):
+        return True
+
+    main.mapping['echo'] = echo
+    servers = [main.TLSHTTPService(('127.0.0.1', 0), main.TargetHandler),
+               main.UnixHTTPService(main.config['unix_socket'],
+                                    main.UnixTargetHandler)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    ctx = ssl.create_default_context(cafile=cert)
+    ctx.check_hostname = False
+    port = servers[0].server_address[1]
+
+    def tls():
+        return http.client.HTTPSConnection('127.0.0.1', port, context=ctx)
+
+    def unix():
+        return _UnixConnection(main.config['unix_socket'])
+
+    try:
+        for label, connect in (("loopback TLS", tls), ("unix socket", unix)):
+            for reuse in (False, True):
+                times = _latencies(connect, calls, reuse)
+                print("%-40s %8d calls %8.3f ms median %8.3f ms p99" %
+                      ("%s %s" % (label, "kept alive" if reuse else
+                                  "new connections"), calls,
+                       times[len(times) // 2] * 1000,
+                       times[int(len(times) * 0.99)] * 1000))
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(d)
+
+
+def bench_thundering_herd(callers=30, rounds=20):
+    """
+    Commands run and time taken by rounds of callers polling the same read
+    only method at once, with and without coalescing of identical calls.
+    """
+    main = importlib.import_module('targetd.main')
+    utils = importlib.import_module('targetd.utils')
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+        f.write("password: %s\nworkers: %d\nread_snapshot_ttl: 0\n" %
+                (testlib.password, callers))
+        f.flush()
+        main.load_config(f.name)
+
+    # Stands in for vol_list's lvs or zfs get
+    @utils.read_only
+    @main.locks('pool')
+    def poll(req, pool):
+        utils.execute(['sleep', '0.02'])
+        return [pool]
+
+    main.mapping['poll'] = poll
+    server = main.HTTPService(('127.0.0.1', 0), main.TargetHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    auth = '%s:%s' % (testlib.user, testlib.password)
+    headers = {'Authorization':
+               'Basic %s' % base64.b64encode(auth.encode()).decode()}
+    data = _payload('poll', dict(pool='vg'))
+
+    def call(conn):
+        conn.request('POST', testlib.rpc_path, data, headers)
+        r = conn.getresponse()
+        r.read()
+        assert r.status == 200
+
+    try:
+        for coalesce in (False, True):
+            main.config['coalesce_reads'] = coalesce
+            conns = [http.client.HTTPConnection('127.0.0.1', port)
+                     for _ in range(callers)]
+            before = utils.command_seconds.values().get('sleep',
+                                                        dict(count=0))
+            start = time.time()
+            for _ in range(rounds):
+                threads = [threading.Thread(target=call, args=(c,))
+                           for c in conns]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            elapsed = time.time() - start
+            runs = utils.command_seconds.values()['sleep']['count'] - \
+                before['count']
+            for c in conns:
+                c.close()
+            print("%-40s %8d calls %8d commands %8.3f s" %
+                  ("herd of %d %s" % (callers, "coalesced" if coalesce
+                                      else "separate"),
+                   callers * rounds, runs, elapsed))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_nfs_exports(n=10000, calls=100):
+    """
+    Time per nfs_export_list style listing and per removal with n exports,
+    reading them from exportfs every time versus from the in-memory table.
+    """
+    nfs = importlib.import_module('targetd.nfs')
+    exports = [("/export/fs_%05d" % i, "10.0.%d.%d" % (i // 250, i % 250),
+                "rw,sync,wdelay,hide,no_subtree_check,sec=sys,secure,"
+                "root_squash,no_all_squash") for i in range(n)]
+    for watched in (False, True):
+        fake = testlib.FakeExportfs(exports)
+        try:
+            table = nfs.Nfs._table()
+            if not watched:
+                table.watch = None
+            start = time.time()
+            for _ in range(calls):
+                assert len(nfs.Nfs.exports()) == n
+            listing = time.time() - start
+
+            start = time.time()
+            for e in nfs.Nfs.exports()[:calls]:
+                nfs.Nfs.export_remove(e)
+            removal = time.time() - start
+            print("%-40s %8.2f ms/list %8.2f ms/remove %6d exportfs runs" %
+                  ("%d exports %s" % (n, "in memory" if watched
+                                      else "from exportfs"),
+                   listing * 1000 / calls, removal * 1000 / calls,
+                   len(fake.calls())))
+        finally:
+            fake.close()
+
+
+def bench_nfs_export_many(n=500):
+    """
+    Time to export a path to n hosts with one nfs_export_add each versus a
+    single nfs_export_add_many, then to remove them again.
+    """
+    fs = importlib.import_module('targetd.fs')
+    entries = [dict(host="10.%d.%d.0/24" % (i // 250, i % 250),
+                    path="/export/tenant", options=["rw", "no_root_squash"])
+               for i in range(n)]
+    for many in (False, True):
+        fake = testlib.FakeExportfs()
+        try:
+            start = time.time()
+            if many:
+                fs.nfs_export_add_many(None, entries)
+            else:
+                for e in entries:
+                    fs.nfs_export_add(None, **e)
+            adding = time.time() - start
+
+            start = time.time()
+            if many:
+                fs.nfs_export_remove_many(None, [dict(host=e['host'],
+                                                      path=e['path'])
+                                                 for e in entries])
+            else:
+                for e in entries:
+                    # The fake lists nothing, so don't look them up
+                    fs.Nfs.export_remove(fs.Export(e['host'], e['path']))
+            removal = time.time() - start
+            print("%-40s %8.3f s add %8.3f s remove %6d exportfs runs" %
+                  ("%d hosts %s" % (n, "at once" if many else "one by one"),
+                   adding, removal, len(fake.calls())))
+        finally:
+            fake.close()
+
+
+def _exports_lines(n):
+    # Mostly plain lines, with the comments, quoted paths and \nnn escapes
+    # found in hand written exports files in between
+    for i in range(n):
+        host = "10.%d.%d.0/24" % (i // 250 % 250, i % 250)
+        if i % 10 == 0:
+            yield "# tenant %d\n" % i
+        elif i % 10 == 1:
+            yield '"/export/tenant %d" %s(rw,sync) # quoted\n' % (i, host)
+        elif i % 10 == 2:
+            yield "/export/tenant\\040%d %s(ro,all_squash)\n" % (i, host)
+        elif i % 10 == 3:
+            yield "/export/fs_%06d -rw,sync %s(ro) *(no_root_squash)\n" % \
+                (i, host)
+        else:
+            yield "/export/fs_%06d %s(rw,sync,no_subtree_check,sec=sys)\n" \
+                % (i, host)
+
+
+def bench_exports_parser(n=100000, rounds=3):
+    """
+    Seconds (best of rounds) to parse an n line exports file and n lines of
+    exportfs -v output, and to list and format the options of n exports.
+    """
+    nfs = importlib.import_module('targetd.nfs')
+    d = tempfile.mkdtemp()
+    exports_file = os.path.join(d, 'exports')
+    with open(exports_file, 'w') as f:
+        f.writelines(_exports_lines(n))
+    listing = "".join(
+        "/export/fs_%06d\t10.%d.%d.0/24(rw,sync,wdelay,hide,no_subtree_check,"
+        "sec=sys,secure,root_squash,no_all_squash)\n" %
+        (i, i // 250 % 250, i % 250) for i in range(n))
+
+    def best(fn):
+        times = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            rc = fn()
+            times.append(time.perf_counter() - start)
+        return min(times), rc
+
+    try:
+        file_s, parsed = best(
+            lambda: nfs.Export.parse_exports_file(exports_file))
+        output_s, exports = best(
+            lambda: nfs.Export.parse_exportfs_output(listing))
+        list_s, _ = best(lambda: [e.options_list() for e in exports])
+        format_s, _ = best(lambda: [e.export_file_format() for e in exports])
+        for label, seconds, count in (
+                ("parse %d line exports file" % n, file_s, len(parsed)),
+                ("parse %d lines of exportfs -v" % n, output_s, len(exports)),
+                ("options_list of %d exports" % n, list_s, len(exports)),
+                ("export_file_format of %d exports" % n, format_s,
+                 len(exports))):
+            print("%-40s %8.3f s %8.2f us/line %8d exports" %
+                  (label, seconds, seconds * 1e6 / n, count))
+    finally:
+        shutil.rmtree(d)
+
+
+BENCHMARKS = dict(
+    keepalive=bench_keepalive,
+    tls_handshake=bench_tls_handshake,
+    streaming=bench_streaming,
+    unix_socket=bench_unix_socket,
+    thundering_herd=bench_thundering_herd,
+    nfs_exports=bench_nfs_exports,
+    nfs_export_many=bench_nfs_export_many,
+    exports_parser=bench_exports_parser,
+)
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        BENCHMARKS[name]()
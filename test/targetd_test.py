@@ -1,17 +1,34 @@
 #!/usr/bin/python3
 
 import unittest
+import base64
+import http.client
+import importlib
 import json
+import os
 import random
+import shlex
+import shutil
+import socket
+import ssl
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import types
 import string
 from targetd.utils import TargetdError
 from os import getenv
 from requests.exceptions import ConnectionError
 from test import testlib
-from targetd import nfs
+from targetd import jobs, metrics, nfs, utils
 from multiprocessing.pool import ThreadPool
 
+# targetd/__init__.py exports the main() function under the module's name
+main = importlib.import_module('targetd.main')
+
 
 def jsonrequest(method, params=None, data=None):
     return testlib.rpc(method, params, data)
@@ -36,6 +53,109 @@ def rs(prefix="td", length=4):
     return rp
 
 
+class UnixConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection to a unix domain socket.
+    """
+
+    def __init__(self, socket_path):
+        super(UnixConnection, self).__init__('localhost', timeout=10)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class LocalServer(object):
+    """
+    Run the targetd HTTP service in-process on an ephemeral port (or a unix
+    socket for engine "unix") with the given methods in place of the
+    storage backends.  Engine "tls" needs ssl_cert and ssl_key.
+    """
+
+    def __init__(self, methods, engine="threading", **cfg):
+        self.socket_dir = None
+        if engine == "unix":
+            self.socket_dir = tempfile.mkdtemp()
+            cfg.setdefault('unix_socket',
+                           os.path.join(self.socket_dir, 'targetd.sock'))
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+            f.write("password: %s\n" % testlib.password)
+            for k, v in cfg.items():
+                f.write("%s: %s\n" % (k, json.dumps(v)))
+            f.flush()
+            main.load_config(f.name)
+
+        self.methods = methods
+        main.mapping.update(methods)
+        self.running = True
+        if engine == "asyncio":
+            self.server = main.AsyncHTTPService(('127.0.0.1', 0))
+            kwargs = dict(running=lambda: self.running, poll_interval=0.05)
+        elif engine == "unix":
+            self.server = main.UnixHTTPService(main.config['unix_socket'],
+                                               main.UnixTargetHandler)
+            kwargs = dict(poll_interval=0.05)
+        elif engine == "tls":
+            self.server = main.TLSHTTPService(('127.0.0.1', 0),
+                                              main.TargetHandler)
+            kwargs = dict(poll_interval=0.05)
+        else:
+            self.server = main.HTTPService(('127.0.0.1', 0),
+                                           main.TargetHandler)
+            kwargs = dict(poll_interval=0.05)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs=kwargs)
+        self.thread.daemon = True
+        self.thread.start()
+        self.tls = engine == "tls"
+        if engine == "asyncio":
+            self.server.ready.wait(10)
+        if not self.socket_dir:
+            self.port = self.server.server_address[1]
+
+    def connect(self, source_address=None):
+        if self.socket_dir:
+            return UnixConnection(self.server.server_address)
+        if self.tls:
+            return http.client.HTTPSConnection(
+                '127.0.0.1', self.port, timeout=10,
+                source_address=source_address,
+                context=ssl._create_unverified_context())
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=10,
+                                          source_address=source_address)
+
+    @staticmethod
+    def post(conn, payload, password=None):
+        auth = '%s:%s' % (testlib.user, password or testlib.password)
+        conn.request('POST', testlib.rpc_path, json.dumps(payload), {
+            'Authorization':
+                'Basic %s' % base64.b64encode(auth.encode()).decode()})
+        r = conn.getresponse()
+        body = r.read()
+        return r, (json.loads(body.decode()) if r.status == 200 else None)
+
+    def call(self, method, params=None, conn=None):
+        conn = conn or self.connect()
+        r, payload = LocalServer.post(conn, dict(
+            id=1, method=method, params=params, jsonrpc="2.0"))
+        return testlib._json_payload(payload)
+
+    def close(self):
+        if isinstance(self.server, main.AsyncHTTPService):
+            self.running = False
+            self.thread.join(10)
+        else:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.socket_dir:
+            shutil.rmtree(self.socket_dir)
+        for m in self.methods:
+            del main.mapping[m]
+
+
 class TargetdObj(object):
 
     @staticmethod
@@ -84,6 +204,146 @@ class NoDaemon(unittest.TestCase):
         result = nfs.Export.parse_exports_file("/tmp/sample")
         self.assertGreater(len(result), 1)
 
+    def test_gp_nfs_export_table(self):
+        fake = testlib.FakeExportfs(
+            [("/a", "*", "rw,sync"), ("/b", "10.0.0.1", "ro"),
+             ("/user", "*", "rw")], "/user *(rw)\n")
+        try:
+            Nfs = nfs.Nfs
+            self.assertEqual([e.path for e in Nfs.exports()],
+                             ["/a", "/b", "/user"])
+            Nfs.exports()
+            self.assertEqual(fake.calls(), ["-v"])
+
+            # Removing is done in memory, the file is written from it
+            Nfs.export_remove(Nfs.exports()[0])
+            self.assertEqual(fake.calls(), ["-v", "-u *:/a"])
+            self.assertEqual([e.path for e in Nfs.exports()],
+                             ["/b", "/user"])
+            self.assertEqual(fake.config_file(), "/b 10.0.0.1(ro)\n")
+
+            # Added ones are listed again for the options exportfs adds
+            Nfs.export_add("h", "/c", nfs.Export.RW, {})
+            self.assertIn("/c h(rw)\n", fake.config_file())
+            fake.set_listing([("/c", "h", "rw,wdelay")])
+            self.assertEqual([e.options_list() for e in Nfs.exports()],
+                             [["rw", "wdelay"]])
+            self.assertEqual(fake.calls()[-2:], ["-o rw h:/c", "-v"])
+
+            # Changes made by others are seen
+            with open(fake.main_file, 'a') as f:
+                f.write("/d *(ro)\n")
+            Nfs.exports()
+            self.assertEqual(fake.calls()[-1], "-v")
+            n = len(fake.calls())
+            with open(fake.etab, 'w') as f:
+                f.write("/e\t*(ro)\n")
+            Nfs.exports()
+            Nfs.exports()
+            self.assertEqual(len(fake.calls()), n + 1)
+        finally:
+            fake.close()
+
+    def test_gp_nfs_export_file(self):
+        fake = testlib.FakeExportfs([("/a", "*", "rw"), ("/b", "*", "ro")])
+        try:
+            Nfs = nfs.Nfs
+            path = os.path.join(fake.config_dir, Nfs.EXPORT_FILE)
+            Nfs.export_add("h", "/c", nfs.Export.RW, {})
+            before = os.stat(path)
+            self.assertEqual(fake.config_file(),
+                             "/a *(rw)\n/b *(ro)\n/c h(rw)\n")
+            self.assertEqual(stat.S_IMODE(before.st_mode), 0o644)
+
+            # Replaced by a new file, no temporary one is left
+            Nfs.export_remove(Nfs.exports()[0])
+            self.assertNotEqual(os.stat(path).st_ino, before.st_ino)
+            self.assertEqual(os.listdir(fake.config_dir), [Nfs.EXPORT_FILE])
+            self.assertEqual(fake.config_file(), "/b *(ro)\n/c h(rw)\n")
+
+            # A failed write leaves the file as it was
+            def fail(fd):
+                raise OSError("no space")
+
+            fsync = nfs.os.fsync
+            nfs.os.fsync = fail
+            try:
+                self.assertRaises(OSError, Nfs._save_exports, ["/x *(ro)\n"])
+            finally:
+                nfs.os.fsync = fsync
+            self.assertEqual(os.listdir(fake.config_dir), [Nfs.EXPORT_FILE])
+            self.assertEqual(fake.config_file(), "/b *(ro)\n/c h(rw)\n")
+        finally:
+            fake.close()
+
+    def test_gp_nfs_export_many(self):
+        fs = importlib.import_module('targetd.fs')
+        fake = testlib.FakeExportfs([("/a", "*", "rw"), ("/user", "*", "rw")],
+                                    "/user *(rw)\n")
+        try:
+            added = fs.nfs_export_add_many(None, [
+                dict(host="*", path="/a", options=["ro"])] + [
+                dict(host="10.0.0.%d" % i, path="/b", options="rw")
+                for i in range(1, 4)])
+            self.assertEqual([r['status'] for r in added],
+                             ["updated", "added", "added", "added"])
+            self.assertEqual(fake.calls(), ["-v", "-r"])
+            self.assertEqual(fake.config_file(),
+                             "/a *(ro)\n/b 10.0.0.1(rw)\n/b 10.0.0.2(rw)\n"
+                             "/b 10.0.0.3(rw)\n")
+            fake.set_listing([("/a", "*", "ro"), ("/user", "*", "rw")] +
+                             [("/b", "10.0.0.%d" % i, "rw")
+                              for i in range(1, 4)])
+
+            removed = fs.nfs_export_remove_many(None, [
+                dict(host="10.0.0.1", path="/b"),
+                dict(host="10.0.0.9", path="/b")])
+            self.assertEqual([r['status'] for r in removed],
+                             ["removed", "not_found"])
+            self.assertEqual(fake.calls()[-1], "-r")
+            self.assertEqual(fake.config_file(),
+                             "/a *(ro)\n/b 10.0.0.2(rw)\n/b 10.0.0.3(rw)\n")
+
+            # Nothing is changed unless every entry is valid
+            n = len(fake.calls())
+            for entries in ([dict(host="h", path="/c", options=["rw", "ro"])],
+                            [dict(host="h", path="/c", options=["bogus"])],
+                            [dict(host="h", path="/c", options=["rw"]),
+                             dict(host="h")],
+                            [dict(host="*", path="/user")]):
+                with self.assertRaises(TargetdError) as cm:
+                    fs.nfs_export_add_many(None, entries)
+                self.assertEqual(cm.exception.error,
+                                 TargetdError.INVALID_ARGUMENT)
+            self.assertRaises(TargetdError, fs.nfs_export_remove_many, None,
+                              [dict(host="*", path="/user")])
+            self.assertEqual(len(fake.calls()), n)
+            self.assertNotIn("/c", fake.config_file())
+        finally:
+            fake.close()
+
+    def test_gp_exports_parser(self):
+        # Split as shlex did for every line, quotes, escapes and comments
+        for line in ("/a *(rw)\n", "/a\t-rw h1 h2(ro) # c\n", "# c\n", "\n",
+                     "/q#x h(rw)\n", '"/a b" h(rw)\n', "/a\\040b h(rw)\n",
+                     "/a\\134060 \\060 *(rw)\n", "/x 'a b'c\\ d e\n",
+                     "/e\\012x h(rw)\n", "/a h(rw)\r\n"):
+            self.assertEqual(nfs.Export._tokens(line),
+                             shlex.split(nfs.Export._chr_encode(line), '#'))
+        self.assertEqual(nfs.Export._chr_encode("/a\\134060 \\060\\101"),
+                         "/a0 0A")
+
+        # Options in the order of bool_option, whatever order they came in
+        e = nfs.Export.parse_exportfs_output(
+            "/a\th(no_all_squash,sec=sys,rw,secure)\n"
+            "/b\th(no_all_squash,sec=sys,rw,secure)\n")
+        self.assertEqual(e[0].options_list(),
+                         ["secure", "rw", "no_all_squash", "sec=sys"])
+        self.assertEqual(e[1].export_file_format(),
+                         "/b h(secure,rw,no_all_squash,sec=sys)\n")
+        self.assertIsNot(e[0].key_value_options, e[1].key_value_options)
+        self.assertRaises(AttributeError, setattr, e[0], "other", 1)
+
     def test_ep_export(self):
         self.assertRaises(ValueError, nfs.Export,
                           "localhost", "/mnt/foo",
@@ -106,6 +366,1586 @@ class NoDaemon(unittest.TestCase):
         i3 = nfs.Export("127.0.0.1", "/mnt/foo", nfs.Export.RO)
         self.assertTrue(i2 != i3)
 
+    def test_gp_paginate(self):
+        items = [dict(name="v%03d" % i) for i in range(25)]
+        random.shuffle(items)
+
+        def key(v):
+            return (v['name'],)
+
+        # No paging asked for, same list as before
+        self.assertIs(type(utils.paginate(items, key)), list)
+        self.assertEqual(utils.paginate(items, key), items)
+
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            page = utils.paginate(items, key, 10, cursor)
+            seen.extend(v['name'] for v in page['items'])
+            pages += 1
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, sorted(v['name'] for v in items))
+
+        page = utils.paginate(items, key, 30, fn=lambda v: v['name'])
+        self.assertEqual(len(page['items']), 25)
+        self.assertIsNone(page['next_cursor'])
+
+    def test_ep_paginate(self):
+        def key(v):
+            return (v,)
+
+        for limit in (0, -1, "5", 1.5):
+            with self.assertRaises(TargetdError) as cm:
+                utils.paginate([1, 2], key, limit)
+            self.assertEqual(cm.exception.error,
+                             TargetdError.INVALID_ARGUMENT)
+        for cursor in ("not base64!", "bm9wZQ==", 5):
+            with self.assertRaises(TargetdError) as cm:
+                utils.paginate([1, 2], key, 1, cursor)
+            self.assertEqual(cm.exception.error,
+                             TargetdError.INVALID_ARGUMENT)
+
+    def test_gp_keepalive(self):
+        srv = LocalServer(dict(echo=lambda req, v=None: v),
+                          keepalive_requests=3)
+        try:
+            conn = srv.connect()
+            sockets = []
+            for i in range(3):
+                r, payload = LocalServer.post(
+                    conn, dict(id=i, method="echo", params=dict(v=i),
+                               jsonrpc="2.0"))
+                self.assertEqual(int(r.getheader('Content-Length')),
+                                 len(json.dumps(payload)))
+                self.assertEqual(payload['result'], i)
+                sockets.append(conn.sock)
+            # Served on one connection, which is closed once the per
+            # connection request limit is reached
+            self.assertIs(sockets[0], sockets[1])
+            self.assertEqual(r.getheader('Connection'), 'close')
+            self.assertIsNone(conn.sock)
+        finally:
+            srv.close()
+
+    def test_ep_keepalive_parse_error(self):
+        srv = LocalServer(dict(echo=lambda req, v=None: v))
+        try:
+            conn = srv.connect()
+            conn.request('POST', testlib.rpc_path, '{"id": 1', {
+                'Authorization': 'Basic %s' % base64.b64encode(
+                    ('%s:%s' % (testlib.user, testlib.password)).encode()
+                ).decode()})
+            r = conn.getresponse()
+            self.assertEqual(json.loads(r.read().decode())['error']['code'],
+                             -32700)
+            # The connection is still usable after an error response
+            self.assertEqual(srv.call("echo", dict(v=5), conn), 5)
+        finally:
+            srv.close()
+
+    def test_gp_batch(self):
+        saves = []
+
+        def save():
+            saves.append(True)
+
+        def change(req, v):
+            utils.defer(req, save)
+            if v < 0:
+                raise TargetdError(TargetdError.INVALID_ARGUMENT, "negative")
+            return v
+
+        srv = LocalServer(dict(change=change))
+        try:
+            r, payload = LocalServer.post(srv.connect(), [
+                dict(id=1, method="change", params=dict(v=1), jsonrpc="2.0"),
+                dict(id=2, method="change", params=dict(v=-1),
+                     jsonrpc="2.0"),
+                dict(id=3, method="nope", jsonrpc="2.0"),
+                "junk",
+                dict(id=5, method="change", params=dict(v=5), jsonrpc="2.0"),
+            ])
+            self.assertEqual([p.get('result') for p in payload],
+                             [1, None, None, None, 5])
+            self.assertEqual([p['error']['code'] for p in payload
+                              if 'error' in p],
+                             [TargetdError.INVALID_ARGUMENT, -32601, -32600])
+            # The deferred work ran once for the whole batch
+            self.assertEqual(len(saves), 1)
+
+            # Outside of a batch it runs with each call
+            srv.call("change", dict(v=2))
+            self.assertEqual(len(saves), 2)
+
+            r, payload = LocalServer.post(srv.connect(), [])
+            self.assertEqual(payload['error']['code'], -32600)
+        finally:
+            srv.close()
+
+    def test_ep_batch_too_big(self):
+        srv = LocalServer(dict(echo=lambda req, v=None: v),
+                          max_request_size=4096)
+        try:
+            call = dict(id=1, method="echo", params=dict(v=1), jsonrpc="2.0")
+            r, payload = LocalServer.post(srv.connect(), [call] * 200)
+            self.assertEqual(r.status, 413)
+        finally:
+            srv.close()
+
+    def test_gp_lock_manager_ordering(self):
+        # Threads asking for the same keys in opposite orders must not
+        # deadlock.
+        lm = utils.LockManager()
+        held = []
+
+        def worker(keys):
+            for _ in range(200):
+                with lm.locked(keys):
+                    held.append(keys)
+
+        threads = [threading.Thread(target=worker, args=(k,))
+                   for k in (['a', 'b', 'c'], ['c', 'b', 'a'], ['b', 'a'],
+                             None)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.is_alive(), "lock manager deadlocked")
+        self.assertEqual(len(held), 800)
+
+    def test_gp_lock_manager_on_write(self):
+        # The hooks get the keys of writes as a set, whatever was passed
+        lm = utils.LockManager()
+        writes = []
+        lm.on_write.append(writes.append)
+        with lm.locked(['b', 'a']):
+            pass
+        with lm.locked(['a'], write=False):
+            pass
+        # Nothing locked, nothing written
+        generation = lm.generation(())
+        with lm.locked(()):
+            pass
+        self.assertEqual(lm.generation(()), generation)
+        with lm.locked(None):
+            pass
+        self.assertEqual(writes, [frozenset(['a', 'b']), None])
+        self.assertTrue(writes[0] <= {'a', 'b', 'c'})
+
+    def test_gp_lock_manager_concurrency(self):
+        # Stand-in backends: calls on different pools run in parallel,
+        # calls on one pool and undeclared methods are serialized.
+        delay = 0.2
+        running = dict(now=0, max=0)
+        count_lock = threading.Lock()
+
+        def work(req, pool):
+            with count_lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(delay)
+            with count_lock:
+                running['now'] -= 1
+
+        srv = LocalServer(dict(
+            work=utils.locks(utils.pool_lock())(work),
+            work_all=lambda req, pool: work(req, pool)))
+        try:
+            def run(method, pools):
+                running['max'] = 0
+                tp = ThreadPool(processes=len(pools))
+                start = time.time()
+                tp.map(lambda p: srv.call(method, dict(pool=p)), pools)
+                tp.close()
+                return time.time() - start
+
+            n = 8
+            elapsed = run("work", ["pool%d" % i for i in range(n)])
+            self.assertEqual(running['max'], n)
+            self.assertLess(elapsed, delay * n / 2)
+
+            elapsed = run("work", ["pool0"] * 4)
+            self.assertEqual(running['max'], 1)
+            self.assertGreaterEqual(elapsed, delay * 4)
+
+            elapsed = run("work_all", ["pool%d" % i for i in range(4)])
+            self.assertEqual(running['max'], 1)
+            self.assertGreaterEqual(elapsed, delay * 4)
+        finally:
+            srv.close()
+
+    def test_ep_lock_keys(self):
+        # A call whose keys can't be had from its params is rejected without
+        # locking everything, calls on other pools don't queue behind it
+        def create(req, pool, name):
+            return name
+
+        def read(req, pool):
+            return pool
+
+        srv = LocalServer(dict(create=utils.locks(utils.pool_lock())(create),
+                               read=utils.locks(utils.pool_lock())(read)))
+        try:
+            with main.lock_manager.locked({'pool:a'}, name="slow"):
+                for params in (dict(name="v"), None, ["a", "v"]):
+                    with self.assertRaises(TargetdError) as cm:
+                        srv.call("create", params)
+                    self.assertEqual(cm.exception.error,
+                                     TargetdError.INVALID_ARGUMENT)
+                self.assertEqual(srv.call("read", dict(pool="b")), "b")
+
+                conn = srv.connect()
+                r, payload = LocalServer.post(conn, [
+                    dict(id=1, method="create", params=dict(name="v"),
+                         jsonrpc="2.0"),
+                    dict(id=2, method="read", params=dict(pool="b"),
+                         jsonrpc="2.0")])
+                self.assertEqual(payload[0]['error']['code'],
+                                 TargetdError.INVALID_ARGUMENT)
+                self.assertEqual(payload[1]['result'], "b")
+        finally:
+            srv.close()
+
+    def test_gp_asyncio_engine(self):
+        srv = LocalServer(dict(echo=lambda req, v=None: v),
+                          engine="asyncio", keepalive_requests=3)
+        try:
+            conn = srv.connect()
+            self.assertEqual(srv.call("echo", dict(v=1), conn), 1)
+            sock = conn.sock
+            r, payload = LocalServer.post(conn, [
+                dict(id=1, method="echo", params=dict(v=2), jsonrpc="2.0"),
+                dict(id=2, method="nope", jsonrpc="2.0")])
+            self.assertIs(conn.sock, sock)
+            self.assertEqual(payload[0]['result'], 2)
+            self.assertEqual(payload[1]['error']['code'], -32601)
+            r, payload = LocalServer.post(conn, "{")
+            self.assertEqual(r.getheader('Connection'), 'close')
+
+            start = time.time()
+            r, payload = LocalServer.post(srv.connect(), {}, password="bad")
+            self.assertEqual(r.status, 401)
+            self.assertGreaterEqual(time.time() - start, 1)
+
+            conn = srv.connect()
+            conn.request('GET', testlib.rpc_path)
+            self.assertEqual(conn.getresponse().status, 501)
+        finally:
+            srv.close()
+
+    def _streamed(self, engine):
+        @utils.locks('stream')
+        def many(req, n, fail=False):
+            if fail:
+                raise TargetdError(TargetdError.INVALID_POOL, "no pool")
+            for i in range(n):
+                yield dict(name="fs%d" % i, size=i)
+
+        srv = LocalServer(dict(many=many), engine=engine)
+        try:
+            conn = srv.connect()
+            r, payload = LocalServer.post(conn, dict(
+                id=3, method="many", params=dict(n=20000), jsonrpc="2.0"))
+            self.assertEqual(r.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(payload['id'], 3)
+            self.assertEqual(len(payload['result']), 20000)
+            self.assertEqual(payload['result'][-1],
+                             dict(name="fs19999", size=19999))
+
+            # Same connection, and the lock was released
+            sock = conn.sock
+            self.assertEqual(srv.call("many", dict(n=0), conn), [])
+            self.assertIs(conn.sock, sock)
+
+            with self.assertRaises(TargetdError) as cm:
+                srv.call("many", dict(n=1, fail=True), conn)
+            self.assertEqual(cm.exception.error, TargetdError.INVALID_POOL)
+
+            r, payload = LocalServer.post(conn, [
+                dict(id=1, method="many", params=dict(n=2), jsonrpc="2.0")])
+            self.assertEqual(payload[0]['result'],
+                             [dict(name="fs0", size=0),
+                              dict(name="fs1", size=1)])
+        finally:
+            srv.close()
+
+    def test_gp_streamed(self):
+        for engine in ("threading", "asyncio"):
+            self._streamed(engine)
+
+    def _streamed_deadline(self, engine):
+        @utils.locks('stream')
+        def many(req, n):
+            for i in range(n):
+                yield dict(i=i, timed=utils.remaining() is not None,
+                           pad="x" * 65536)
+
+        srv = LocalServer(dict(many=many), engine=engine)
+        try:
+            # The items after the first are made within the call too
+            result = srv.call("many", dict(n=3, call_timeout=10))
+            self.assertEqual([r['timed'] for r in result], [True] * 3)
+
+            # A client which doesn't read keeps the call and its lock until
+            # the deadline only
+            stuck = srv.connect()
+            stuck.request('POST', testlib.rpc_path, json.dumps(dict(
+                id=1, method="many", params=dict(n=100000, call_timeout=1),
+                jsonrpc="2.0")), {'Authorization': 'Basic %s' % base64.
+                                  b64encode(('%s:%s' % (
+                                      testlib.user, testlib.password)
+                                  ).encode()).decode()})
+            time.sleep(0.2)
+            start = time.time()
+            self.assertEqual(len(srv.call("many", dict(n=1))), 1)
+            self.assertLess(time.time() - start, 5)
+            stuck.close()
+        finally:
+            srv.close()
+
+    def test_ep_streamed_deadline(self):
+        for engine in ("threading", "asyncio"):
+            self._streamed_deadline(engine)
+
+    def test_gp_jobs(self):
+        release = threading.Event()
+
+        @jobs.long_running
+        @utils.locks('job')
+        def slow(req, v):
+            release.wait(10)
+            if v < 0:
+                raise TargetdError(TargetdError.INVALID_POOL, "no pool")
+            return v
+
+        @utils.locks()
+        def fast(req, v=None):
+            return v
+
+        srv = LocalServer(dict(slow=slow, fast=fast), job_workers=1)
+        methods = jobs.initialize(main.config)
+        main.mapping.update(methods)
+        srv.methods.update(methods)
+        try:
+            first = srv.call("slow", dict(v=1, async_job=True))['job_id']
+            queued = srv.call("slow", dict(v=2, async_job=True))['job_id']
+            failing = srv.call("slow", dict(v=-1, async_job=True))['job_id']
+
+            status = srv.call("job_wait", dict(job_id=first, timeout=0.2))
+            self.assertEqual(status['status'], jobs.RUNNING)
+            self.assertEqual(status['method'], "slow")
+            # Not held up by the job
+            self.assertEqual(srv.call("fast", dict(v=5)), 5)
+
+            self.assertTrue(srv.call("job_cancel", dict(job_id=queued)))
+            self.assertEqual(srv.call("job_status", dict(job_id=queued))
+                             ['status'], jobs.CANCELLED)
+
+            release.set()
+            status = srv.call("job_wait", dict(job_id=first))
+            self.assertEqual(status['status'], jobs.DONE)
+            self.assertEqual(status['result'], 1)
+            self.assertFalse(srv.call("job_cancel", dict(job_id=first)))
+
+            status = srv.call("job_wait", dict(job_id=failing))
+            self.assertEqual(status['status'], jobs.FAILED)
+            self.assertEqual(status['error']['code'],
+                             TargetdError.INVALID_POOL)
+
+            # Only the job table is looked at, no lock is taken
+            with main.lock_manager.locked(None, name="all"):
+                status = srv.call("job_wait", dict(job_id=first, timeout=1))
+                self.assertEqual(status['status'], jobs.DONE)
+                self.assertFalse(srv.call("job_cancel", dict(job_id=first)))
+        finally:
+            release.set()
+            srv.close()
+
+    def test_ep_jobs(self):
+        srv = LocalServer(dict(fast=lambda req, v=None: v), max_jobs=1)
+        methods = jobs.initialize(main.config)
+        main.mapping.update(methods)
+        srv.methods.update(methods)
+        try:
+            with self.assertRaises(TargetdError) as cm:
+                srv.call("job_status", dict(job_id="nope"))
+            self.assertEqual(cm.exception.error, TargetdError.NOT_FOUND_JOB)
+
+            with self.assertRaises(TargetdError) as cm:
+                srv.call("fast", dict(v=1, async_job=True))
+            self.assertEqual(cm.exception.error,
+                             TargetdError.INVALID_ARGUMENT)
+
+            # A full store of unfinished jobs turns new ones away
+            release = threading.Event()
+            job = jobs.submit("test", lambda: release.wait(10))
+            with self.assertRaises(TargetdError) as cm:
+                jobs.submit("test", lambda: None)
+            self.assertEqual(cm.exception.error, TargetdError.JOB_LIMIT)
+            release.set()
+            jobs.manager.get(job).done.wait(10)
+            # Finished ones make room
+            jobs.submit("test", lambda: None)
+        finally:
+            srv.close()
+
+    def test_gp_unix_socket(self):
+        @utils.locks()
+        def echo(req, v=None):
+            return v
+
+        srv = LocalServer(dict(echo=echo), engine="unix",
+                          unix_socket_uids=[os.getuid()])
+        path = srv.server.server_address
+        try:
+            self.assertTrue(stat.S_ISSOCK(os.stat(path).st_mode))
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o660)
+            # No password needed, but a wrong one doesn't hurt either
+            conn = srv.connect()
+            r, payload = LocalServer.post(conn, dict(
+                id=1, method="echo", params=dict(v=3), jsonrpc="2.0"),
+                password="wrong")
+            self.assertEqual(r.status, 200)
+            self.assertEqual(payload['result'], 3)
+            # Kept alive
+            self.assertEqual(srv.call("echo", dict(v=4), conn), 4)
+
+            main.config['unix_socket_uids'] = []
+            main.config['unix_socket_gids'] = [os.getgid()]
+            self.assertEqual(srv.call("echo", dict(v=5)), 5)
+
+            main.config['unix_socket_gids'] = []
+            r, payload = LocalServer.post(srv.connect(), dict(
+                id=1, method="echo", jsonrpc="2.0"))
+            self.assertEqual(r.status, 403)
+        finally:
+            srv.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_gp_reload_config(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.locks(utils.pool_lock())
+        def hold(req, pool):
+            started.set()
+            release.wait(10)
+            return pool
+
+        configured = []
+        committed = []
+
+        def configure(new_config):
+            if 'bad' in new_config['block_pools']:
+                raise TargetdError(TargetdError.NOT_FOUND_VOLUME_GROUP,
+                                   "VG pool bad not found")
+            configured.append(new_config)
+            return lambda: committed.append(new_config)
+
+        def write(**cfg):
+            f.seek(0)
+            f.truncate()
+            f.write("password: %s\n" % testlib.password)
+            for k, v in cfg.items():
+                f.write("%s: %s\n" % (k, json.dumps(v)))
+            f.flush()
+
+        srv = LocalServer(dict(hold=hold), block_pools=["a", "b"])
+        hooks = list(main.configure_hooks)
+        main.configure_hooks[:] = [configure]
+        f = tempfile.NamedTemporaryFile('w', suffix='.yaml')
+        try:
+            # A call on a pool being removed finishes on the old config
+            t = threading.Thread(target=srv.call, args=("hold",
+                                                        dict(pool="b")))
+            t.start()
+            self.assertTrue(started.wait(10))
+            write(block_pools=["a", "c"], workers=2,
+                  call_timeouts=dict(hold=5))
+            result = []
+            r = threading.Thread(
+                target=lambda: result.append(main.reload_config(f.name)))
+            r.start()
+            r.join(0.3)
+            self.assertEqual(len(configured), 1)
+            self.assertEqual(committed, [])
+            self.assertEqual(main.config['block_pools'], {"a", "b"})
+            release.set()
+            t.join(10)
+            r.join(10)
+            self.assertEqual(result, [True])
+            self.assertEqual(committed, configured)
+            self.assertEqual(main.config['block_pools'], {"a", "c"})
+            self.assertEqual(main.config['call_timeouts'], dict(hold=5))
+            # Only read at startup
+            self.assertEqual(main.config['workers'], 16)
+
+            # Adding an fs pool waits for the fs calls, it drops their
+            # catalog
+            write(block_pools=["a", "c"], fs_pools=["/tmp"])
+            result = []
+            with main.lock_manager.locked({'fs'}, name="fs"):
+                r = threading.Thread(
+                    target=lambda: result.append(main.reload_config(f.name)))
+                r.start()
+                r.join(0.3)
+                self.assertEqual(result, [])
+            r.join(10)
+            self.assertEqual(result, [True])
+            self.assertEqual(main.config['fs_pools'], {"/tmp"})
+
+            # A bad pool keeps the current configuration
+            write(block_pools=["a", "bad"])
+            self.assertFalse(main.reload_config(f.name))
+            self.assertEqual(main.config['block_pools'], {"a", "c"})
+            self.assertEqual(len(committed), 2)
+        finally:
+            release.set()
+            f.close()
+            main.configure_hooks[:] = hooks
+            srv.close()
+
+    # Starts targetd in a new interpreter, prints its startup profile
+    COLD_START = """
+import importlib, json, sys
+main = importlib.import_module('targetd.main')
+from targetd.utils import startup
+with startup.phase('config'):
+    main.load_config(sys.argv[1])
+main.update_mapping()
+with startup.phase('bind'):
+    server = main.HTTPService(('127.0.0.1', 0), main.TargetHandler)
+profile = startup.finish()
+profile['loaded'] = [m for m in ('rtslib_fb', 'gi', 'targetd.block',
+                                 'targetd.backends.lvm') if m in sys.modules]
+print(json.dumps(profile))
+"""
+
+    def test_gp_cold_start(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+            config = testlib.startup_config
+            if config is None:
+                # NFS only, nothing to load for block
+                f.write("password: %s\nblock_pools: []\nfs_pools: []\n" %
+                        testlib.password)
+                f.flush()
+                config = f.name
+            start = time.time()
+            out = subprocess.check_output(
+                [sys.executable, '-c', self.COLD_START, config],
+                cwd=os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))))
+            elapsed = time.time() - start
+
+        profile = json.loads(out.decode().splitlines()[-1])
+        for phase in ('config', 'imports', 'pool checks', 'bind'):
+            self.assertGreaterEqual(profile[phase], 0)
+        self.assertLessEqual(elapsed, testlib.startup_budget,
+                             "cold start took %.3fs: %s" % (elapsed, profile))
+        if testlib.startup_config is None:
+            self.assertEqual(profile['loaded'], [])
+
+    # Calls a block method on a host without block pools
+    NFS_ONLY_BLOCK_CALL = """
+import importlib, json, sys
+main = importlib.import_module('targetd.main')
+main.load_config(sys.argv[1])
+main.update_mapping()
+print(json.dumps(dict(known='access_group_list' in main.mapping,
+                      loaded='targetd.block' in sys.modules)))
+tries = []
+configure_block = main.configure_block
+main.configure_block = lambda *a, **kw: tries.append(1) or \
+    configure_block(*a, **kw)
+req = main.RpcRequest(('127.0.0.1', 0), {})
+call = json.dumps(dict(id=1, method='access_group_list', jsonrpc='2.0'))
+print(main.rpc_execute(req, call.encode()))
+main.rpc_execute(req, call.encode())
+polled = len(tries)
+main.reload_config(sys.argv[1])
+main.rpc_execute(req, call.encode())
+print(json.dumps(dict(block=main.block is not None,
+                      rtslib='rtslib_fb' in sys.modules,
+                      tries=[polled, len(tries)])))
+"""
+
+    def test_gp_nfs_only_block_methods(self):
+        # The block methods stay part of the API, loaded on first call
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+            f.write("password: %s\nblock_pools: []\nfs_pools: []\n" %
+                    testlib.password)
+            f.flush()
+            out = subprocess.check_output(
+                [sys.executable, '-c', self.NFS_ONLY_BLOCK_CALL, f.name],
+                cwd=os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))))
+        before, response, after = [json.loads(line)
+                                   for line in out.decode().splitlines()[-3:]]
+        self.assertEqual(before, dict(known=True, loaded=False))
+        if after['rtslib']:
+            self.assertTrue(after['block'])
+            self.assertIsInstance(response['result'], list)
+            self.assertEqual(after['tries'], [1, 1])
+        else:
+            # No rtslib here, the call says so instead of not being found
+            self.assertEqual(response['error']['code'],
+                             TargetdError.NO_SUPPORT)
+            self.assertIn("rtslib", response['error']['message'])
+            # Tried again after a reload only
+            self.assertEqual(after['tries'], [1, 2])
+
+    @staticmethod
+    def _scrape(conn, auth=None):
+        headers = {}
+        if auth:
+            headers['Authorization'] = \
+                'Basic %s' % base64.b64encode(auth.encode()).decode()
+        conn.request('GET', '/metrics', headers=headers)
+        r = conn.getresponse()
+        body = r.read().decode()
+        samples = dict()
+        if r.status == 200:
+            for line in body.splitlines():
+                if line and not line.startswith('#'):
+                    name, value = line.rsplit(' ', 1)
+                    samples[name] = float(value)
+        return r, samples
+
+    def _metrics(self, engine):
+        @utils.locks('m')
+        def ok(req):
+            utils.execute(['true'])
+            return True
+
+        @utils.locks('m')
+        def fail(req):
+            raise TargetdError(TargetdError.INVALID_POOL, "no pool")
+
+        srv = LocalServer(dict(ok=ok, fail=fail), engine=engine,
+                          metrics=True)
+        try:
+            conn = srv.connect()
+            r, before = self._scrape(conn)
+            self.assertEqual(r.status, 200)
+            self.assertTrue(r.getheader('Content-Type').startswith(
+                'text/plain; version=0.0.4'))
+
+            self.assertTrue(srv.call("ok", conn=conn))
+            with self.assertRaises(TargetdError):
+                srv.call("fail", conn=conn)
+
+            r, after = self._scrape(conn)
+
+            def grew(name, by=1):
+                self.assertEqual(after[name] - before.get(name, 0), by, name)
+
+            grew('targetd_call_seconds_count{method="ok"}')
+            grew('targetd_call_seconds_bucket{method="ok",le="+Inf"}')
+            grew('targetd_lock_wait_seconds_count{method="ok"}')
+            grew('targetd_lock_hold_seconds_count{method="fail"}')
+            grew('targetd_call_errors_total{method="fail",code="%d"}' %
+                 TargetdError.INVALID_POOL)
+            grew('targetd_command_seconds_count{command="true"}')
+            self.assertIn('targetd_tarpit_held', after)
+
+            main.config['metrics_password'] = "scrape"
+            # Missing credentials
+            r, samples = self._scrape(srv.connect())
+            self.assertEqual(r.status, 400)
+            r, samples = self._scrape(srv.connect(), "metrics:scrape")
+            self.assertEqual(r.status, 200)
+
+            main.config['metrics'] = False
+            r, samples = self._scrape(srv.connect())
+            self.assertEqual(r.status, 404)
+        finally:
+            srv.close()
+
+    def test_gp_metrics(self):
+        self._metrics("threading")
+
+    def test_gp_metrics_threads_gone(self):
+        # bounded() runs each library call on a thread of its own, what
+        # they record is kept once they are gone but not their shards
+        counter = metrics.Counter('test_counter', 'test')
+        histogram = metrics.Histogram('test_seconds', 'test')
+
+        def record():
+            counter.inc("a")
+            histogram.observe("a", 0.5)
+
+        before = len(utils.library_call_seconds._shards)
+        with utils.call_context(30):
+            for _ in range(200):
+                utils.bounded(record)
+        for _ in range(50):
+            if len(counter._shards) <= 1:
+                break
+            time.sleep(0.1)
+        self.assertLessEqual(len(counter._shards), 1)
+        self.assertLessEqual(len(utils.library_call_seconds._shards),
+                             before + 1)
+        self.assertEqual(counter.values(), dict(a=200))
+        self.assertEqual(histogram.values()["a"]["count"], 200)
+        self.assertEqual(histogram.values()["a"]["sum"], 100.0)
+
+    def _server_timing(self, engine):
+        @utils.locks('t')
+        def traced(req):
+            utils.execute(['true'])
+            utils.execute(['sh', '-c', 'echo abc; exit 3'])
+            return True
+
+        srv = LocalServer(dict(traced=traced, debug_trace=main.debug_trace),
+                          engine=engine, server_timing=True)
+        try:
+            conn = srv.connect()
+            auth = '%s:%s' % (testlib.user, testlib.password)
+            conn.request('POST', testlib.rpc_path, json.dumps(dict(
+                id=1, method="traced", jsonrpc="2.0")), {
+                'Authorization':
+                    'Basic %s' % base64.b64encode(auth.encode()).decode(),
+                'X-Request-Id': 'trace-%s' % engine})
+            r = conn.getresponse()
+            r.read()
+            timing = r.getheader('Server-Timing')
+            self.assertIn('true;dur=', timing)
+            self.assertIn('sh;dur=', timing)
+            self.assertIn('request;desc="trace-%s"' % engine, timing)
+
+            rc = srv.call("debug_trace", dict(request_id='trace-%s' % engine),
+                          conn=conn)
+            self.assertEqual([t['argv'][0] for t in rc], ['true', 'sh'])
+            self.assertEqual([t['exit_code'] for t in rc], [0, 3])
+            self.assertEqual(rc[1]['stdout_bytes'], 4)
+            self.assertEqual(rc[1]['method'], "traced")
+            self.assertEqual(rc[1]['retry'], 0)
+            self.assertEqual(len(srv.call("debug_trace", dict(limit=1),
+                                          conn=conn)), 1)
+
+            main.config['server_timing'] = False
+            r, payload = srv.post(conn, dict(id=1, method="traced",
+                                             jsonrpc="2.0"))
+            self.assertIsNone(r.getheader('Server-Timing'))
+        finally:
+            srv.close()
+
+    def test_gp_server_timing(self):
+        self._server_timing("threading")
+
+    def test_gp_server_timing_asyncio(self):
+        self._server_timing("asyncio")
+
+    def test_gp_lock_watchdog(self):
+        manager = utils.LockManager()
+        release = threading.Event()
+        holding = threading.Event()
+
+        def slow():
+            with manager.locked(['k'], name="slow"):
+                holding.set()
+                release.wait(10)
+
+        def queued():
+            with manager.locked(['k'], name="queued"):
+                pass
+
+        threads = [threading.Thread(target=slow),
+                   threading.Thread(target=queued)]
+        threads[0].start()
+        holding.wait(10)
+        threads[1].start()
+        try:
+            for _ in range(100):
+                if manager.status()['waiters']:
+                    break
+                time.sleep(0.01)
+            rc = manager.status()
+            self.assertEqual([h['method'] for h in rc['holders']], ["slow"])
+            self.assertEqual(rc['holders'][0]['keys'], ['k'])
+            self.assertEqual([(w['method'], w['waiting_for'])
+                              for w in rc['waiters']], [("queued", 'k')])
+
+            with self.assertLogs(level='WARNING') as cm:
+                self.assertEqual(manager.stuck(0), ["slow"])
+            # the holder's stack, down to where it waits
+            self.assertIn("release.wait", cm.output[0])
+            # reported once
+            self.assertEqual(manager.stuck(0), [])
+        finally:
+            release.set()
+            for t in threads:
+                t.join(10)
+        self.assertEqual(manager.status(), dict(holders=[], waiters=[]))
+
+    def _herd(self, callers=30, **cfg):
+        runs = []
+
+        @utils.read_only
+        @utils.locks('p')
+        def polled(req, pool):
+            runs.append(pool)
+            time.sleep(0.05)
+            return [pool, len(runs) > 0]
+
+        srv = LocalServer(dict(polled=polled), read_snapshot_ttl=0, **cfg)
+        pool = ThreadPool(callers)
+        try:
+            results = pool.map(lambda i: srv.call("polled", dict(pool="x")),
+                               range(callers))
+        finally:
+            pool.close()
+            srv.close()
+        self.assertEqual(results, [["x", True]] * callers)
+        return len(runs)
+
+    def test_gp_coalesce_reads(self):
+        # A thundering herd of identical polls runs the method a few times
+        # instead of once per caller
+        self.assertLess(self._herd(), 10)
+        self.assertEqual(self._herd(coalesce_reads=False), 30)
+
+    def test_ep_coalesced_timeout(self):
+        # A call waiting for an identical one gives up at its own deadline,
+        # and is accounted for as the one it waited for
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.read_only
+        @utils.locks('c')
+        def waited(req):
+            started.set()
+            release.wait(10)
+            return True
+
+        srv = LocalServer(dict(waited=waited), read_snapshot_ttl=0)
+        pool = ThreadPool(1)
+        before = main.call_seconds.values().get('waited', dict(count=0))
+        try:
+            leader = pool.apply_async(srv.call, ("waited",
+                                                 dict(call_timeout=0.5)))
+            started.wait(10)
+            start = time.time()
+            with self.assertRaises(TargetdError) as cm:
+                srv.call("waited", dict(call_timeout=0.5))
+            self.assertEqual(cm.exception.error, TargetdError.TIMEOUT)
+            self.assertLess(time.time() - start, 5)
+            release.set()
+            self.assertTrue(leader.get(10))
+            self.assertEqual(main.call_seconds.values()['waited']['count'],
+                             before['count'] + 2)
+        finally:
+            release.set()
+            pool.close()
+            srv.close()
+
+    def test_gp_read_snapshot(self):
+        runs = []
+        writing = threading.Event()
+        release = threading.Event()
+
+        @utils.read_only
+        @utils.locks('s')
+        def listed(req):
+            runs.append(1)
+            return len(runs)
+
+        @utils.locks('s')
+        def changed(req, wait=False):
+            if wait:
+                writing.set()
+                release.wait(10)
+            return True
+
+        srv = LocalServer(dict(listed=listed, changed=changed))
+        pool = ThreadPool(1)
+        try:
+            self.assertEqual(srv.call("listed"), 1)
+            self.assertEqual(srv.call("listed"), 1)
+            self.assertTrue(srv.call("changed"))
+            self.assertEqual(srv.call("listed"), 2)
+
+            # A write in progress doesn't hold up reads, which see the state
+            # from before it
+            writer = pool.apply_async(srv.call, ("changed", dict(wait=True)))
+            writing.wait(10)
+            start = time.time()
+            self.assertEqual(srv.call("listed"), 2)
+            self.assertLess(time.time() - start, 1)
+            release.set()
+            self.assertTrue(writer.get(10))
+            self.assertEqual(srv.call("listed"), 3)
+
+            main.config['read_snapshot_ttl'] = 0
+            self.assertEqual(srv.call("listed"), 4)
+            self.assertEqual(srv.call("listed"), 5)
+        finally:
+            release.set()
+            pool.close()
+            srv.close()
+
+    def _reread(self):
+        # Wait for the snapshots made stale by a write to be read again
+        for i in range(500):
+            if not main.snapshots.rereading:
+                return
+            time.sleep(0.01)
+        self.fail("snapshots still being read again")
+
+    def test_gp_read_snapshot_writer(self):
+        # Reads don't queue behind a long write, even once their snapshot
+        # is older than read_snapshot_ttl
+        runs = []
+        writing = threading.Event()
+        release = threading.Event()
+
+        @utils.read_only
+        @utils.locks('s')
+        def polled(req, page=0):
+            runs.append(page)
+            return len(runs)
+
+        @utils.locks('s')
+        def changed(req, wait=False):
+            if wait:
+                writing.set()
+                release.wait(10)
+            return True
+
+        srv = LocalServer(dict(polled=polled, changed=changed),
+                          read_snapshot_ttl=0.2)
+        pool = ThreadPool(1)
+        before = main.call_seconds.values().get('polled', dict(count=0))
+        try:
+            self.assertEqual(srv.call("polled"), 1)
+            # The write has it read again in the background, which isn't a
+            # call of the method
+            self.assertTrue(srv.call("changed"))
+            self._reread()
+            self.assertEqual(len(runs), 2)
+            self.assertEqual(main.call_seconds.values()['polled']['count'],
+                             before['count'] + 1)
+
+            writer = pool.apply_async(srv.call, ("changed", dict(wait=True)))
+            writing.wait(10)
+            time.sleep(0.3)
+            start = time.time()
+            self.assertEqual(srv.call("polled"), 2)
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(len(runs), 2)
+            release.set()
+            self.assertTrue(writer.get(10))
+            self._reread()
+            self.assertEqual(srv.call("polled"), 3)
+
+            # Only the latest few are read again
+            main.config['read_snapshot_ttl'] = 10
+            pages = 3 * utils.SNAPSHOT_REREADS
+            for page in range(1, pages + 1):
+                srv.call("polled", dict(page=page))
+            del runs[:]
+            self.assertTrue(srv.call("changed"))
+            self._reread()
+            self.assertEqual(runs, list(range(pages - utils.SNAPSHOT_REREADS
+                                              + 1, pages + 1)))
+        finally:
+            release.set()
+            pool.close()
+            srv.close()
+
+    def test_gp_fs_catalog(self):
+        fs = importlib.import_module('targetd.fs')
+        calls = []
+
+        class Backend(object):
+            filesystems = dict(
+                ("/p/%s" % n, dict(name=n, uuid="u-%s" % n, pool="/p",
+                                   total_space=1, free_space=1,
+                                   full_path="/p/%s" % n))
+                for n in ("a", "b"))
+
+            @staticmethod
+            def has_fs_pool(pool):
+                return pool == "/p"
+
+            @staticmethod
+            def fs_hash(pool=None, name_prefix=None):
+                calls.append('fs_hash')
+                return dict(Backend.filesystems)
+
+            @staticmethod
+            def ss(req, pool, name, name_prefix=None):
+                calls.append('ss')
+                return [dict(name="s1", uuid="s-%s" % name, timestamp=0)]
+
+            @staticmethod
+            def fs_snapshot_delete(req, pool, name, ss_name):
+                calls.append('delete %s@%s' % (name, ss_name))
+
+            @staticmethod
+            def fs_destroy(req, pool, name):
+                calls.append('destroy %s' % name)
+                del Backend.filesystems["/p/%s" % name]
+
+        saved = fs.pool_modules, fs.catalog
+        fs.pool_modules, fs.catalog = dict(fake=Backend), None
+        try:
+            fs.fs_snapshot_delete(None, "u-a", "s-a")
+            fs.fs_snapshot_delete(None, "u-b", "s-b")
+            # one listing of the file systems, one of each one's snapshots
+            self.assertEqual(calls, ['fs_hash', 'ss', 'delete a@s1', 'ss',
+                                     'delete b@s1'])
+
+            del calls[:]
+            fs.fs_destroy(None, "u-a")
+            self.assertEqual(calls, ['destroy a'])
+            # Unknown uuids are looked for again before giving up
+            with self.assertRaises(TargetdError) as cm:
+                fs.fs_destroy(None, "u-a")
+            self.assertEqual(cm.exception.error, TargetdError.NOT_FOUND_FS)
+            self.assertEqual(calls, ['destroy a', 'fs_hash'])
+
+            del calls[:]
+            self.assertEqual(fs.ss(None, "u-b"),
+                             [dict(name="s1", uuid="s-b", timestamp=0)])
+            self.assertEqual(calls, ['ss'])
+        finally:
+            fs.pool_modules, fs.catalog = saved
+
+    # Stand-in for the parts of rtslib_fb block.py uses, see _block()
+    @staticmethod
+    def _rtslib():
+        rtslib = types.ModuleType('rtslib_fb')
+
+        class RTSLibError(Exception):
+            pass
+
+        class RTSLibNotInCFS(RTSLibError):
+            pass
+
+        def not_in_cfs(*args, **kwargs):
+            raise RTSLibNotInCFS("no configfs here")
+
+        class BlockStorageObject(object):
+            def __init__(self, name, dev=None):
+                if dev is None:
+                    raise RTSLibError("no such storage object")
+                self.name = name
+                self.dev = dev
+                self.plugin = 'block'
+                self.wwn = None
+
+            def set_attribute(self, name, value):
+                pass
+
+        class LUN(object):
+            def __init__(self, tpg, storage_object):
+                self.storage_object = storage_object
+                tpg.luns.append(self)
+
+        rtslib.RTSLibError = RTSLibError
+        rtslib.RTSLibNotInCFS = RTSLibNotInCFS
+        rtslib.BlockStorageObject = BlockStorageObject
+        rtslib.LUN = LUN
+        for name in ('Target', 'TPG', 'NodeACL', 'FabricModule', 'RTSRoot',
+                     'NetworkPortal', 'MappedLUN', 'NodeACLGroup'):
+            setattr(rtslib, name, not_in_cfs)
+        return rtslib
+
+    def _block(self):
+        """
+        Import targetd.block afresh with _rtslib() as rtslib_fb, both are
+        dropped again once the test is done.
+        """
+        package = importlib.import_module('targetd')
+        saved = dict((m, sys.modules.get(m))
+                     for m in ('rtslib_fb', 'targetd.block'))
+        attr = package.__dict__.get('block')
+
+        def restore():
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+            if attr is None:
+                package.__dict__.pop('block', None)
+            else:
+                package.block = attr
+
+        self.addCleanup(restore)
+        sys.modules['rtslib_fb'] = self._rtslib()
+        sys.modules.pop('targetd.block', None)
+        return importlib.import_module('targetd.block')
+
+    def _volume_backend(self, calls):
+        class Info(object):
+            def __init__(self, name):
+                self.size = 1024
+                self.uuid = "uuid-%s" % name
+
+        class Backend(object):
+            volumes_of = dict(p=["a", "b"])
+            fail = set()
+
+            @staticmethod
+            def has_pool(pool):
+                return pool in Backend.volumes_of
+
+            @staticmethod
+            def volumes(req, pool, name_prefix=None):
+                calls.append('volumes')
+                return [dict(name=n, size=1024, uuid="uuid-%s" % n)
+                        for n in Backend.volumes_of[pool]
+                        if name_prefix is None or n.startswith(name_prefix)]
+
+            @staticmethod
+            def vol_info(pool, name):
+                calls.append('vol_info %s' % name)
+                if 'vol_info' in Backend.fail:
+                    raise RuntimeError("vol_info failed")
+                return Info(name)
+
+            @staticmethod
+            def create(req, pool, name, size):
+                calls.append('create %s' % name)
+                if 'create' in Backend.fail:
+                    raise RuntimeError("lvcreate failed")
+                Backend.volumes_of[pool].append(name)
+
+            @staticmethod
+            def destroy(req, pool, name):
+                calls.append('destroy %s' % name)
+                Backend.volumes_of[pool].remove(name)
+
+            @staticmethod
+            def copy(req, pool, vol_orig, vol_new, timeout):
+                calls.append('copy %s %s' % (vol_orig, vol_new))
+                Backend.volumes_of[pool].append(vol_new)
+
+            @staticmethod
+            def get_so_name(pool, name):
+                return "%s:%s" % (pool, name)
+
+            @staticmethod
+            def get_dev_path(pool, name):
+                return "/dev/%s/%s" % (pool, name)
+
+        return Backend
+
+    def test_gp_volume_index(self):
+        block = self._block()
+        calls = []
+        backend = self._volume_backend(calls)
+        block.pool_modules = dict(fake=backend)
+
+        # One listing answers the checks of the calls which follow
+        self.assertTrue(block.check_vol_exists(None, "p", "a"))
+        self.assertFalse(block.check_vol_exists(None, "p", "c"))
+        self.assertEqual(calls, ['volumes'])
+
+        # Changes keep it current without listing again
+        del calls[:]
+        block.create(None, "p", "c", 1024)
+        block.copy(None, "p", "c", "d")
+        block.destroy(None, "p", "a")
+        self.assertEqual(calls, ['create c', 'vol_info c', 'copy c d',
+                                 'vol_info d', 'destroy a'])
+        self.assertEqual(sorted(block.indexes["p"].volumes),
+                         ["b", "c", "d"])
+        self.assertEqual(block.indexes["p"].volumes["c"],
+                         dict(name="c", size=1024, uuid="uuid-c"))
+        with self.assertRaises(TargetdError) as cm:
+            block.create(None, "p", "b", 1024)
+        self.assertEqual(cm.exception.error, TargetdError.NAME_CONFLICT)
+        with self.assertRaises(TargetdError) as cm:
+            block.destroy(None, "p", "a")
+        self.assertEqual(cm.exception.error, TargetdError.NOT_FOUND_VOLUME)
+
+        # Listed again once index_ttl old, to see changes made behind our
+        # back
+        del calls[:]
+        backend.volumes_of["p"].append("e")
+        self.assertFalse(block.check_vol_exists(None, "p", "e"))
+        block.indexes["p"].listed -= block.index_ttl + 1
+        self.assertTrue(block.check_vol_exists(None, "p", "e"))
+        self.assertEqual(calls, ['volumes'])
+
+        # vol_list lists them anyway, and refreshes it
+        del calls[:]
+        backend.volumes_of["p"].append("f")
+        self.assertEqual(len(block.volumes(None, "p")), 5)
+        self.assertTrue(block.check_vol_exists(None, "p", "f"))
+        self.assertEqual(calls, ['volumes'])
+
+    def test_ep_volume_index(self):
+        block = self._block()
+        calls = []
+        backend = self._volume_backend(calls)
+        block.pool_modules = dict(fake=backend)
+        self.assertTrue(block.check_vol_exists(None, "p", "a"))
+
+        # A change which failed may be half done, the index is dropped
+        backend.fail = {'create'}
+        with self.assertRaises(RuntimeError):
+            block.create(None, "p", "c", 1024)
+        self.assertNotIn("p", block.indexes)
+
+        # The change was done, only updating the index failed: the call
+        # succeeds and the pool is listed again when next needed
+        backend.fail = {'vol_info'}
+        with self.assertLogs(level='WARNING'):
+            block.create(None, "p", "d", 1024)
+        self.assertNotIn("p", block.indexes)
+        del calls[:]
+        self.assertTrue(block.check_vol_exists(None, "p", "d"))
+        self.assertEqual(calls, ['volumes'])
+
+    def test_gp_volume_index_lun(self):
+        # Exporting a volume takes its wwn from a current index rather than
+        # asking the backend
+        block = self._block()
+        calls = []
+        block.pool_modules = dict(fake=self._volume_backend(calls))
+        tpg = types.SimpleNamespace(luns=[])
+
+        self.assertTrue(block.check_vol_exists(None, "p", "a"))
+        lun = block._tpg_lun_of(tpg, "p", "a")
+        self.assertEqual(lun.storage_object.wwn, "uuid-a")
+        self.assertEqual(lun.storage_object.dev, "/dev/p/a")
+        self.assertEqual(calls, ['volumes'])
+
+        # Not twice
+        self.assertIs(block._tpg_lun_of(tpg, "p", "a"), lun)
+        self.assertEqual(len(tpg.luns), 1)
+
+        # Past index_ttl the backend is asked
+        del calls[:]
+        block.indexes["p"].listed -= block.index_ttl + 1
+        lun = block._tpg_lun_of(tpg, "p", "b")
+        self.assertEqual(lun.storage_object.wwn, "uuid-b")
+        self.assertEqual(calls, ['vol_info b'])
+
+    def test_gp_lock_status(self):
+        release = threading.Event()
+        holding = threading.Event()
+
+        @utils.locks('x')
+        def slow(req):
+            holding.set()
+            return release.wait(10)
+
+        # locks every resource
+        def hog(req):
+            return True
+
+        srv = LocalServer(dict(slow=slow, hog=hog,
+                               lock_status=main.lock_status))
+        pool = ThreadPool(2)
+        try:
+            results = [pool.apply_async(srv.call, ("slow",))]
+            holding.wait(10)
+            results.append(pool.apply_async(srv.call, ("hog",)))
+            for _ in range(100):
+                rc = srv.call("lock_status")
+                if rc['waiters']:
+                    break
+                time.sleep(0.01)
+            self.assertEqual([h['method'] for h in rc['holders']], ["slow"])
+            self.assertEqual([(w['method'], w['keys'], w['waiting_for'])
+                              for w in rc['waiters']],
+                             [("hog", None, 'all')])
+            release.set()
+            self.assertEqual([r.get(10) for r in results], [True, True])
+        finally:
+            release.set()
+            pool.close()
+            srv.close()
+
+    def test_gp_metrics_asyncio(self):
+        self._metrics("asyncio")
+
+    def test_gp_call_timeout(self):
+        # Commands are killed once the deadline passes or on cancel
+        start = time.time()
+        with self.assertRaises(TargetdError) as cm:
+            with utils.call_context(0.3):
+                utils.execute(['sleep', '5'])
+        self.assertEqual(cm.exception.error, TargetdError.TIMEOUT)
+        self.assertLess(time.time() - start, 2)
+
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        with self.assertRaises(TargetdError) as cm:
+            with utils.call_context(cancel=cancel):
+                utils.execute(['sleep', '5'])
+        self.assertEqual(cm.exception.error, TargetdError.CANCELLED)
+
+        # Nested contexts keep the earliest deadline
+        with utils.call_context(0.2):
+            with utils.call_context(60):
+                self.assertLessEqual(utils.remaining(), 0.2)
+        self.assertIsNone(utils.remaining())
+
+        # A library call given up on keeps its locks until it returns
+        lm = utils.LockManager()
+        release = threading.Event()
+        with self.assertRaises(TargetdError) as cm:
+            with utils.call_context(0.2) as ctx, \
+                    lm.locked(['pool'], ctx.orphans):
+                utils.bounded(release.wait, 10)
+        self.assertEqual(cm.exception.error, TargetdError.TIMEOUT)
+        lock = lm._key_lock('pool')
+        self.assertFalse(lock.acquire(timeout=0.2))
+        release.set()
+        self.assertTrue(lock.acquire(timeout=5))
+        lock.release()
+
+    def test_ep_call_timeout(self):
+        @utils.locks()
+        def slow(req):
+            utils.execute(['sleep', '5'])
+
+        srv = LocalServer(dict(slow=slow), call_timeouts=dict(slow=0.3))
+        try:
+            start = time.time()
+            with self.assertRaises(TargetdError) as cm:
+                srv.call("slow")
+            self.assertEqual(cm.exception.error, TargetdError.TIMEOUT)
+            self.assertLess(time.time() - start, 2)
+
+            with self.assertRaises(TargetdError) as cm:
+                srv.call("slow", dict(call_timeout=0.2))
+            self.assertEqual(cm.exception.error, TargetdError.TIMEOUT)
+
+            for bad in (0, -1, "soon"):
+                with self.assertRaises(TargetdError) as cm:
+                    srv.call("slow", dict(call_timeout=bad))
+                self.assertEqual(cm.exception.error,
+                                 TargetdError.INVALID_ARGUMENT)
+        finally:
+            srv.close()
+
+    def test_gp_job_cancel_running(self):
+        started = threading.Event()
+
+        @jobs.long_running
+        @utils.locks('job')
+        def slow(req):
+            started.set()
+            utils.execute(['sleep', '10'])
+
+        srv = LocalServer(dict(slow=slow))
+        methods = jobs.initialize(main.config)
+        main.mapping.update(methods)
+        srv.methods.update(methods)
+        try:
+            job = srv.call("slow", dict(async_job=True))['job_id']
+            self.assertTrue(started.wait(10))
+            self.assertTrue(srv.call("job_cancel", dict(job_id=job)))
+            status = srv.call("job_wait", dict(job_id=job, timeout=5))
+            self.assertEqual(status['status'], jobs.CANCELLED)
+            self.assertEqual(status['error']['code'], TargetdError.CANCELLED)
+            self.assertFalse(srv.call("job_cancel", dict(job_id=job)))
+        finally:
+            srv.close()
+
+    def _queue_full(self, engine):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(req):
+            started.set()
+            release.wait(10)
+            return "done"
+
+        srv = LocalServer(dict(slow=slow), engine=engine, workers=1,
+                          accept_queue_size=1)
+        before = main.requests_rejected.values()
+        results = []
+
+        def call():
+            results.append(srv.call("slow"))
+
+        try:
+            threads = [threading.Thread(target=call) for _ in range(2)]
+            threads[0].start()
+            self.assertTrue(started.wait(10))
+            threads[1].start()
+            time.sleep(0.3)
+
+            r, payload = LocalServer.post(srv.connect(), dict(
+                id=1, method="slow", jsonrpc="2.0"))
+            self.assertEqual(r.status, 503)
+            self.assertEqual(r.getheader('Retry-After'),
+                             str(main.RETRY_AFTER))
+
+            release.set()
+            for t in threads:
+                t.join(10)
+            self.assertEqual(results, ["done", "done"])
+
+            rejected = main.requests_rejected.values()
+            key = "slow" if engine == "asyncio" else ""
+            self.assertEqual(rejected.get(key, 0), before.get(key, 0) + 1)
+            self.assertEqual(main.requests_in_flight.values()['slow'], 0)
+            waits = main.queue_wait_seconds.values()['slow']
+            self.assertGreaterEqual(waits['count'], 2)
+            self.assertGreater(waits['sum'], 0.2)
+        finally:
+            release.set()
+            srv.close()
+
+    def test_gp_queue_full(self):
+        for engine in ("threading", "asyncio"):
+            self._queue_full(engine)
+
+    @unittest.skipUnless(shutil.which('openssl') and os.geteuid() == 0,
+                         "needs openssl and root owned certificate files")
+    def test_gp_ssl_context_reload(self):
+        with tempfile.TemporaryDirectory() as d:
+            def cert(n):
+                subprocess.check_call(
+                    ['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                     '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                     '-keyout', os.path.join(d, 'k%d.pem' % n),
+                     '-out', os.path.join(d, 'c%d.pem' % n)],
+                    stderr=subprocess.DEVNULL)
+
+            def install(n):
+                for f in ('c', 'k'):
+                    dst = os.path.join(d, '%s.pem' % f)
+                    shutil.copy(os.path.join(d, '%s%d.pem' % (f, n)), dst)
+                    os.chmod(dst, 0o600)
+
+            cert(1)
+            cert(2)
+            install(1)
+            with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+                f.write("password: %s\nssl_cert: %s/c.pem\n"
+                        "ssl_key: %s/k.pem\n" % (testlib.password, d, d))
+                f.flush()
+                main.load_config(f.name)
+
+            interval = main.SSLContextCache.CHECK_INTERVAL
+            main.SSLContextCache.CHECK_INTERVAL = 0
+            try:
+                cache = main.SSLContextCache()
+                first = cache.get()
+                self.assertIs(cache.get(), first)
+
+                install(2)
+                second = cache.get()
+                self.assertIsNot(second, first)
+                self.assertEqual(cache.reloads, 1)
+
+                # A bad certificate keeps the working context
+                with open(os.path.join(d, 'c.pem'), 'w') as c:
+                    c.write("garbage")
+                self.assertIs(cache.get(), second)
+                self.assertEqual(cache.reloads, 1)
+            finally:
+                main.SSLContextCache.CHECK_INTERVAL = interval
+
+    @unittest.skipUnless(shutil.which('openssl'), "needs openssl")
+    def test_ep_tls_silent_clients(self):
+        # Connections which never start their TLS handshake don't keep the
+        # workers from serving others
+        with tempfile.TemporaryDirectory() as d:
+            cert, key = os.path.join(d, 'c.pem'), os.path.join(d, 'k.pem')
+            subprocess.check_call(
+                ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                 '-days', '1', '-subj', '/CN=localhost', '-keyout', key,
+                 '-out', cert], stderr=subprocess.DEVNULL)
+            srv = LocalServer(dict(echo=lambda req, v=None: v), engine="tls",
+                              workers=2, ssl_cert=cert, ssl_key=key,
+                              tls_handshake_timeout=60)
+            silent = []
+            try:
+                for _ in range(2):
+                    silent.append(socket.create_connection(
+                        ('127.0.0.1', srv.port)))
+                time.sleep(0.3)
+                start = time.time()
+                self.assertEqual(srv.call("echo", dict(v=1)), 1)
+                self.assertLess(time.time() - start, 5)
+
+                # Nor does one that stalls in the middle of it
+                srv.close()
+                srv = LocalServer(dict(echo=lambda req, v=None: v),
+                                  engine="tls", workers=1, ssl_cert=cert,
+                                  ssl_key=key, tls_handshake_timeout=0.5)
+                stalled = socket.create_connection(('127.0.0.1', srv.port))
+                silent.append(stalled)
+                stalled.sendall(b'\x16\x03\x01')
+                time.sleep(0.2)
+                start = time.time()
+                self.assertEqual(srv.call("echo", dict(v=2)), 2)
+                self.assertLess(time.time() - start, 5)
+            finally:
+                for s in silent:
+                    s.close()
+                srv.close()
+
+    def _tarpit_flood(self, engine):
+        srv = LocalServer(dict(echo=lambda req, v=None: v), engine=engine)
+        stats = main.tar.stats()
+        try:
+            def bad_auth(i):
+                # Each attacker from its own address, the tarpit is per
+                # client address
+                start = time.time()
+                try:
+                    r, payload = LocalServer.post(
+                        srv.connect(("127.0.0.%d" % (2 + i % 200), 0)),
+                        dict(id=1, method="echo", jsonrpc="2.0"),
+                        password="bad")
+                except OSError:
+                    # See test_ep_concurrent_authentication, the immediate
+                    # 503 can be lost to a connection reset
+                    return 503, time.time() - start
+                return r.status, time.time() - start
+
+            flood = 300
+            tp = ThreadPool(processes=flood)
+            attack = tp.map_async(bad_auth, range(flood))
+            time.sleep(0.5)
+
+            latency = []
+            for i in range(20):
+                start = time.time()
+                self.assertEqual(srv.call("echo", dict(v=i)), i)
+                latency.append(time.time() - start)
+
+            results = attack.get(30)
+            tp.close()
+            self.assertTrue(all(code in (401, 503) for code, _ in results))
+            self.assertTrue(all(t >= main.TARPIT_DELAY * 0.9
+                                for code, t in results if code == 401))
+            self.assertLess(max(latency), 0.5,
+                            "legitimate calls delayed by auth flood %s" %
+                            latency)
+
+            # The reply can reach the client just before the tarpit lets go
+            for _ in range(20):
+                after = main.tar.stats()
+                if not after['held']:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(after['held'], 0)
+            self.assertEqual(after['pending'], 0)
+            self.assertGreater(after['pitted'], stats['pitted'])
+        finally:
+            srv.close()
+
+    def test_gp_tarpit_flood(self):
+        self._tarpit_flood("threading")
+        self._tarpit_flood("asyncio")
+
 
 class TestConnect(unittest.TestCase):
 
@@ -223,9 +2063,13 @@ class TestConnect(unittest.TestCase):
                  method=method,
                  params=params, jsonrpc="2.0")).encode('utf-8')
 
-        self.assertRaises(ConnectionError,
-                          jsonrequest,
-                          method, params=None, data=data[0:len(data) - 10])
+        error_code = 0
+        try:
+            jsonrequest(method, params=None, data=data[0:len(data) - 10])
+        except TargetdError as e:
+            error_code = e.error
+
+        self.assertEqual(error_code, -32700)
 
     def test_gp_simple(self):
         # Basic good path
@@ -497,6 +2341,28 @@ class TestTargetd(unittest.TestCase):
             self._vol_destroy(block_pool, vol_copy)
             self._vol_destroy(block_pool, vol)
 
+    def test_gp_vol_list_pages(self):
+        for block_pool in self._block_pools():
+            prefix = rs(length=6)
+            names = ["%s_%d" % (prefix, i) for i in range(3)]
+            vols = [TestTargetd._vol_create(block_pool, n) for n in names]
+
+            seen = []
+            cursor = None
+            while True:
+                page = jsonrequest("vol_list", dict(
+                    pool=block_pool.name, name_prefix=prefix, limit=2,
+                    cursor=cursor))
+                self.assertLessEqual(len(page['items']), 2)
+                seen.extend(v['name'] for v in page['items'])
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(seen, names)
+
+            for vol in vols:
+                self._vol_destroy(block_pool, vol)
+
     def test_ep_copy_missing_volume(self):
         for block_pool in self._block_pools():
             vol_name = rs(length=6)
@@ -4,6 +4,10 @@ from requests.auth import HTTPBasicAuth
 
 from os import getenv, path
 import json
+import os
+import shutil
+import tempfile
+from targetd import nfs
 from targetd.utils import TargetdError
 
 # based on code from git://github.com/openstack/nova.git
@@ -19,6 +23,10 @@ port = int(getenv("TARGETD_UT_PORT", 18700))
 rpc_path = '/targetrpc'
 proto = getenv("TARGETD_UT_PROTO", "https")
 cert_file = getenv("TARGETD_UT_CERTFILE", "/tmp/targetd_cert.pem")
+# Seconds a cold start may take, and the targetd.yaml to start with (a
+# configuration without pools if unset)
+startup_budget = float(getenv("TARGETD_UT_STARTUP_BUDGET", 2))
+startup_config = getenv("TARGETD_UT_STARTUP_CONFIG")
 
 id_num = 1
 
@@ -79,4 +87,65 @@ if __name__ == "__main__":
     try:
         print(rpc("pool_list"))
     except TargetdError as e:
-        print("Got error %d %s" % (e.error, e))
\ No newline at end of file
+        print("Got error %d %s" % (e.error, e))
+
+
+class FakeExportfs(object):
+    """
+    Point targetd.nfs at exports files in a temporary directory and an
+    exportfs script which logs its arguments and lists the exports in
+    self.listing for -v.  Undone by close().
+    """
+
+    SCRIPT = """#!/bin/sh
+echo "$*" >> %(dir)s/calls
+if [ "$1" = "-v" ]; then cat %(dir)s/listing; fi
+"""
+
+    def __init__(self, exports=(), user_exports=""):
+        self.dir = tempfile.mkdtemp()
+        self.main_file = path.join(self.dir, 'exports')
+        self.config_dir = path.join(self.dir, 'exports.d')
+        self.etab = path.join(self.dir, 'nfs', 'etab')
+        self.listing = path.join(self.dir, 'listing')
+        os.mkdir(self.config_dir)
+        os.mkdir(path.dirname(self.etab))
+        for name in (self.etab, path.join(self.dir, 'calls')):
+            open(name, 'w').close()
+        with open(self.main_file, 'w') as f:
+            f.write(user_exports)
+        self.set_listing(exports)
+        cmd = path.join(self.dir, 'exportfs')
+        with open(cmd, 'w') as f:
+            f.write(self.SCRIPT % dict(dir=self.dir))
+        os.chmod(cmd, 0o755)
+
+        self.saved = dict((k, getattr(nfs.Nfs, k)) for k in (
+            'CMD', 'MAIN_EXPORT_FILE', 'EXPORT_FS_CONFIG_DIR', 'ETAB',
+            'table'))
+        nfs.Nfs.CMD = cmd
+        nfs.Nfs.MAIN_EXPORT_FILE = self.main_file
+        nfs.Nfs.EXPORT_FS_CONFIG_DIR = self.config_dir
+        nfs.Nfs.ETAB = self.etab
+        nfs.Nfs.table = None
+
+    def set_listing(self, exports):
+        """
+        exports: (path, host, options) tuples, listed as exportfs -v does.
+        """
+        with open(self.listing, 'w') as f:
+            for p, h, o in exports:
+                f.write("%s\t%s(%s)\n" % (p, h, o))
+
+    def calls(self):
+        with open(path.join(self.dir, 'calls')) as f:
+            return f.read().splitlines()
+
+    def config_file(self):
+        with open(path.join(self.config_dir, nfs.Nfs.EXPORT_FILE)) as f:
+            return f.read()
+
+    def close(self):
+        for k, v in self.saved.items():
+            setattr(nfs.Nfs, k, v)
+        shutil.rmtree(self.dir)